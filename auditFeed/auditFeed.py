@@ -1,7 +1,8 @@
 # auditFeed.py
 #
-# This script takes as input an API key, account ID, and time frame, and returns
-# audit records in JSON format from the auditFeed API for that account. Optional
+# This script takes as input an API key, one or more account IDs, and a time
+# frame, and returns audit records in JSON format from the auditFeed API for
+# those accounts. Optional
 # parameters include a marker value to initialise with and the path to a file in
 # which to store the marker between runs. Audit records can also be filtered by
 # audit field values.
@@ -11,6 +12,30 @@
 # changes, the stored marker is reset automatically to avoid reusing a marker
 # across different time frames.
 #
+# The auditFeed API accepts a list of account IDs and returns an accounts[]
+# array, so several accounts can be collected with a single request chain.
+# Pass a comma-separated list to -I, and optionally use -B to cap how many
+# accounts go into each request. Each group of accounts has its own marker,
+# timeFrame and dedup state in the config file, and every record is tagged with
+# the account_id it belongs to.
+#
+# Several copies of the script can share one config file to spread collection
+# across hosts. -S index/count assigns each instance a shard of the account
+# list (every account belongs to exactly one shard), and -L enables leases:
+# while an instance collects an account group it records a lease with an
+# expiry time in the config file and renews it on every page. Other instances
+# skip groups with a live lease, and take over a group once its lease has
+# expired, so a standby started with the same -S value fails over within one
+# lease period. Config file updates are serialized with flock() on
+# CONFIG_FILE.lock, where the platform supports it.
+#
+# With -d, state is kept in a SQLite database (WAL mode) instead of the config
+# file: markers per account group and timeFrame, seen record identities with
+# time-based expiry, per-destination delivery cursors and leases. Each page is
+# committed as a small transaction rather than a rewrite of the whole state.
+# The first time a group is collected with -d, its state is migrated from the
+# config file if one exists. The database schema is shared with eventsFeed.py.
+#
 # The auditFeed API query returns records with fieldsMap and flatFields. This
 # script normalizes records into a JSON key:value collection, adds audit and
 # event timestamps from the record time, and keeps output behavior similar to
@@ -24,7 +49,7 @@
 # Options:
 #   -h, --help          show this help message and exit
 #   -K API_KEY          API key
-#   -I ID               Account ID
+#   -I ID               Account ID, or comma-separated list of account IDs
 #   -T TIME_FRAME       Cato TimeFrame, for example last.P1D
 #   -P                  Prettify output
 #   -p                  Print audit records
@@ -38,6 +63,19 @@
 #                       of audit records (default=1)
 #   -r RUNTIME_LIMIT    Stop execution if total runtime exceeds this many
 #                       seconds (default=infinite)
+#   -B BATCH_SIZE       Maximum number of accounts per auditFeed request
+#                       (default is all accounts in one request)
+#   -U API_URL          API endpoint URL (default
+#                       https://api.catonetworks.com/api/v1/graphql2)
+#   -S SHARD            Only collect the accounts in this shard, as
+#                       index/count, for example 0/3
+#   -L LEASE_SECONDS    Lease account groups for this many seconds so that
+#                       several instances can share the config file (default
+#                       is no leases, or 60 seconds when -S is used)
+#   -d STATE_DB         Keep state in this SQLite database instead of the
+#                       config file, migrating from the config file on first use
+#   --stream            Decompress and parse responses incrementally, one
+#                       record at a time, to bound memory use
 #   -v                  Print debug info
 #   -V                  Print detailed debug info
 #
@@ -64,6 +102,22 @@
 # To only see audit records where change_type is CREATED:
 #   python3 auditFeed.py -K YOURAPIKEY -I 1714 -T last.P1D -p -F change_type=CREATED
 #
+# To collect three accounts with one request chain:
+#   python3 auditFeed.py -K YOURAPIKEY -I 1714,1715,1716 -T last.P1D -p
+#
+# To collect many accounts, at most 50 accounts per request:
+#   python3 auditFeed.py -K YOURAPIKEY -I "$(cat accounts.txt)" -T last.P1D -B 50 -p
+#
+# To split the same account list across three hosts sharing one config file,
+# run one instance per shard:
+#   python3 auditFeed.py -K YOURAPIKEY -I "$(cat accounts.txt)" -T last.P1D -S 0/3 -c /shared/config.txt
+#   python3 auditFeed.py -K YOURAPIKEY -I "$(cat accounts.txt)" -T last.P1D -S 1/3 -c /shared/config.txt
+#   python3 auditFeed.py -K YOURAPIKEY -I "$(cat accounts.txt)" -T last.P1D -S 2/3 -c /shared/config.txt
+#
+# To keep state for many accounts in a SQLite database, importing the existing
+# ./config.txt on the first run:
+#   python3 auditFeed.py -K YOURAPIKEY -I "$(cat accounts.txt)" -T last.P1D -d ./state.db -p
+#
 # This script is supplied as a demonstration of how to access the Cato API with
 # Python. It is not an official Cato release and is provided with no guarantees
 # of support. Error handling is restricted to the bare minimum required for the
@@ -73,17 +127,28 @@
 
 import argparse
 import base64
+import codecs
+import contextlib
 import datetime
 import gzip
 import hmac
 import hashlib
+import itertools
 import json
 import os
 import socket
+import sqlite3
 import sys
 import time
 import urllib.error
 import urllib.request
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    # no flock() on this platform (Windows): config file updates are unlocked
+    fcntl = None
 
 
 # Maximum number of recently-seen record hashes to remember between runs.
@@ -91,6 +156,12 @@ import urllib.request
 # few thousand is plenty while keeping the state file small.
 MAX_SEEN_HASHES = 5000
 
+# With the SQLite state store (-d), seen record hashes are kept for this many
+# seconds instead of being capped at MAX_SEEN_HASHES.
+SEEN_HASH_TTL = 7 * 24 * 3600
+
+DEFAULT_API_URL = "https://api.catonetworks.com/api/v1/graphql2"
+
 
 ########################################################################################
 ########################################################################################
@@ -140,9 +211,170 @@ def logd(text):
         log(text)
 
 
-# send GQL query string and variables to API, return JSON
+# Responses are decoded incrementally with --stream. The in-body rate-limit
+# and error checks only need the start of the body.
+RATE_LIMIT_PREFIX = '{"errors":[{"message":"rate limit for operation:'
+ERRORS_PREFIX = '{"errors"'
+
+
+class FeedStream:
+    """Incremental decoder for a FEED API response.
+
+    The body is read in CHUNK_SIZE pieces, gunzipped with a zlib
+    decompressobj and parsed with a small pull parser. Iterating yields
+    (account_id, record) for each entry of data.FEED.accounts[].records,
+    decoded one record at a time with json.JSONDecoder.raw_decode, so memory
+    is bounded by the record size rather than the page size. The scalar
+    fields of data.FEED (marker, fetchedCount, ...) are collected in .fields
+    as they are parsed, and the whole response with the records arrays left
+    empty is available as .envelope once iteration is complete.
+
+    GraphQL returns fields in query order, so marker and the account id are
+    known before the records that follow them."""
+
+    CHUNK_SIZE = 65536
+
+    def __init__(self, response, feed):
+        self.response = response
+        self.feed = feed
+        self.decompressor = None
+        self.decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self.json_decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.started = False
+        self.eof = False
+        self.fields = {}
+        self.envelope = None
+        self.account_id = None
+
+    def _fill(self):
+        """Append the next decoded chunk to the buffer, dropping what has
+        already been parsed. Returns False at the end of the body."""
+        global total_bytes_compressed
+        global total_bytes_uncompressed
+        if self.eof:
+            return False
+        raw = self.response.read(self.CHUNK_SIZE)
+        if not self.started:
+            self.started = True
+            if raw[:2] == b"\x1f\x8b":
+                self.decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        total_bytes_compressed += len(raw)
+        if raw:
+            data = self.decompressor.decompress(raw) if self.decompressor else raw
+        else:
+            self.eof = True
+            data = self.decompressor.flush() if self.decompressor else b""
+        total_bytes_uncompressed += len(data)
+        self.buf = self.buf[self.pos:] + self.decoder.decode(data, final=self.eof)
+        self.pos = 0
+        return True
+
+    def startswith(self, prefix):
+        while len(self.buf) - self.pos < len(prefix) and self._fill():
+            pass
+        return self.buf.startswith(prefix, self.pos)
+
+    def _peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def _next(self, expected):
+        ch = self._peek()
+        if not ch or ch not in expected:
+            raise ValueError(f"Unexpected {ch!r} in {self.feed} response, expected one of {expected!r}")
+        self.pos += 1
+        return ch
+
+    def _value(self):
+        """Decode one complete JSON value, reading more of the body as needed."""
+        self._peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number at the end of the buffer may continue in the next chunk
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def _parse(self, path):
+        """Parse the value at path, yielding records along the way, and return
+        it with the records arrays left empty."""
+        target = ("data", self.feed, "accounts", None, "records")
+        on_path = all(t is None or p == t for p, t in zip(path, target))
+        ch = self._peek()
+        if not on_path or ch not in ("{", "["):
+            return self._value()
+        if ch == "{":
+            return (yield from self._object(path))
+        return (yield from self._array(path))
+
+    def _object(self, path):
+        self._next("{")
+        result = {}
+        if len(path) == 4:
+            self.account_id = None
+        if self._peek() == "}":
+            self.pos += 1
+            return result
+        while True:
+            if self._peek() != '"':
+                raise ValueError(f"Expected an object key in {self.feed} response")
+            key = self._value()
+            self._next(":")
+            value = yield from self._parse(path + (key,))
+            result[key] = value
+            if len(path) == 4 and key == "id":
+                self.account_id = value
+            elif len(path) == 2:
+                self.fields[key] = value
+            if self._next(",}") == "}":
+                return result
+
+    def _array(self, path):
+        self._next("[")
+        result = []
+        if self._peek() == "]":
+            self.pos += 1
+            return result
+        if len(path) == 5:
+            # data.FEED.accounts[i].records: yield each record, keep none
+            while True:
+                yield self.account_id, self._value()
+                if self._next(",]") == "]":
+                    return result
+        index = 0
+        while True:
+            result.append((yield from self._parse(path + (index,))))
+            index += 1
+            if self._next(",]") == "]":
+                return result
+
+    def __iter__(self):
+        self.envelope = yield from self._parse(())
+
+    def read_all(self):
+        """Consume the rest of the body and return the parsed response."""
+        for _ in self:
+            pass
+        return self.envelope
+
+
+# send GQL query string and variables to API, return JSON, or a FeedStream
+# over the response body when stream is set
 # if we hit a network error, retry ten times with a 2 second sleep
-def send(query, variables):
+def send(query, variables, stream=False):
     global api_call_count
     global total_bytes_compressed
     global total_bytes_uncompressed
@@ -164,7 +396,7 @@ def send(query, variables):
             sys.exit(1)
         try:
             request = urllib.request.Request(
-                url='https://api.catonetworks.com/api/v1/graphql2',
+                url=api_url,
                 data=json.dumps(data).encode("utf-8"),
                 headers=headers,
                 method="POST"
@@ -190,6 +422,20 @@ def send(query, variables):
             retry_count += 1
             continue
 
+        if stream:
+            feed_stream = FeedStream(response, "auditFeed")
+            if feed_stream.startswith(RATE_LIMIT_PREFIX):
+                log(f"RATE LIMIT (attempt {retry_count}) sleeping 5 seconds then retrying")
+                response.close()
+                time.sleep(5)
+                retry_count += 1
+                continue
+            if feed_stream.startswith(ERRORS_PREFIX):
+                result = feed_stream.read_all()
+                log(f"API error: {json.dumps(result)}")
+                return False, result
+            return True, feed_stream
+
         response_data = response.read()
         total_bytes_compressed += len(response_data)
         if response.headers.get("Content-Encoding", "").lower() == "gzip" or response_data[:2] == b"\x1f\x8b":
@@ -213,9 +459,9 @@ def send(query, variables):
     return True, result
 
 
-def build_variables(marker, audit_filters):
+def build_variables(account_ids, marker, audit_filters):
     variables = {
-        "accountIDs": [args.ID],
+        "accountIDs": list(account_ids),
         "timeFrame": args.time_frame,
         "marker": marker
     }
@@ -224,6 +470,36 @@ def build_variables(marker, audit_filters):
     return variables
 
 
+def parse_account_ids(ids):
+    """Return the unique account IDs from a comma/whitespace separated list, in order."""
+    account_ids = []
+    for account_id in ids.replace(",", " ").split():
+        if account_id not in account_ids:
+            account_ids.append(account_id)
+    return account_ids
+
+
+def group_key(account_ids):
+    """Key under which an account group's state is stored in the config file."""
+    return ",".join(account_ids)
+
+
+def parse_shard(shard):
+    """Parse an index/count shard specification into (index, count)."""
+    try:
+        index, count = (int(value) for value in shard.split("/"))
+    except ValueError:
+        return None
+    if count < 1 or not 0 <= index < count:
+        return None
+    return index, count
+
+
+def in_shard(account_id, index, count):
+    """Stable shard assignment: the same account always maps to the same shard."""
+    return zlib.crc32(account_id.encode("utf-8")) % count == index
+
+
 def parse_filters(filters):
     filter_values = {}
     for filter_text in filters.split(','):
@@ -301,6 +577,204 @@ def record_identity(audit_record):
     return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
 
 
+########################################################################################
+########################################################################################
+########################################################################################
+# SQLite state store
+
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS markers (
+    feed TEXT NOT NULL,
+    account_group TEXT NOT NULL,
+    time_frame TEXT NOT NULL,
+    marker TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (feed, account_group, time_frame)
+);
+CREATE TABLE IF NOT EXISTS seen (
+    feed TEXT NOT NULL,
+    account_group TEXT NOT NULL,
+    time_frame TEXT NOT NULL,
+    identity TEXT NOT NULL,
+    seen_at REAL NOT NULL,
+    PRIMARY KEY (feed, account_group, time_frame, identity)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS seen_expiry ON seen (seen_at);
+CREATE TABLE IF NOT EXISTS cursors (
+    feed TEXT NOT NULL,
+    account_group TEXT NOT NULL,
+    time_frame TEXT NOT NULL,
+    sink TEXT NOT NULL,
+    from_marker TEXT NOT NULL,
+    to_marker TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (feed, account_group, time_frame, sink)
+);
+CREATE TABLE IF NOT EXISTS parts (
+    feed TEXT NOT NULL,
+    account_group TEXT NOT NULL,
+    time_frame TEXT NOT NULL,
+    sink TEXT NOT NULL,
+    from_marker TEXT NOT NULL,
+    to_marker TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (feed, account_group, time_frame, sink)
+);
+CREATE TABLE IF NOT EXISTS leases (
+    feed TEXT NOT NULL,
+    account_group TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (feed, account_group)
+);
+"""
+
+
+class SqliteState:
+    """Feed state in a SQLite database, shared with eventsFeed.py.
+
+    markers: current marker per account group and timeFrame
+    seen:    identities of emitted records, expired after SEEN_HASH_TTL
+    cursors: the last page (from_marker -> to_marker) delivered to each
+             network destination, so a page is not re-sent to a destination
+             that already has it when a run is restarted mid-page
+    parts:   how many records of the page being sent (from_marker ->
+             to_marker) a destination already has, for pages sent in parts
+             (--stream to Sentinel)
+    leases:  which instance is collecting an account group, and until when
+
+    Every update is a short BEGIN IMMEDIATE transaction, which also serializes
+    concurrent instances sharing the database."""
+
+    def __init__(self, path, feed):
+        self.feed = feed
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(STATE_SCHEMA)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.db
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def has_state(self, group):
+        row = self.db.execute(
+            "SELECT 1 FROM markers WHERE feed = ? AND account_group = ? LIMIT 1",
+            (self.feed, group)).fetchone()
+        return row is not None
+
+    def get_marker(self, group, time_frame):
+        row = self.db.execute(
+            "SELECT marker FROM markers WHERE feed = ? AND account_group = ? AND time_frame = ?",
+            (self.feed, group, time_frame)).fetchone()
+        return None if row is None else row[0]
+
+    def reset(self, group, time_frame, marker, identities=()):
+        """Set the marker for a group and replace its seen identities."""
+        now = time.time()
+        with self.transaction() as db:
+            db.execute(
+                "DELETE FROM seen WHERE feed = ? AND account_group = ? AND time_frame = ?",
+                (self.feed, group, time_frame))
+            self._save(db, group, time_frame, marker, identities, now)
+
+    def seen(self, group, time_frame, identities):
+        """Return the subset of identities that have already been emitted."""
+        found = set()
+        identities = list(identities)
+        for i in range(0, len(identities), 500):
+            chunk = identities[i:i + 500]
+            rows = self.db.execute(
+                "SELECT identity FROM seen WHERE feed = ? AND account_group = ? AND time_frame = ?"
+                f" AND identity IN ({','.join('?' * len(chunk))})",
+                (self.feed, group, time_frame, *chunk))
+            found.update(row[0] for row in rows)
+        return found
+
+    def save_page(self, group, time_frame, marker, identities, owner=None, lease_seconds=0):
+        """Commit a processed page: new marker and newly emitted identities.
+        When leasing, the lease is renewed in the same transaction, and nothing
+        is written (False is returned) if another instance has taken it over."""
+        now = time.time()
+        with self.transaction() as db:
+            if lease_seconds and not self._lease(db, group, owner, now + lease_seconds, now):
+                return False
+            self._save(db, group, time_frame, marker, identities, now)
+        return True
+
+    def _save(self, db, group, time_frame, marker, identities, now):
+        db.execute(
+            "INSERT INTO markers (feed, account_group, time_frame, marker, updated) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT (feed, account_group, time_frame) DO UPDATE SET marker = excluded.marker, updated = excluded.updated",
+            (self.feed, group, time_frame, marker, now))
+        db.executemany(
+            "INSERT OR IGNORE INTO seen (feed, account_group, time_frame, identity, seen_at) VALUES (?, ?, ?, ?, ?)",
+            ((self.feed, group, time_frame, identity, now) for identity in identities))
+
+    def expire_seen(self, ttl):
+        with self.transaction() as db:
+            db.execute("DELETE FROM seen WHERE seen_at < ?", (time.time() - ttl,))
+
+    def lease(self, group, owner, lease_seconds, release=False):
+        """Take, renew or release the lease on a group. Returns False if another
+        owner holds an unexpired lease."""
+        now = time.time()
+        with self.transaction() as db:
+            return self._lease(db, group, owner, now if release else now + lease_seconds, now)
+
+    def _lease(self, db, group, owner, expires, now):
+        row = db.execute(
+            "SELECT owner, expires FROM leases WHERE feed = ? AND account_group = ?",
+            (self.feed, group)).fetchone()
+        if row is not None and row[0] != owner and row[1] > now:
+            return False
+        db.execute(
+            "INSERT INTO leases (feed, account_group, owner, expires) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (feed, account_group) DO UPDATE SET owner = excluded.owner, expires = excluded.expires",
+            (self.feed, group, owner, expires))
+        return True
+
+    def delivered(self, group, time_frame, sink, from_marker, to_marker):
+        """Record that the page from_marker -> to_marker reached a destination."""
+        with self.transaction() as db:
+            db.execute(
+                "INSERT INTO cursors (feed, account_group, time_frame, sink, from_marker, to_marker, updated)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (feed, account_group, time_frame, sink) DO UPDATE SET"
+                " from_marker = excluded.from_marker, to_marker = excluded.to_marker, updated = excluded.updated",
+                (self.feed, group, time_frame, sink, from_marker, to_marker, time.time()))
+
+    def was_delivered(self, group, time_frame, sink, from_marker, to_marker):
+        row = self.db.execute(
+            "SELECT from_marker, to_marker FROM cursors"
+            " WHERE feed = ? AND account_group = ? AND time_frame = ? AND sink = ?",
+            (self.feed, group, time_frame, sink)).fetchone()
+        return row is not None and tuple(row) == (from_marker, to_marker)
+
+    def delivered_part(self, group, time_frame, sink, from_marker, to_marker, count):
+        """Record that the first `count` records of a page reached a destination."""
+        with self.transaction() as db:
+            db.execute(
+                "INSERT INTO parts (feed, account_group, time_frame, sink, from_marker, to_marker, count, updated)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (feed, account_group, time_frame, sink) DO UPDATE SET"
+                " from_marker = excluded.from_marker, to_marker = excluded.to_marker, count = excluded.count,"
+                " updated = excluded.updated",
+                (self.feed, group, time_frame, sink, from_marker, to_marker, count, time.time()))
+
+    def delivered_count(self, group, time_frame, sink, from_marker, to_marker):
+        row = self.db.execute(
+            "SELECT from_marker, to_marker, count FROM parts"
+            " WHERE feed = ? AND account_group = ? AND time_frame = ? AND sink = ?",
+            (self.feed, group, time_frame, sink)).fetchone()
+        return row[2] if row is not None and tuple(row[:2]) == (from_marker, to_marker) else 0
+
+
 ########################################################################################
 ########################################################################################
 ########################################################################################
@@ -364,7 +838,7 @@ start = datetime.datetime.now()
 # Process options
 parser = argparse.ArgumentParser()
 parser.add_argument("-K", dest="api_key", help="API key")
-parser.add_argument("-I", dest="ID", help="Account ID")
+parser.add_argument("-I", dest="ID", help="Account ID, or comma-separated list of account IDs")
 parser.add_argument("-T", dest="time_frame", help="Cato TimeFrame, for example last.P1D")
 parser.add_argument("-P", dest="prettify", action="store_true", help="Prettify output")
 parser.add_argument("-p", dest="print_events", action="store_true", help="Print audit records")
@@ -375,6 +849,12 @@ parser.add_argument("-c", dest="config_file", help="Config file location (defaul
 parser.add_argument("-F", dest="filters", help="Comma-separated field=value audit filters")
 parser.add_argument("-f", dest="fetch_limit", help="Stop execution if a fetch returns less than this number of audit records (default=1)")
 parser.add_argument("-r", dest="runtime_limit", help="Stop execution if total runtime exceeds this many seconds (default=infinite)")
+parser.add_argument("-B", dest="batch_size", help="Maximum number of accounts per auditFeed request (default is all accounts in one request)")
+parser.add_argument("-U", dest="api_url", help=f"API endpoint URL (default {DEFAULT_API_URL})")
+parser.add_argument("-S", dest="shard", help="Only collect the accounts in this shard, as index/count, for example 0/3")
+parser.add_argument("-d", dest="state_db", help="Keep state in this SQLite database instead of the config file, migrating from the config file on first use")
+parser.add_argument("-L", dest="lease_seconds", help="Lease account groups for this many seconds so that several instances can share the config file (default is no leases, or 60 seconds when -S is used)")
+parser.add_argument("--stream", dest="stream", action="store_true", help="Decompress and parse responses incrementally, one record at a time, to bound memory use")
 parser.add_argument("-v", dest="verbose", action="store_true", help="Print debug info")
 parser.add_argument("-V", dest="veryverbose", action="store_true", help="Print detailed debug info")
 args = parser.parse_args()
@@ -382,40 +862,143 @@ if args.api_key is None or args.ID is None or args.time_frame is None:
     parser.print_help()
     sys.exit(1)
 
+account_ids = parse_account_ids(args.ID)
+if not account_ids:
+    print("Error: -I must contain at least one account ID")
+    parser.print_help()
+    sys.exit(1)
+
+# keep only the accounts assigned to this instance's shard
+if args.shard is not None:
+    shard = parse_shard(args.shard)
+    if shard is None:
+        print("Error: -S value must be in the form of index/count, for example 0/3")
+        parser.print_help()
+        sys.exit(1)
+    account_ids = [account_id for account_id in account_ids if in_shard(account_id, *shard)]
+    log(f"Shard {args.shard}: {len(account_ids)} account(s) assigned to this instance")
+    if not account_ids:
+        log("No accounts assigned to this shard, nothing to do")
+        sys.exit(0)
+
+# leases let several instances share the config file without collecting the
+# same account group at the same time
+if args.lease_seconds is not None:
+    LEASE_SECONDS = int(args.lease_seconds)
+elif args.shard is not None:
+    LEASE_SECONDS = 60
+else:
+    LEASE_SECONDS = 0
+if LEASE_SECONDS and fcntl is None:
+    log("flock() is not available on this platform, config file updates are not locked")
+instance_id = f"{socket.gethostname()}:{os.getpid()}"
+
+# split the accounts into groups, one auditFeed request chain per group
+if args.batch_size is None:
+    BATCH_SIZE = len(account_ids)
+else:
+    BATCH_SIZE = int(args.batch_size)
+    if BATCH_SIZE < 1:
+        print("Error: -B must be at least 1")
+        parser.print_help()
+        sys.exit(1)
+account_groups = [account_ids[i:i + BATCH_SIZE] for i in range(0, len(account_ids), BATCH_SIZE)]
+log(f"{len(account_ids)} account(s) in {len(account_groups)} request group(s)")
+
+api_url = args.api_url or DEFAULT_API_URL
+
 
-# The auditFeed marker is scoped to a specific timeFrame. The config file stores
-# the marker together with the timeFrame it belongs to, so that a run against a
-# different time window starts cleanly instead of reusing a stale marker.
+# The auditFeed marker is scoped to a specific timeFrame and to the set of
+# accounts it was requested for. The config file stores, for each account
+# group, the marker together with the timeFrame it belongs to, so that a run
+# against a different time window starts cleanly instead of reusing a stale
+# marker.
 def read_config(path):
-    """Return (marker, time_frame, seen_hashes) from the config file.
+    """Return a dict of account group state from the config file.
 
-    Supports the JSON format written by this script as well as a legacy
-    plain-text marker file (a single line containing just the marker)."""
+    Each value is {"accountIDs", "timeFrame", "marker", "seenHashes"} and is
+    keyed by group_key(). Supports the JSON format written by this script, the
+    earlier single-account JSON format, and a legacy plain-text marker file (a
+    single line containing just the marker), which is returned under key None."""
     try:
         with open(path, "r") as f:
             content = f.read().strip()
     except IOError as e:
         log(f"Couldn't read config file: {e}")
-        return "", None, []
+        return {}
     if not content:
-        return "", None, []
+        return {}
     try:
         data = json.loads(content)
-        if isinstance(data, dict):
-            seen = data.get("seenHashes") or []
+    except ValueError:
+        data = None
+    if isinstance(data, dict):
+        if isinstance(data.get("groups"), dict):
+            stored_groups = data["groups"]
+        else:
+            # single-account state written by earlier versions of this script
+            stored_groups = {str(data.get("accountID")): data}
+        groups = {}
+        for key, group in stored_groups.items():
+            if not isinstance(group, dict):
+                continue
+            seen = group.get("seenHashes") or []
             if not isinstance(seen, list):
                 seen = []
-            return data.get("marker", "") or "", data.get("timeFrame"), seen
-    except ValueError:
-        pass
-    # legacy plain-text marker (no associated timeFrame / dedup state)
-    return content.splitlines()[0].strip(), None, []
+            groups[key] = {
+                "accountIDs": group.get("accountIDs") or parse_account_ids(key),
+                "timeFrame": group.get("timeFrame"),
+                "marker": group.get("marker", "") or "",
+                "seenHashes": seen,
+                "lease": group.get("lease"),
+            }
+        return groups
+    # legacy plain-text marker (no associated accounts / timeFrame / dedup state)
+    return {None: {
+        "accountIDs": [],
+        "timeFrame": None,
+        "marker": content.splitlines()[0].strip(),
+        "seenHashes": [],
+    }}
+
+
+def write_config(path, groups):
+    """Persist the state of every account group, replacing the file atomically."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as File:
+        json.dump({"groups": groups}, File)
+    os.replace(tmp_path, path)
+
+
+@contextlib.contextmanager
+def locked_config(path):
+    """Hold an exclusive flock() on PATH.lock while the config file is read and rewritten."""
+    if fcntl is None:
+        yield
+        return
+    with open(path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def lease_held_by_other(lease):
+    """True if another instance holds an unexpired lease on an account group."""
+    return (
+        isinstance(lease, dict)
+        and lease.get("owner") != instance_id
+        and lease.get("expires", 0) > time.time()
+    )
+
+
+def new_lease():
+    return {"owner": instance_id, "expires": time.time() + LEASE_SECONDS}
 
 
 # either use the default marker or load from config file
 config_file = "./config.txt"
-marker = ""
-seen_hashes = []
 if args.config_file is None:
     log(f"No config file specified, using default: {config_file}")
 else:
@@ -423,27 +1006,156 @@ else:
     log(f"Using config file from -c parameter: {config_file}")
 if args.marker is None:
     log("No marker value supplied, attempting to load from config file")
-    # does the config file exist, if so load the marker value
+else:
+    log(f"Using marker value from -m parameter: {args.marker}")
+
+
+def load_groups():
+    """Read every account group's state, or nothing if there is no config file yet."""
     if os.path.isfile(config_file):
-        log(f"Found config file: {config_file}")
-        stored_marker, stored_time_frame, stored_seen = read_config(config_file)
-        if stored_time_frame is not None and stored_time_frame != args.time_frame:
-            log(f"Stored timeFrame '{stored_time_frame}' differs from requested '{args.time_frame}', resetting marker and dedup state")
-            marker = ""
-            seen_hashes = []
+        return read_config(config_file)
+    return {}
+
+
+def acquire_group(account_group):
+    """Return the starting state for an account group, or None if another
+    instance holds its lease. The state is read under the config file lock
+    just before the group is collected, so progress made by an instance that
+    previously held the lease is picked up."""
+    key = group_key(account_group)
+    if state_db is not None:
+        return acquire_group_db(account_group)
+    with locked_config(config_file):
+        stored_groups = load_groups()
+        stored = stored_groups.get(key)
+        if stored is None and len(account_groups) == 1:
+            stored = stored_groups.get(None)
+        if LEASE_SECONDS and stored is not None and lease_held_by_other(stored.get("lease")):
+            log(f"[{key}] Leased by {stored['lease']['owner']}, skipping")
+            return None
+        if args.marker is not None:
+            # explicit marker override means manual repositioning, so drop dedup memory
+            marker, seen_hashes = args.marker, []
+        elif stored is None:
+            log(f"[{key}] No stored state, sticking with default marker")
+            marker, seen_hashes = "", []
+        elif stored["timeFrame"] is not None and stored["timeFrame"] != args.time_frame:
+            log(f"[{key}] Stored timeFrame '{stored['timeFrame']}' differs from requested '{args.time_frame}', resetting marker and dedup state")
+            marker, seen_hashes = "", []
         else:
-            marker = stored_marker
-            seen_hashes = stored_seen
-            log(f"Read marker from config_file: {marker} ({len(seen_hashes)} seen hashes)")
+            marker, seen_hashes = stored["marker"], stored["seenHashes"]
+            log(f"[{key}] Read marker from config_file: {marker} ({len(seen_hashes)} seen hashes)")
+        group_state = {
+            "accountIDs": account_group,
+            "timeFrame": args.time_frame,
+            "marker": marker,
+            "seenHashes": seen_hashes,
+            "lease": None,
+        }
+        if LEASE_SECONDS:
+            group_state["lease"] = new_lease()
+            stored_groups.pop(None, None)
+            stored_groups[key] = group_state
+            write_config(config_file, stored_groups)
+    return group_state
+
+
+def acquire_group_db(account_group):
+    """acquire_group() for the SQLite state store."""
+    key = group_key(account_group)
+    if LEASE_SECONDS and not state_db.lease(key, instance_id, LEASE_SECONDS):
+        log(f"[{key}] Leased by another instance, skipping")
+        return None
+    if not state_db.has_state(key) and os.path.isfile(config_file):
+        # first use of the database for this group: migrate the config file state
+        stored_groups = read_config(config_file)
+        stored = stored_groups.get(key)
+        if stored is None and len(account_groups) == 1:
+            stored = stored_groups.get(None)
+        if stored is not None:
+            state_db.reset(key, stored["timeFrame"] or args.time_frame, stored["marker"], stored["seenHashes"])
+            log(f"[{key}] Migrated marker and {len(stored['seenHashes'])} seen hashes from {config_file} to {args.state_db}")
+    if args.marker is not None:
+        # explicit marker override means manual repositioning, so drop dedup memory
+        state_db.reset(key, args.time_frame, args.marker)
+        marker = args.marker
     else:
-        log("Config file does not exist, sticking with default marker")
-else:
-    # explicit marker override means manual repositioning, so drop dedup memory
-    marker = args.marker
-    seen_hashes = []
-    log(f"Using marker value from -m parameter: {marker}")
+        marker = state_db.get_marker(key, args.time_frame)
+        if marker is None:
+            log(f"[{key}] No stored marker for timeFrame '{args.time_frame}', sticking with default marker")
+            marker = ""
+        else:
+            log(f"[{key}] Read marker from state database: {marker}")
+    return {
+        "accountIDs": account_group,
+        "timeFrame": args.time_frame,
+        "marker": marker,
+        "seenHashes": [],
+        "lease": None,
+    }
+
+
+def save_group(key, group_state, release=False):
+    """Write one account group's state into the config file, leaving the other
+    groups as they are on disk. With leases enabled the lease is renewed (or
+    released), and False is returned without writing if the lease has expired
+    and been taken over by another instance."""
+    with locked_config(config_file):
+        stored_groups = load_groups()
+        stored_groups.pop(None, None)
+        if LEASE_SECONDS:
+            stored = stored_groups.get(key)
+            if stored is not None and lease_held_by_other(stored.get("lease")):
+                return False
+            group_state["lease"] = None if release else new_lease()
+        stored_groups[key] = group_state
+        write_config(config_file, stored_groups)
+    return True
+
+
+def renew_lease(key, group_state, release=False):
+    if state_db is not None:
+        return state_db.lease(key, instance_id, LEASE_SECONDS, release=release)
+    return save_group(key, group_state, release=release)
+
+
+def save_page(key, group_state, new_hashes):
+    """Persist a processed page. Returns False if the group's lease was lost."""
+    if state_db is not None:
+        return state_db.save_page(
+            key, args.time_frame, group_state["marker"], new_hashes,
+            owner=instance_id, lease_seconds=LEASE_SECONDS)
+    return save_group(key, group_state)
+
+
+def already_delivered(key, sink, sent_marker, marker):
+    """True if a restarted run is re-sending a page this destination already has."""
+    return state_db is not None and state_db.was_delivered(key, args.time_frame, sink, sent_marker, marker)
+
+
+def mark_delivered(key, sink, sent_marker, marker):
+    if state_db is not None:
+        state_db.delivered(key, args.time_frame, sink, sent_marker, marker)
+
+
+def part_delivered(key, sink, sent_marker, marker):
+    """How many records of the page a destination received in parts in an
+    earlier, interrupted run."""
+    return 0 if state_db is None else state_db.delivered_count(key, args.time_frame, sink, sent_marker, marker)
+
+
+def mark_part_delivered(key, sink, sent_marker, marker, count):
+    if state_db is not None:
+        state_db.delivered_part(key, args.time_frame, sink, sent_marker, marker, count)
 
-seen_set = set(seen_hashes)
+
+# SQLite state store
+if args.state_db is not None:
+    log(f"Using SQLite state database: {args.state_db}")
+    state_db = SqliteState(args.state_db, "auditFeed")
+    state_db.expire_seen(SEEN_HASH_TTL)
+else:
+    state_db = None
 
 # process audit filters
 if args.filters is not None:
@@ -488,67 +1200,44 @@ if args.runtime_limit is None:
 else:
     RUNTIME_LIMIT = int(args.runtime_limit)
 
-# API call loop
-iteration = 1
-total_count = 0
-while True:
-    sent_marker = marker
-    variables = build_variables(marker, audit_filters)
-
-    logd(GRAPHQL_QUERY)
-    logd(json.dumps(variables))
-    success, resp = send(GRAPHQL_QUERY, variables)
-    if not success:
-        print(resp)
-        sys.exit(1)
-    logd(resp)
-
-    audit_feed = resp["data"]["auditFeed"]
-    marker = audit_feed.get("marker") or ""
-    fetched_count = int(audit_feed.get("fetchedCount", 0))
-    has_more = bool(audit_feed.get("hasMore"))
 
-    # Construct list of audit records, with added timestamps and reordering.
-    audit_list = []
-    for account in audit_feed.get("accounts", []) or []:
-        account_id = account.get("id")
-        for record in account.get("records", []) or []:
-            audit_list.append(normalize_audit_record(record, account_id))
-
-    # Deduplicate: the auditFeed marker boundary is inclusive, so the last
-    # record(s) of a drained window are re-returned on the next poll. Drop any
-    # record we have already emitted. Robust even if the API changes its
-    # boundary/marker behavior in the future.
-    new_records = []
-    duplicate_count = 0
-    for audit_record in audit_list:
-        h = record_identity(audit_record)
-        if h in seen_set:
-            duplicate_count += 1
-            continue
-        seen_set.add(h)
-        seen_hashes.append(h)
-        new_records.append(audit_record)
-
-    # bound the persisted dedup set to the most recent entries
-    if len(seen_hashes) > MAX_SEEN_HASHES:
-        drop = len(seen_hashes) - MAX_SEEN_HASHES
-        for old in seen_hashes[:drop]:
-            seen_set.discard(old)
-        seen_hashes = seen_hashes[drop:]
-
-    audit_list = new_records
-    total_count += len(audit_list)
-    line = f"iteration:{iteration} fetched:{fetched_count} new:{len(audit_list)} dup:{duplicate_count} total_count:{total_count} marker:{marker} hasMore:{has_more}"
-
-    if len(audit_list) > 0:
-        line += " " + audit_list[0].get("audit_timestamp", "")
-        line += " " + audit_list[-1].get("audit_timestamp", "")
-    log(line)
-
-    # print output
-    if args.print_events:
-        for audit_record in audit_list:
+# Sentinel body size at which a streamed page (--stream) is posted in parts,
+# so the pending body stays small. Without --stream each page is one post.
+SENTINEL_BATCH_BYTES = 1024 * 1024
+
+# Records looked up in the seen identities of the state database at a time
+# with --stream. Without --stream the whole page is looked up at once.
+SEEN_BLOCK_RECORDS = 500
+
+
+class PageOutput:
+    """Sends the new records of one page to the configured outputs as they
+    are produced: printed straight away, written to a TCP connection opened
+    for the page, and serialized into the Sentinel body. Destinations that
+    already received the page in an earlier, interrupted run (see
+    already_delivered) are skipped. With -d, each part of a page posted to
+    Sentinel is recorded, and the records a restarted run already posted
+    are skipped."""
+
+    def __init__(self, key, sent_marker, feed_fields):
+        self.key = key
+        self.sent_marker = sent_marker
+        self.feed_fields = feed_fields
+        self.sock = None
+        self.skip_tcp = None
+        self.skip_sentinel = None
+        self.part_marker = None
+        self.sentinel_skip = 0
+        self.sentinel_delivered = 0
+        self.sentinel_body = bytearray()
+        self.sentinel_count = 0
+
+    def marker(self):
+        return self.feed_fields.get("marker") or ""
+
+    def emit(self, audit_record):
+        # print output
+        if args.print_events:
             if args.prettify:
                 print(json.dumps(audit_record, indent=2, ensure_ascii=False))
             else:
@@ -557,59 +1246,227 @@ while True:
                 except Exception:
                     print(json.dumps(audit_record))
 
-    # network stream
-    if args.stream_events is not None:
-        logd(f"Sending audit records to {network_elements[0]}:{network_elements[1]}")
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            # bound connect/send so a hung receiver cannot block the run forever
-            s.settimeout(30)
-            s.connect((network_elements[0], int(network_elements[1])))
-            for audit_record in audit_list:
-                s.sendall(json.dumps(audit_record, ensure_ascii=False).encode("utf-8"))
-
-    # send to Microsoft Sentinel
-    if args.sentinel is not None:
-        logd(f"Sending audit records to Azure workspace ID {sentinel_elements[0]}")
+        # network stream
+        if args.stream_events is not None:
+            if self.skip_tcp is None:
+                self.skip_tcp = already_delivered(self.key, "tcp", self.sent_marker, self.marker())
+                if self.skip_tcp:
+                    log(f"[{self.key}] Page already delivered to {args.stream_events}, not sending it again")
+            if not self.skip_tcp:
+                if self.sock is None:
+                    logd(f"Sending audit records to {network_elements[0]}:{network_elements[1]}")
+                    self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    # bound connect/send so a hung receiver cannot block the run forever
+                    self.sock.settimeout(30)
+                    self.sock.connect((network_elements[0], int(network_elements[1])))
+                self.sock.sendall(json.dumps(audit_record, ensure_ascii=False).encode("utf-8"))
+
+        # send to Microsoft Sentinel
+        if args.sentinel is not None:
+            if self.skip_sentinel is None:
+                self.skip_sentinel = already_delivered(self.key, "sentinel", self.sent_marker, self.marker())
+                if self.skip_sentinel:
+                    log(f"[{self.key}] Page already delivered to Azure workspace ID {sentinel_elements[0]}, not sending it again")
+                else:
+                    # parts are recorded against the marker known at the first record, as
+                    # with --stream the envelope fields may only arrive after the records
+                    self.part_marker = self.marker()
+                    self.sentinel_skip = part_delivered(self.key, "sentinel", self.sent_marker, self.part_marker)
+                    if self.sentinel_skip:
+                        log(f"[{self.key}] First {self.sentinel_skip} records of the page already delivered to "
+                            f"Azure workspace ID {sentinel_elements[0]}, not sending them again")
+            if self.sentinel_skip:
+                self.sentinel_skip -= 1
+                self.sentinel_delivered += 1
+            elif not self.skip_sentinel:
+                self.sentinel_body += b"," if self.sentinel_count else b"["
+                self.sentinel_body += json.dumps(audit_record, ensure_ascii=False).encode("utf-8")
+                self.sentinel_count += 1
+                if args.stream and len(self.sentinel_body) >= SENTINEL_BATCH_BYTES:
+                    self.post_sentinel()
+                    mark_part_delivered(self.key, "sentinel", self.sent_marker, self.part_marker, self.sentinel_delivered)
+
+    def post_sentinel(self):
+        logd(f"Sending {self.sentinel_count} audit records to Azure workspace ID {sentinel_elements[0]}")
         response_status = post_data(
             sentinel_elements[0],
             sentinel_elements[1],
-            json.dumps(audit_list, ensure_ascii=False).encode('utf-8')
+            bytes(self.sentinel_body + b"]")
         )
         if response_status < 200 or response_status > 299:
             print(f"Send to Azure returned {response_status}, exiting")
             sys.exit(1)
         logd(f"Send to Azure response code:{response_status}")
+        self.sentinel_delivered += self.sentinel_count
+        self.sentinel_body = bytearray()
+        self.sentinel_count = 0
+
+    def close(self):
+        """Finish the page once every record has been emitted."""
+        marker = self.marker()
+        if self.sock is not None:
+            self.sock.close()
+        if args.stream_events is not None and not self.skip_tcp:
+            mark_delivered(self.key, "tcp", self.sent_marker, marker)
+        if args.sentinel is not None and not self.skip_sentinel:
+            if self.sentinel_count:
+                self.post_sentinel()
+            mark_delivered(self.key, "sentinel", self.sent_marker, marker)
+
+
+def page_records(feed_fields):
+    """(account_id, record) for every record of a fully parsed page."""
+    for account in feed_fields.get("accounts", []) or []:
+        account_id = account.get("id")
+        for record in account.get("records", []) or []:
+            yield account_id, record
 
-    # write marker back out after the current batch is processed successfully.
-    # Persist the timeFrame alongside the marker so a future run against a
-    # different time window resets the marker (the marker is timeFrame-scoped).
-    logd("Writing marker to " + config_file)
-    with open(config_file, "w") as File:
-        json.dump({
-            "accountID": args.ID,
-            "timeFrame": args.time_frame,
-            "marker": marker,
-            "seenHashes": seen_hashes,
-        }, File)
 
-    # increment counter and check if we hit any limits for stopping
-    iteration += 1
-    if not has_more:
-        log("No more audit records available, stopping")
-        break
-    # guard against a stuck feed: if the marker did not advance but the API
-    # still reports hasMore, paginating again would just refetch the same
-    # records (all deduplicated to nothing) forever, so stop here
-    if marker == sent_marker:
-        log(f"Marker did not advance ({marker!r}) while hasMore is true, stopping to avoid an infinite loop")
-        break
-    if fetched_count < FETCH_THRESHOLD:
-        log(f"Fetched count {fetched_count} less than threshold {FETCH_THRESHOLD}, stopping")
-        break
-    elapsed = datetime.datetime.now() - start
-    if elapsed.total_seconds() > RUNTIME_LIMIT:
-        log(f"Elapsed time {elapsed.total_seconds()} exceeds runtime limit {RUNTIME_LIMIT}, stopping")
+def record_blocks(records, size=None):
+    """Lists of (account_id, record) of at most `size` records, or one list
+    of every record when size is None."""
+    if size is None:
+        yield list(records)
+        return
+    records = iter(records)
+    while True:
+        block = list(itertools.islice(records, size))
+        if not block:
+            return
+        yield block
+
+
+# API call loop for one account group. Returns False if the runtime limit was
+# reached, so that the remaining groups are not started.
+def poll_group(key, group_state):
+    global total_count
+    marker = group_state["marker"]
+    seen_hashes = group_state["seenHashes"]
+    seen_set = set(seen_hashes)
+    iteration = 1
+    runtime_left = True
+    while True:
+        sent_marker = marker
+        variables = build_variables(group_state["accountIDs"], marker, audit_filters)
+
+        logd(GRAPHQL_QUERY)
+        logd(json.dumps(variables))
+        success, resp = send(GRAPHQL_QUERY, variables, stream=args.stream)
+        if not success:
+            print(resp)
+            sys.exit(1)
+        if args.stream:
+            # records are parsed one at a time as they are read from the body
+            feed_fields = resp.fields
+            records = resp
+        else:
+            logd(resp)
+            feed_fields = resp["data"]["auditFeed"]
+            records = page_records(feed_fields)
+
+        # make sure the lease is still ours before emitting anything
+        if LEASE_SECONDS and not renew_lease(key, group_state):
+            log(f"[{key}] Lease lost to another instance, stopping")
+            return True
+
+        # Normalize each audit record, adding timestamps and reordering, and
+        # deduplicate it: the auditFeed marker boundary is inclusive, so the last
+        # record(s) of a drained window are re-returned on the next poll. Drop any
+        # record we have already emitted. Robust even if the API changes its
+        # boundary/marker behavior in the future.
+        if state_db is not None:
+            seen_set = set()
+        output = PageOutput(key, sent_marker, feed_fields)
+        new_hashes = []
+        duplicate_count = 0
+        first_timestamp = last_timestamp = None
+        # the seen identities in the database are looked up a block at a time:
+        # the whole page, or SEEN_BLOCK_RECORDS records as they stream in
+        for block in record_blocks(records, SEEN_BLOCK_RECORDS if args.stream else None):
+            audit_records = [normalize_audit_record(record, account_id) for account_id, record in block]
+            identities = [record_identity(audit_record) for audit_record in audit_records]
+            if state_db is not None:
+                seen_set.update(state_db.seen(key, args.time_frame, identities))
+            for audit_record, h in zip(audit_records, identities):
+                if h in seen_set:
+                    duplicate_count += 1
+                    continue
+                seen_set.add(h)
+                new_hashes.append(h)
+                if first_timestamp is None:
+                    first_timestamp = audit_record.get("audit_timestamp", "")
+                last_timestamp = audit_record.get("audit_timestamp", "")
+                output.emit(audit_record)
+        if args.stream and "errors" in resp.envelope:
+            # errors reported after the data: the records already emitted will be
+            # fetched again by the next run, as the marker is not advanced
+            print(resp.envelope)
+            sys.exit(1)
+        output.close()
+
+        marker = feed_fields.get("marker") or ""
+        fetched_count = int(feed_fields.get("fetchedCount", 0))
+        has_more = bool(feed_fields.get("hasMore"))
+
+        if state_db is None:
+            seen_hashes.extend(new_hashes)
+        # bound the persisted dedup set to the most recent entries
+        if len(seen_hashes) > MAX_SEEN_HASHES:
+            drop = len(seen_hashes) - MAX_SEEN_HASHES
+            for old in seen_hashes[:drop]:
+                seen_set.discard(old)
+            seen_hashes = seen_hashes[drop:]
+
+        total_count += len(new_hashes)
+        line = f"[{key}] iteration:{iteration} fetched:{fetched_count} new:{len(new_hashes)} dup:{duplicate_count} total_count:{total_count} marker:{marker} hasMore:{has_more}"
+
+        if first_timestamp is not None:
+            line += " " + first_timestamp
+            line += " " + last_timestamp
+        log(line)
+
+        # write marker back out after the current batch is processed successfully.
+        # Persist the timeFrame alongside the marker so a future run against a
+        # different time window resets the marker (the marker is timeFrame-scoped).
+        group_state["marker"] = marker
+        group_state["seenHashes"] = seen_hashes
+        logd("Writing marker to " + (args.state_db or config_file))
+        if not save_page(key, group_state, new_hashes):
+            log(f"[{key}] Lease lost to another instance, stopping")
+            return True
+
+        # increment counter and check if we hit any limits for stopping
+        iteration += 1
+        if not has_more:
+            log(f"[{key}] No more audit records available, stopping")
+            break
+        # guard against a stuck feed: if the marker did not advance but the API
+        # still reports hasMore, paginating again would just refetch the same
+        # records (all deduplicated to nothing) forever, so stop here
+        if marker == sent_marker:
+            log(f"[{key}] Marker did not advance ({marker!r}) while hasMore is true, stopping to avoid an infinite loop")
+            break
+        if fetched_count < FETCH_THRESHOLD:
+            log(f"[{key}] Fetched count {fetched_count} less than threshold {FETCH_THRESHOLD}, stopping")
+            break
+        elapsed = datetime.datetime.now() - start
+        if elapsed.total_seconds() > RUNTIME_LIMIT:
+            log(f"Elapsed time {elapsed.total_seconds()} exceeds runtime limit {RUNTIME_LIMIT}, stopping")
+            runtime_left = False
+            break
+    # hand the group back so another instance can take it over straight away
+    if LEASE_SECONDS:
+        renew_lease(key, group_state, release=True)
+    return runtime_left
+
+
+total_count = 0
+for group in account_groups:
+    group_state = acquire_group(group)
+    if group_state is None:
+        continue
+    if not poll_group(group_key(group), group_state):
         break
 
 end = datetime.datetime.now()
-log(f"OK {total_count} audit records from {api_call_count} API calls with {total_bytes_uncompressed} bytes uncompressed, {total_bytes_compressed} bytes compressed in {end-start}")
+log(f"OK {total_count} audit records for {len(account_ids)} accounts from {api_call_count} API calls ({api_call_count / len(account_ids):.2f} per account) with {total_bytes_uncompressed} bytes uncompressed, {total_bytes_compressed} bytes compressed in {end-start}")
@@ -26,7 +26,7 @@ class Canister:
 	version = "1.0"
 
 
-	def __init__(self, ip, port):
+	def __init__(self, ip, port, workers=8, timeout=10, global_timeout=None):
 		#
 		# Initialise the Canister client object.
 		#
@@ -35,8 +35,17 @@ class Canister:
 		#
 		# ip 	The IP address of the target for reflected tests
 		# port 	The port of the reflected target
+		# workers	The number of tests executed at the same time
+		# timeout	Seconds each test waits for its target
+		# global_timeout	Seconds the whole set may run for, or None
 		#
-		self.canister_set = canisterset.CanisterSet(target=ip, port=port)
+		self.canister_set = canisterset.CanisterSet(
+			target=ip,
+			port=port,
+			workers=workers,
+			timeout=timeout,
+			global_timeout=global_timeout,
+		)
 
 
 	def load_object(self, cset):
@@ -78,6 +87,15 @@ class Canister:
 		return self.canister_set.results()
 
 
+	def run_load(self, rate=None, concurrency=None, duration=10):
+		#
+		# Replays the loaded set at a request rate or concurrency for a
+		# duration in seconds, and returns the load results. See
+		# CanisterSet.run_load().
+		#
+		return self.canister_set.run_load(rate=rate, concurrency=concurrency, duration=duration)
+
+
 
 #
 # The main() function allows us to call this module from the command line
@@ -89,21 +107,61 @@ def main():
 	#
 	# Example command line would be:
 	# 
-	# python3 -m canister <server_ip> <server_port>
+	# python3 -m canister <server_ip> <server_port> [workers] [timeout] [options]
 	#
 	# server_ip: the IP or host of the catcher.
 	# server_port: the port the catcher is listening on for web attacks.
+	# workers: optional, the number of tests executed at the same time.
+	# timeout: optional, seconds each test waits for its target.
+	#
+	# Options:
+	#
+	# --local: only run the tests against the catcher, which need no
+	#          Internet access.
+	# --global-timeout S: seconds the whole set may run for, tests not
+	#          finished by then are left unexecuted.
+	# --rate N: load mode, replay the set at N requests per second.
+	# --concurrency N: load mode, replay the set with N requests in flight.
+	# --duration S: seconds of load, 10 by default.
 	#
 
 	#
-	# Process the CLI
+	# Process the CLI, options first
 	#
-	if len(sys.argv) < 3:
+	options = {"local": False, "rate": None, "concurrency": None, "duration": 10, "global_timeout": None}
+	args = []
+	argv = sys.argv[1:]
+	while len(argv) > 0:
+		arg = argv.pop(0)
+		if arg == "--local":
+			options["local"] = True
+		elif arg in ["--rate", "--concurrency", "--duration", "--global-timeout"]:
+			if len(argv) == 0:
+				print(f'Error: {arg} needs a value.')
+				sys.exit(1)
+			value = argv.pop(0)
+			option = arg[2:].replace("-", "_")
+			try:
+				options[option] = int(value) if arg == "--concurrency" else float(value)
+			except ValueError:
+				options[option] = None
+			if options[option] is None or options[option] <= 0:
+				kind = "a positive integer" if arg == "--concurrency" else "a positive number"
+				print(f'Error: {arg} should be {kind}, not {value}.')
+				sys.exit(1)
+		else:
+			args.append(arg)
+	if options["rate"] is not None and options["concurrency"] is not None:
+		print("Error: --rate and --concurrency cannot be used together.")
+		sys.exit(1)
+	if len(args) < 2:
 		print("Error: not enough arguments. Both the server IP and port must be specified.")
 		print("For example: python3 -m canister 192.168.1.1 8443")
 		sys.exit(1)
-	ip = sys.argv[1]
-	port = int(sys.argv[2])
+	ip = args[0]
+	port = int(args[1])
+	workers = int(args[2]) if len(args) > 2 else 8
+	timeout = float(args[3]) if len(args) > 3 else 10
 
 	#
 	# Initialise the logger
@@ -117,17 +175,32 @@ def main():
 	#
 	# Create the object
 	#
-	C = Canister(ip, port)
+	C = Canister(ip, port, workers=workers, timeout=timeout, global_timeout=options["global_timeout"])
 
 	#
 	# Print the welcome
 	#
-	print(f'Canister v{C.version} loading default test set')
+	if options["local"]:
+		print(f'Canister v{C.version} loading local test set')
+		C.load_object(canisterset.LOCAL)
+	else:
+		print(f'Canister v{C.version} loading default test set')
+		C.load_object(canisterset.DEFAULT)
 
 	#
-	# Load the default set
+	# Load mode
 	#
-	C.load_object(canisterset.DEFAULT)
+	if options["rate"] is not None or options["concurrency"] is not None:
+		if options["rate"] is not None:
+			print(f'Loaded {len(C.canister_set)} tests, replaying at {options["rate"]:g} requests/s for {options["duration"]:g}s:')
+		else:
+			print(f'Loaded {len(C.canister_set)} tests, replaying with {options["concurrency"]} in flight for {options["duration"]:g}s:')
+		print_load_results(C.run_load(
+			rate=options["rate"],
+			concurrency=options["concurrency"],
+			duration=options["duration"],
+		))
+		return
 	print(f'Loaded {len(C.canister_set)} tests, executing:')
 
 	#
@@ -136,16 +209,24 @@ def main():
 	C.execute()
 
 	#
-	# Print the results
+	# Print the results, with the median of each phase in milliseconds
 	#
+	results = C.results()
 	print("\nResults:\n-------")
-	for T in C.canister_set:
+	print(f'{"Test":<40} {"Result":<6} {"DNS":>7} {"Connect":>8} {"TLS":>7} {"TTFB":>7} {"Total":>8} {"Bytes":>9}')
+	for T, timings in zip(C.canister_set, results["timings"]):
 		if T.success:
 			result = "Pass"
 		else:
 			result = "Fail"
-		print(f'{T.name:<40} {result}')
-	results = C.results()
+		medians = {}
+		for field, stats in timings.items():
+			if type(stats) == dict:
+				medians[field] = f'{stats["median"]:.1f}' if field != "bytes" else f'{stats["median"]:.0f}'
+			else:
+				medians[field] = "-"
+		print(f'{T.name:<40} {result:<6} {medians["dns_ms"]:>7} {medians["connect_ms"]:>8} {medians["tls_ms"]:>7}\
+ {medians["ttfb_ms"]:>7} {medians["total_ms"]:>8} {medians["bytes"]:>9}')
 	print("")
 	print(f'Total:{results["total"]}\
  Succeeded:{results["succeeded"]} ({results["succeeded"]*100/results["total"]:.1f}%)\
@@ -153,5 +234,25 @@ def main():
 
 
 
+
+def print_load_results(results):
+	#
+	# Print the results of a load run.
+	#
+	print("\nLoad results:\n------------")
+	print(f'Requests:{results["requests"]} in {results["duration_s"]:.1f}s, {results["achieved_rps"]:.1f}/s')
+	print(f'Succeeded:{results["succeeded"]} Failed:{results["failed"]} No response:{results["no_response"]} Not sent:{results["not_sent"]}')
+	codes = ", ".join(f'{code}:{count}' for code, count in sorted(results["codes"].items(), key=lambda item: str(item[0])))
+	print(f'Response codes: {codes}')
+	for name in ["latency_ms", "response_time_ms"]:
+		summary = results[name]
+		if summary is not None:
+			print(f'{name}: ' + " ".join(f'{key}={value:.1f}' for key, value in summary.items()))
+	print("\nLatency histogram:")
+	for bound, count in results["histogram"]:
+		label = f'<= {bound} ms' if bound is not None else f'> {canisterset.latency_buckets[-1]} ms'
+		print(f'{label:>12} {count:>8}')
+
+
 if __name__ == "__main__":
 	main()
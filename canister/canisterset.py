@@ -5,8 +5,15 @@
 #
 
 
+import concurrent.futures
+import statistics
+import threading
+import time
+from array import array
+
 from logger import Logger
 from canistertest import CanisterTest
+from net_http import timing_fields
 
 
 
@@ -17,7 +24,7 @@ class CanisterSet:
 
 
 
-	def __init__(self, target="127.0.0.1", port=8443):
+	def __init__(self, target="127.0.0.1", port=8443, workers=8, timeout=10, global_timeout=None):
 		#
 		# Parameters:
 		# ----------
@@ -27,9 +34,24 @@ class CanisterSet:
 		#
 		# port: the port the target is listening on.
 		#
+		# workers: the number of tests executed at the same time. 1 runs
+		#          the tests one after another.
+		#
+		# timeout: seconds each test waits for its target, unless the
+		#          test defines its own "timeout". None waits for the OS
+		#          TCP timeout.
+		#
+		# global_timeout: seconds the whole set may run for, or None for
+		#          no limit. Tests not finished by then are unexecuted.
+		#
+		if workers < 1:
+			raise ValueError(f'workers should be at least 1, not {workers}')
 		self.tests = []
 		self.target = target
 		self.port = port
+		self.workers = workers
+		self.timeout = timeout
+		self.global_timeout = global_timeout
 
 	def __len__(self):
 		return len(self.tests)
@@ -109,25 +131,67 @@ class CanisterSet:
 
 	def execute(self):
 		#
-		# Execute the loaded set by iterating over each test,
-		# calling the test's execute() method.
+		# Execute the loaded set, calling each test's execute() method
+		# on a pool of self.workers threads, so the set takes about as
+		# long as its slowest tests rather than the sum of all of them.
+		# The tests keep their load order, whatever order they finish in.
+		#
+		Logger.log(1, f'CanisterSet:execute() workers={self.workers}')
+		if self.global_timeout is None:
+			deadline = None
+		else:
+			deadline = time.monotonic() + self.global_timeout
+
+		pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+		futures = {
+			pool.submit(ct.execute, timeout=self.timeout, deadline=deadline): ct
+			for ct in self.tests
+		}
+		done, pending = concurrent.futures.wait(futures, timeout=self.global_timeout)
+
+		#
+		# Tests still queued at the global timeout never start. Tests
+		# still running finish their request within the deadline and
+		# then leave themselves unexecuted.
 		#
-		Logger.log(1, f'CanisterSet:execute()')
+		for future in pending:
+			if future.cancel():
+				ct = futures[future]
+				ct.executed = False
+				ct.success = None
+				ct.reasons = ["Global timeout reached before the test started"]
+		pool.shutdown(wait=False)
+		if pending:
+			Logger.log(1, f'CanisterSet:execute() global timeout, {len(pending)} tests unfinished')
+
+		#
+		# A test which raised is reported against the test, in load order.
+		#
+		for future, ct in futures.items():
+			if future in done and future.exception() is not None:
+				Logger.log(0, f'Test:{ct.name} raised {future.exception()}')
 		for ct in self.tests:
-			ct.execute()
+			Logger.log(2, f'Test:{ct.name} executed={ct.executed} success={ct.success}')
 
 
 
 	def results(self):
 		#
-		# Return a dictionary of total, succeeded, failed, unexecuted counts.
+		# Return a dictionary of total, succeeded, failed, unexecuted counts,
+		# and the timings of each test.
 		#
 		# Call this after execute() to receive a summary of results.
 		#
+		# "timings" lists the tests in load order, each as a dictionary of
+		# its name, its number of runs and the min/median/p95 of each
+		# phase over its runs (see canistertest.timing_stats()), with None
+		# for the phases of an unexecuted test.
+		#
 		succeeded = 0
 		failed = 0
 		unexecuted = 0
 		total = 0
+		timings = []
 		for ct in self.tests:
 			total += 1
 			if not ct.executed:
@@ -136,13 +200,251 @@ class CanisterSet:
 				succeeded += 1
 			else:
 				failed += 1
+			test_timings = {
+				"name": ct.name,
+				"runs": len(ct.timings) if ct.executed else 0,
+			}
+			for field in timing_fields:
+				test_timings[field] = ct.timing_stats[field] if ct.executed else None
+			timings.append(test_timings)
 		return {
 			"total":total, 
 			"succeeded":succeeded, 
 			"failed":failed, 
-			"unexecuted":unexecuted
+			"unexecuted":unexecuted,
+			"timings":timings,
+		}
+
+
+
+	def run_load(self, rate=None, concurrency=None, duration=10, workers=64):
+		#
+		# Load mode: replay the loaded tests, in load order and round
+		# robin, for a duration, to generate sustained volume rather than
+		# one result per test. Test state is not changed.
+		#
+		# Parameters:
+		# ----------
+		#
+		# rate: requests per second to offer. Requests are started on a
+		#       fixed schedule whatever the responses take (open loop),
+		#       so slow responses do not reduce the offered load. Each
+		#       latency is measured from the request's scheduled start,
+		#       so time queued behind busy workers counts.
+		#
+		# concurrency: instead of a rate, the number of requests kept
+		#       in flight, each worker starting its next request as its
+		#       last one completes (closed loop).
+		#
+		# duration: seconds to start requests for. Requests in flight at
+		#       the end are completed, within the set's timeout, and
+		#       requests still waiting for a worker are not sent.
+		#
+		# workers: threads making the requests in rate mode. Requests
+		#       due while all workers are busy wait for one.
+		#
+		# Returns:
+		# -------
+		#
+		# A dictionary of the load run, see load_results().
+		#
+		if (rate is None) == (concurrency is None):
+			raise ValueError("run_load needs either a rate or a concurrency")
+		if rate is not None and (type(rate) not in [int, float] or rate <= 0):
+			raise ValueError(f'run_load rate should be a positive number, not {rate}')
+		if concurrency is not None and (type(concurrency) != int or concurrency < 1):
+			raise ValueError(f'run_load concurrency should be a positive integer, not {concurrency}')
+		if type(duration) not in [int, float] or duration <= 0:
+			raise ValueError(f'run_load duration should be a positive number of seconds, not {duration}')
+		if len(self.tests) == 0:
+			raise ValueError("run_load needs a loaded set")
+		Logger.log(1, f'CanisterSet:run_load() rate={rate} concurrency={concurrency} duration={duration}')
+
+		#
+		# Outcomes are appended under a lock, latencies to flat arrays.
+		#
+		state = {
+			"lock": threading.Lock(),
+			"latencies": array("d"),
+			"response_times": array("d"),
+			"succeeded": 0,
+			"failed": 0,
+			"no_response": 0,
+			"not_sent": 0,
+			"codes": {},
+			"tests": {ct.name: {"requests":0, "failed":0} for ct in self.tests},
 		}
 
+		def load_request(ct, scheduled):
+			success, reasons, timings, response_code = ct.run(ct.optional_parameters.get("timeout", self.timeout))
+			latency_ms = (time.monotonic() - scheduled) * 1000
+			with state["lock"]:
+				state["latencies"].append(latency_ms)
+				state["response_times"].append(timings["total_ms"])
+				state["codes"][response_code] = state["codes"].get(response_code, 0) + 1
+				state["tests"][ct.name]["requests"] += 1
+				if response_code is None:
+					state["no_response"] += 1
+				if success:
+					state["succeeded"] += 1
+				else:
+					state["failed"] += 1
+					state["tests"][ct.name]["failed"] += 1
+
+		def queued_request(ct, scheduled):
+			#
+			# Requests still queued behind busy workers at the end are
+			# dropped, so a slow target does not stretch the run.
+			#
+			if time.monotonic() >= end:
+				with state["lock"]:
+					state["not_sent"] += 1
+				return
+			load_request(ct, scheduled)
+
+		started = time.monotonic()
+		end = started + duration
+		if rate is not None:
+
+			#
+			# Open loop: the n-th request is due at started + n / rate.
+			# A scheduler running late submits the requests it owes at
+			# once, so the offered rate holds over the run.
+			#
+			pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+			n = 0
+			while True:
+				scheduled = started + n / rate
+				if scheduled >= end:
+					break
+				delay = scheduled - time.monotonic()
+				if delay > 0:
+					time.sleep(delay)
+				pool.submit(queued_request, self.tests[n % len(self.tests)], scheduled)
+				n += 1
+			pool.shutdown(wait=True)
+
+		else:
+
+			#
+			# Closed loop: each worker starts its next request when its
+			# last one completes.
+			#
+			counter = {"n": 0}
+
+			def worker():
+				while time.monotonic() < end:
+					with state["lock"]:
+						n = counter["n"]
+						counter["n"] += 1
+					load_request(self.tests[n % len(self.tests)], time.monotonic())
+
+			threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+
+		elapsed = time.monotonic() - started
+		results = load_results(state, elapsed, rate, concurrency)
+		Logger.log(1, f'CanisterSet:run_load() {results["requests"]} requests at {results["achieved_rps"]:.1f}/s')
+		return results
+
+
+
+#
+# Upper bounds, in milliseconds, of the buckets of the latency histograms
+# of load runs. The last bucket has no upper bound.
+#
+latency_buckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+
+
+def latency_summary(values):
+	#
+	# Summarise a list of latencies in milliseconds.
+	#
+	# Returns:
+	# -------
+	#
+	# Dictionary of min, median, p95, p99 and max (nearest-rank
+	# percentiles), or None if there are no values.
+	#
+	if len(values) == 0:
+		return None
+	values = sorted(values)
+	summary = {"min": values[0], "median": statistics.median(values)}
+	for p in [95, 99]:
+		summary[f'p{p}'] = values[max(0, -(-p * len(values) // 100) - 1)]
+	summary["max"] = values[-1]
+	return summary
+
+
+
+def latency_histogram(values):
+	#
+	# Count latencies into latency_buckets.
+	#
+	# Returns:
+	# -------
+	#
+	# A list of (upper bound in ms, count), the last bound being None.
+	#
+	counts = [0] * (len(latency_buckets) + 1)
+	for value in values:
+		for i, bound in enumerate(latency_buckets):
+			if value <= bound:
+				counts[i] += 1
+				break
+		else:
+			counts[-1] += 1
+	return list(zip(latency_buckets + [None], counts))
+
+
+
+def load_results(state, elapsed, rate, concurrency):
+	#
+	# Build the results of a load run.
+	#
+	# Returns:
+	# -------
+	#
+	# Dictionary of:
+	#
+	# duration_s: seconds from the first request to the last response.
+	# offered_rps: the requested rate, or None in concurrency mode.
+	# concurrency: the requested concurrency, or None in rate mode.
+	# requests: requests completed.
+	# achieved_rps: requests completed per second over the run.
+	# succeeded, failed: requests meeting, or not, their test's criteria.
+	# no_response: failed requests without any response.
+	# not_sent: requests due in rate mode which were still waiting for a
+	#           worker at the end of the run, and were not made.
+	# codes: requests per response code, None for no response.
+	# latency_ms: latency_summary() from the scheduled start of each
+	#             request (rate mode) or its actual start (concurrency mode).
+	# response_time_ms: latency_summary() of the request time itself.
+	# histogram: latency_histogram() of latency_ms.
+	# tests: requests and failed requests per test name.
+	#
+	requests = len(state["latencies"])
+	return {
+		"duration_s": elapsed,
+		"offered_rps": rate,
+		"concurrency": concurrency,
+		"requests": requests,
+		"achieved_rps": requests / elapsed if elapsed > 0 else 0.0,
+		"succeeded": state["succeeded"],
+		"failed": state["failed"],
+		"no_response": state["no_response"],
+		"not_sent": state["not_sent"],
+		"codes": state["codes"],
+		"latency_ms": latency_summary(state["latencies"]),
+		"response_time_ms": latency_summary(state["response_times"]),
+		"histogram": latency_histogram(state["latencies"]),
+		"tests": state["tests"],
+	}
+
 
 
 #
@@ -376,3 +678,10 @@ DEFAULT = [
 	    "success_criteria": [{"field":"response_code","op":"is","value":200}],
 	},
 ]
+
+
+#
+# The tests of the default set against the target (catcher) alone, for
+# runs without Internet access such as load runs.
+#
+LOCAL = [test for test in DEFAULT if test["host"] is None]
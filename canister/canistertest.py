@@ -6,8 +6,12 @@
 #
 
 
+import concurrent.futures
+import statistics
+import time
+
 from logger import Logger
-from net_http import request
+from net_http import timed_request, timed_transfer, timing_fields
 
 
 #
@@ -67,12 +71,60 @@ supported_protocols = ["http", "https"]
 supported_methods = ["GET", "POST"]
 
 
+#
+# Define the supported test types. A "web" test makes a request and
+# checks the response. A "throughput" test downloads or uploads bulk
+# content, optionally over parallel streams, to measure bandwidth.
+#
+supported_ttypes = ["web", "throughput"]
+supported_directions = ["download", "upload"]
+
+
 #
 # Define supported success criteria fields
 #
 supported_sc_items = ["field","op","value"]
-supported_sc_fields = ["response_code"]
-supported_sc_ops = ["is"]
+supported_sc_fields = [
+	#
+	# The HTTP status code, None if there was no response.
+	#
+	"response_code",
+	#
+	# The total time of the request, see net_http.timed_request().
+	#
+	"response_time_ms",
+	#
+	# The time to the first byte of the response.
+	#
+	"ttfb_ms",
+	#
+	# The body bytes received and sent over the total time of the
+	# request, so that uploads are measured too.
+	#
+	"throughput_mbps",
+	#
+	# The response body bytes.
+	#
+	"bytes_received",
+	#
+	# The request body bytes sent by a throughput upload.
+	#
+	"bytes_sent",
+]
+supported_sc_ops = ["is", "lt", "le", "gt", "ge", "between"]
+
+
+#
+# The numeric comparison of each op, "between" being inclusive of both
+# bounds, which are given as a [low, high] list.
+#
+numeric_sc_ops = {
+	"lt": lambda result, value: result < value,
+	"le": lambda result, value: result <= value,
+	"gt": lambda result, value: result > value,
+	"ge": lambda result, value: result >= value,
+	"between": lambda result, value: value[0] <= result <= value[1],
+}
 
 
 class CanisterTest:
@@ -119,6 +171,66 @@ class CanisterTest:
 			Logger.log(1, error)
 			raise ValueError(error)
 
+		#
+		# Check the test type, and the parameters of throughput tests:
+		# the "direction", the "size" in bytes, uploaded or the most
+		# downloaded, and the number of parallel "streams".
+		#
+		ttype = params.get("ttype", "web")
+		if ttype not in supported_ttypes:
+			error = f'Test:{params["name"]} unsupported ttype: {ttype}'
+			Logger.log(1, error)
+			raise ValueError(error)
+		if ttype == "throughput":
+			direction = params.get("direction", "download")
+			if direction not in supported_directions:
+				error = f'Test:{params["name"]} unsupported direction: {direction}'
+				Logger.log(1, error)
+				raise ValueError(error)
+			size = params.get("size")
+			if size is not None and (type(size) != int or size < 1):
+				error = f'Test:{params["name"]} size should be a positive number of bytes, not {size}'
+				Logger.log(1, error)
+				raise ValueError(error)
+			if direction == "upload" and (size is None or params["method"] != "POST"):
+				error = f'Test:{params["name"]} an upload needs the POST method and a size'
+				Logger.log(1, error)
+				raise ValueError(error)
+			streams = params.get("streams", 1)
+			if type(streams) != int or streams < 1:
+				error = f'Test:{params["name"]} streams should be a positive integer, not {streams}'
+				Logger.log(1, error)
+				raise ValueError(error)
+
+		#
+		# Check the optional per-test timeout
+		#
+		timeout = params.get("timeout")
+		if timeout is not None:
+			if type(timeout) not in [int, float] or timeout <= 0:
+				error = f'Test:{params["name"]} timeout should be a positive number of seconds, not {timeout}'
+				Logger.log(1, error)
+				raise ValueError(error)
+
+		#
+		# Check the optional repeat count
+		#
+		repeat = params.get("repeat", 1)
+		if type(repeat) != int or repeat < 1:
+			error = f'Test:{params["name"]} repeat should be a positive integer, not {repeat}'
+			Logger.log(1, error)
+			raise ValueError(error)
+
+		#
+		# Check the optional fresh connection flag, for tests about
+		# connection setup which must not reuse a kept-alive connection.
+		#
+		fresh_connection = params.get("fresh_connection", False)
+		if type(fresh_connection) != bool:
+			error = f'Test:{params["name"]} fresh_connection should be True or False, not {fresh_connection}'
+			Logger.log(1, error)
+			raise TypeError(error)
+
 		#
 		# Check success criteria
 		#
@@ -127,6 +239,7 @@ class CanisterTest:
 			error = f'Test:{params["name"]} success criteria should be a list, not {type(scs)}'
 			Logger.log(1, error)
 			raise TypeError(error)
+		criteria = []
 		for sc in scs:
 			if type(sc) != dict:
 				error = f'Test:{params["name"]} each success criterion must be a dict, not {type(sc)}'
@@ -137,12 +250,10 @@ class CanisterTest:
 					error = f'Test:{params["name"]} unsupported item in success criteria: {item}'
 					Logger.log(1, error)
 					raise KeyError(error)
-			if sc["field"] not in supported_sc_fields:
-				error = f'Test:{params["name"]} unsupported success criteria field: {sc["field"]}'
-				Logger.log(1, error)
-				raise ValueError(error)
-			if sc["op"] not in supported_sc_ops:
-				error = f'Test:{params["name"]} unsupported success criteria op: {sc["op"]}'
+			try:
+				criteria.append(Criterion(sc))
+			except ValueError as e:
+				error = f'Test:{params["name"]} {e}'
 				Logger.log(1, error)
 				raise ValueError(error)
 
@@ -159,6 +270,8 @@ class CanisterTest:
 		self.path = params["path"]
 		self.port = params["port"]
 		self.success_criteria = params["success_criteria"]
+		self.criteria = criteria
+		self.ttype = ttype
 
 		#
 		# Optional params - 
@@ -172,6 +285,13 @@ class CanisterTest:
 		self.success = None
 		self.reasons = None
 
+		#
+		# Timings of each run, see net_http.timed_request(), and their
+		# min/median/p95 over the runs, see timing_stats().
+		#
+		self.timings = None
+		self.timing_stats = None
+
 		#
 		# Log success
 		#
@@ -179,9 +299,22 @@ class CanisterTest:
 
 
 
-	def execute(self):
+	def execute(self, timeout=None, deadline=None):
+		#
+		# The main test engine. A test with a "repeat" count makes its
+		# request that many times, and succeeds if every run succeeds.
 		#
-		# The main test engine.
+		# Parameters:
+		# ----------
+		#
+		# timeout: seconds to wait for the target before the test gives
+		#          up, unless the test defines its own "timeout". A test
+		#          which times out is executed and fails.
+		#
+		# deadline: time.monotonic() value by which the whole run must
+		#           be finished. The request is cut short to end by then,
+		#           and a test still running at the deadline is left
+		#           unexecuted.
 		#
 		Logger.log(1, f'Test:{self.name} executing with {self.protocol}')
 
@@ -192,6 +325,17 @@ class CanisterTest:
 		self.success = None
 		self.reasons = None
 		self.executed = False
+		self.timings = None
+		self.timing_stats = None
+
+		#
+		# The test's own timeout overrides the one passed in, and neither
+		# may run past the deadline.
+		#
+		timeout = self.optional_parameters.get("timeout", timeout)
+		if deadline is not None:
+			remaining = max(deadline - time.monotonic(), 0.001)
+			timeout = remaining if timeout is None else min(timeout, remaining)
 
 		#
 		# http/s tests
@@ -199,37 +343,43 @@ class CanisterTest:
 		if self.protocol in ["http", "https"]:
 
 			#
-			# Construct request
-			#
-			headers = self.optional_parameters.get("headers", {})
-			body = self.optional_parameters.get("body", None)
-			url = f'{self.protocol}://{self.host}:{self.port}{self.path}'
-			Logger.log(3, f'Test:{self.name} url={url}')
-
-			#
-			# Make request
-			#
-			response_code, response_reason, response_headers, response_body = request(
-				url,
-				method=self.method,
-				headers=headers,
-				body=body,
-			)
-			Logger.log(3, f'Test:{self.name} response_code={response_code}')
-			Logger.log(3, f'Test:{self.name} response_reason={response_reason}')
-			Logger.log(4, f'Test:{self.name} response_headers={response_headers}')
-			Logger.log(4, f'Test:{self.name} response_body={response_body}')
-
-			#
-			# Evaluate result
+			# Make the requests
 			#
-			Logger.log(2, f'Test:{self.name} evaluating response')
-			self.success, self.reasons = evaluate(
-				{
-					"response_code": response_code
-				},
-				self.success_criteria
-			)
+			timings = []
+			success = True
+			reasons = None
+			for run in range(self.optional_parameters.get("repeat", 1)):
+				run_success, run_reasons, run_timings, response_code = self.run(timeout)
+
+				#
+				# Past the deadline the set has already moved on, so the
+				# outcome is not recorded.
+				#
+				if deadline is not None and time.monotonic() >= deadline:
+					self.reasons = ["Global timeout reached before the test finished"]
+					Logger.log(1, f'Test:{self.name} global timeout')
+					return
+
+				#
+				# The reasons reported are those of the first failed run,
+				# or of the last run if all succeeded.
+				#
+				if success:
+					reasons = run_reasons
+				success = success and run_success
+				timings.append(run_timings)
+
+				#
+				# Later runs use a new deadline-limited timeout
+				#
+				if deadline is not None:
+					remaining = max(deadline - time.monotonic(), 0.001)
+					timeout = remaining if timeout is None else min(timeout, remaining)
+
+			self.success = success
+			self.reasons = reasons
+			self.timings = timings
+			self.timing_stats = timing_stats(timings)
 			self.executed = True
 			Logger.log(2, f'Test:{self.name} success={self.success}')
 			Logger.log(3, f'Test:{self.name} reasons={self.reasons}')
@@ -245,12 +395,257 @@ class CanisterTest:
 			raise ValueError(error)
 
 
+	def run(self, timeout=None):
+		#
+		# Make the test's request once and evaluate it, without changing
+		# the test's state, so that runs can be made concurrently. Used by
+		# execute() and by the set's load mode.
+		#
+		# Parameters:
+		# ----------
+		#
+		# timeout: seconds to wait for the target.
+		#
+		# Returns:
+		# -------
+		#
+		# (success, reasons, timings, response_code), timings as from
+		# net_http.timed_request(), or transfer_timings() for a
+		# throughput test.
+		#
+		headers = self.optional_parameters.get("headers", {})
+		body = self.optional_parameters.get("body", None)
+		url = f'{self.protocol}://{self.host}:{self.port}{self.path}'
+		Logger.log(3, f'Test:{self.name} url={url}')
+		if self.ttype == "throughput":
+			response_code, response_reason, timings = self.transfer(url, headers, timeout)
+		else:
+			response_code, response_reason, response_headers, response_body, timings = timed_request(
+				url,
+				method=self.method,
+				headers=headers,
+				body=body,
+				timeout=timeout,
+				fresh=self.optional_parameters.get("fresh_connection", False),
+			)
+			Logger.log(4, f'Test:{self.name} response_headers={response_headers}')
+			Logger.log(4, f'Test:{self.name} response_body={response_body}')
+		Logger.log(3, f'Test:{self.name} response_code={response_code}')
+		Logger.log(3, f'Test:{self.name} response_reason={response_reason}')
+		Logger.log(3, f'Test:{self.name} timings={timings}')
+
+		#
+		# Evaluate result
+		#
+		Logger.log(2, f'Test:{self.name} evaluating response')
+		success, reasons = evaluate(
+			result_fields(response_code, timings),
+			self.criteria
+		)
+		if response_code is None:
+			reasons.append(f'No response: {response_reason}')
+		return success, reasons, timings, response_code
+
+
+	def transfer(self, url, headers, timeout):
+		#
+		# Make the transfers of a throughput test, one per stream, at the
+		# same time.
+		#
+		# Returns:
+		# -------
+		#
+		# (response_code, response_reason, timings), timings as from
+		# transfer_timings(). The response code and reason are those of
+		# the first stream which failed, or of the first stream.
+		#
+		upload = self.optional_parameters.get("direction") == "upload"
+		size = self.optional_parameters.get("size")
+		streams = self.optional_parameters.get("streams", 1)
+		started = time.perf_counter()
+		with concurrent.futures.ThreadPoolExecutor(max_workers=streams) as executor:
+			futures = [
+				executor.submit(
+					timed_transfer,
+					url,
+					method=self.method,
+					headers=headers,
+					upload=size if upload else 0,
+					limit=None if upload else size,
+					timeout=timeout,
+				)
+				for _ in range(streams)
+			]
+			results = [future.result() for future in futures]
+		total_ms = (time.perf_counter() - started) * 1000
+
+		response_code, response_reason, _ = results[0]
+		for code, reason, _ in results:
+			if code is None or code >= 400:
+				response_code, response_reason = code, reason
+				break
+		return response_code, response_reason, transfer_timings([timings for _, _, timings in results], total_ms)
+
+
 	def __str__(self):
 		attributes = {key: value for key, value in self.__dict__.items() if not key.startswith('__') and not callable(value)}
 		return f'{attributes}'
 
 
 
+def transfer_timings(stream_timings, total_ms):
+	#
+	# Combine the timings of the parallel streams of a throughput test.
+	#
+	# Parameters:
+	# ----------
+	#
+	# stream_timings: list of net_http.timed_transfer() timings, one per
+	#                 stream.
+	#
+	# total_ms: from the start of the first stream to the end of the last.
+	#
+	# Returns:
+	# -------
+	#
+	# Timings dictionary as for one stream, with the phases of the slowest
+	# stream, the total_ms passed in, the bytes received and sent by all
+	# streams and the number of streams.
+	#
+	timings = {}
+	for field in ["dns_ms", "connect_ms", "tls_ms", "ttfb_ms"]:
+		values = [stream[field] for stream in stream_timings if stream[field] is not None]
+		timings[field] = max(values) if len(values) > 0 else None
+	timings["total_ms"] = total_ms
+	received = [stream["bytes"] for stream in stream_timings if stream["bytes"] is not None]
+	timings["bytes"] = sum(received) if len(received) > 0 else None
+	timings["bytes_sent"] = sum(stream["bytes_sent"] for stream in stream_timings)
+	timings["reused"] = False
+	timings["streams"] = len(stream_timings)
+	return timings
+
+
+
+def timing_stats(timings):
+	#
+	# Summarise the timings of the runs of a test.
+	#
+	# Parameters:
+	# ----------
+	#
+	# timings: list of timings dictionaries, one per run.
+	#
+	# Returns:
+	# -------
+	#
+	# Dictionary of {"min", "median", "p95"} per timing field, over the
+	# runs which reached that phase, or None for a phase no run reached.
+	# p95 is the nearest-rank percentile, the slowest run below 20 runs.
+	#
+	stats = {}
+	for field in timing_fields:
+		values = sorted(run[field] for run in timings if run[field] is not None)
+		if len(values) == 0:
+			stats[field] = None
+			continue
+		stats[field] = {
+			"min": values[0],
+			"median": statistics.median(values),
+			"p95": values[max(0, -(-95 * len(values) // 100) - 1)],
+		}
+	return stats
+
+
+
+class Criterion:
+	#
+	# A success criterion, checked and compiled once when its test loads,
+	# so that evaluating it is a single comparison.
+	#
+
+
+	def __init__(self, sc):
+		#
+		# Parameters:
+		# ----------
+		#
+		# sc: a success criterion dictionary of field, op and value.
+		#     "is" compares the result and value as case-insensitive
+		#     strings, the other ops compare numbers.
+		#
+		# Raises ValueError for an unsupported field or op, or a value
+		# which does not suit the op.
+		#
+		self.field = sc["field"]
+		self.op = sc["op"]
+		self.value = sc["value"]
+		if self.field not in supported_sc_fields:
+			raise ValueError(f'unsupported success criteria field: {self.field}')
+		if self.op not in supported_sc_ops:
+			raise ValueError(f'unsupported success criteria op: {self.op}')
+
+		if self.op == "is":
+			self.expected = str(self.value).lower()
+			return
+		if self.op == "between":
+			if type(self.value) != list or len(self.value) != 2 or not all(is_number(bound) for bound in self.value):
+				raise ValueError(f'success criteria op between needs a [low, high] value, not {self.value}')
+			if self.value[0] > self.value[1]:
+				raise ValueError(f'success criteria op between has low > high: {self.value}')
+		elif not is_number(self.value):
+			raise ValueError(f'success criteria op {self.op} needs a number, not {self.value}')
+		self.compare = numeric_sc_ops[self.op]
+
+
+	def check(self, results):
+		#
+		# Returns (outcome, reason), outcome being None if the field is
+		# not in the results.
+		#
+		if self.field not in results:
+			return None, f'No {self.field} in result'
+		result = results[self.field]
+		if self.op == "is":
+			if self.expected == str(result).lower():
+				return True, f'{self.field} result {result} = success criteria {self.value}'
+			return False, f'{self.field} result {result} != success criteria {self.value}'
+		if result is None:
+			return None, f'No {self.field} in result'
+		if self.compare(result, self.value):
+			return True, f'{self.field} result {result:g} {self.op} success criteria {self.value}'
+		return False, f'{self.field} result {result:g} not {self.op} success criteria {self.value}'
+
+
+
+def is_number(value):
+	return type(value) in [int, float]
+
+
+
+def result_fields(response_code, timings):
+	#
+	# The results of a web request which success criteria can test, from
+	# its response code and its net_http.timed_request() timings. The
+	# throughput counts the bytes sent as well as received, for uploads.
+	#
+	total_ms = timings["total_ms"]
+	received = timings["bytes"]
+	sent = timings.get("bytes_sent")
+	if (received is None and not sent) or not total_ms:
+		throughput_mbps = None
+	else:
+		throughput_mbps = ((received or 0) + (sent or 0)) * 8 / (total_ms * 1000)
+	return {
+		"response_code": response_code,
+		"response_time_ms": total_ms,
+		"ttfb_ms": timings["ttfb_ms"],
+		"throughput_mbps": throughput_mbps,
+		"bytes_received": received,
+		"bytes_sent": sent,
+	}
+
+
+
 def evaluate(results, scs):
 	#
 	# Evaluates the given results against the success criteria.
@@ -262,7 +657,8 @@ def evaluate(results, scs):
 	#
 	# results: dictionary, contents of which depend on test type
 	#
-	# scs: list of success criteria.
+	# scs: list of success criteria, as Criterion objects or as
+	#      dictionaries, which are compiled on each call.
 	#
 	# Returns:
 	# -------
@@ -279,33 +675,17 @@ def evaluate(results, scs):
 	# each with the results.
 	#
 	for sc in scs:
-
-		#
-		# response_code
-		#
-		if sc["field"] == "response_code":
-
-			#
-			# Check if field is present
-			#
-			if "response_code" not in results:
-				reasons.append("No response_code in result")
-				errors += 1
-				continue
-
-			#
-			# Compare values
-			#
-			if sc["op"] == "is":
-				if str(sc["value"]).lower() == str(results["response_code"]).lower():
-					reasons.append(f'response_code result {results["response_code"]} = success criteria {sc["value"]}')
-					successes += 1
-				else:
-					errors += 1
-					reasons.append(f'response_code result {results["response_code"]} != success criteria {sc["value"]}')
+		if type(sc) != Criterion:
+			sc = Criterion(sc)
+		outcome, reason = sc.check(results)
+		reasons.append(reason)
+		if outcome:
+			successes += 1
+		else:
+			errors += 1
 
 	if errors > 0:
 		return False, reasons
 	if successes > 0:
 		return True, reasons
-	return False, ["Indeterminate result"]
\ No newline at end of file
+	return False, ["Indeterminate result"]
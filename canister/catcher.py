@@ -5,23 +5,544 @@
 # a target for tests. The service will respond to any GET/POST request with
 # a 200 OK, and echo the request headers and body back in the response.
 #
+# Two backends serve the same routes: Catcher, a thread per connection
+# http.server, and AsyncCatcher, an asyncio server for high concurrency
+# with HTTP/1.1 keep-alive and pipelining.
+#
+# Besides the test payloads, bulk endpoints measure throughput:
+# /bytes/<size> and /file/<name> stream generated and on-disk content,
+# and /sink consumes uploads.
+#
+# Both backends count what they serve, see Metrics, and report it on
+# /__stats and optionally in a periodic summary, so logging each request
+# can be turned off under load.
+#
 
+import asyncio
 import base64
+import bisect
+import email.utils
 import http.server
+import json
+import os
+import re
 import socketserver
 import ssl
 import sys
 import threading
 import time
+import urllib.parse
 
 from logger import Logger
 
 
 
+#
+# Test payloads, base64 encoded
+#
+eicarb64 = "WDVPIVAlQEFQWzRcUFpYNTQoUF4pN0NDKTd9JEVJQ0FSLVNUQU5EQVJELUFOVElWSVJVUy1URVNULUZJTEUhJEgrSCo="
+ngeicarb64 = "WDVPIVAlQEFQWzRcUFpYNTQoUF4pN0NDKTd9JEVJQ0FSLVNFTlRJTkVMLUFOVElWSVJVUy1URVNULUZJTEUhJEgrSCo="
+eicarzipb64 = "UEsDBAoAAAAAADKs6yjRINsxuAAAALgAAAANAAAAZWljYXJfY29tLnppcFBLAwQKAAAAAADgmLgoPM9RaEQAAABEAAAACQAAAGVpY2FyLmNvbVg1TyFQJUBBUFs0XFBaWDU0KFBeKTdDQyk3fSRFSUNBUi1TVEFOREFSRC1BTlRJVklSVVMtVEVTVC1GSUxFISRIK0gqUEsBAhQACgAAAAAA4Ji4KDzPUWhEAAAARAAAAAkAAAAAAAAAAQAgAP+BAAAAAGVpY2FyLmNvbVBLBQYAAAAAAQABADcAAABrAAAAAABQSwECFAAKAAAAAAAyrOso0SDbMbgAAAC4AAAADQAAAAAAAAAAACAAtoEAAAAAZWljYXJfY29tLnppcFBLBQYAAAAAAQABADsAAADjAAAAAAA=="
+
+
+
+#
+# The built-in routes, in the format of a routes file, see load_routes().
+#
+DEFAULT_ROUTES = [
+    {
+        "method": "GET",
+        "path": "/eicar.exe",
+        "headers": {"Content-Type": "application/octet-stream",
+                    "Content-Disposition": "attachment; filename=\"eicar.exe\""},
+        "body_base64": eicarb64,
+    },
+    {
+        "method": "GET",
+        "path": "/ngeicar.exe",
+        "headers": {"Content-Type": "application/octet-stream",
+                    "Content-Disposition": "attachment; filename=\"ngeicar.exe\""},
+        "body_base64": ngeicarb64,
+    },
+    {
+        "method": "GET",
+        "path": "/eicar.zip",
+        "headers": {"Content-Type": "application/octet-stream",
+                    "Content-Disposition": "attachment; filename=\"eicar.zip\""},
+        "body_base64": eicarzipb64,
+    },
+]
+
+
+#
+# Methods routes can be defined for, and the Server header of all responses.
+#
+route_methods = ["GET", "POST"]
+server_header = f'{http.server.BaseHTTPRequestHandler.server_version} {http.server.BaseHTTPRequestHandler.sys_version}'
+
+
+
+class Response:
+    #
+    # A response prebuilt as bytes, so that serving it is a single write.
+    # Only the protocol version of the status line and the Date and
+    # Connection headers are added when it is sent, by render().
+    #
+    # Parameters:
+    # ----------
+    #   code: HTTP status code.
+    #
+    #   headers: list of (name, value) headers. Server and Content-Length
+    #            are added.
+    #
+    #   body: the body bytes.
+    #
+    #   length: the Content-Length, if the body is streamed after the
+    #           response rather than included in it.
+    #
+    def __init__(self, code, headers, body, length=None):
+        self.code = code
+        self.body = body
+        self.length = len(body) if length is None else length
+        reason = http.server.BaseHTTPRequestHandler.responses.get(code, ("",))[0]
+        lines = [f' {code} {reason}', f'Server: {server_header}']
+        lines += [f'{name}: {value}' for name, value in headers]
+        lines.append(f'Content-Length: {self.length}')
+        self.head = ("\r\n".join(lines) + "\r\n").encode("latin-1")
+
+
+    def render(self, protocol, connection=None):
+        #
+        # The response as sent.
+        #
+        # Parameters:
+        # ----------
+        #   protocol: the status line version, b"HTTP/1.1" or b"HTTP/1.0".
+        #
+        #   connection: the Connection header value as bytes, or None for
+        #               no Connection header.
+        #
+        parts = [protocol, self.head, http_date()]
+        if connection is not None:
+            parts.append(b"Connection: " + connection + b"\r\n")
+        parts.append(b"\r\n")
+        parts.append(self.body)
+        return b"".join(parts)
+
+
+
+#
+# The Date header, formatted once per second.
+#
+date_cache = (0, b"")
+
+def http_date():
+    global date_cache
+    now = int(time.time())
+    second, header = date_cache
+    if second != now:
+        header = f'Date: {email.utils.formatdate(now, usegmt=True)}\r\n'.encode()
+        date_cache = (now, header)
+    return header
+
+
+
+def load_routes(filename):
+    #
+    # Load custom routes from a JSON file, so that payloads can be served
+    # without code changes.
+    #
+    # The file holds a list of routes, each a dictionary of:
+    #
+    #   path: the request path, starting with "/". Required.
+    #
+    #   method: GET (default) or POST.
+    #
+    #   status: the response status code, 200 by default.
+    #
+    #   headers: a dictionary of response headers, by default a
+    #            Content-Type of application/octet-stream.
+    #
+    #   and the body as one of:
+    #
+    #   body: text, sent UTF-8 encoded.
+    #   body_base64: base64 encoded bytes.
+    #   file: a file to send, relative to the routes file.
+    #
+    # Returns:
+    # -------
+    #   The list of routes, with file names made absolute. Raises
+    #   ValueError if a route is invalid.
+    #
+    with open(filename) as f:
+        routes = json.load(f)
+    if type(routes) != list:
+        raise ValueError(f'{filename}: routes should be a list, not {type(routes)}')
+    base_dir = os.path.dirname(os.path.abspath(filename))
+    loaded = []
+    for i, route in enumerate(routes):
+        if type(route) != dict:
+            raise ValueError(f'{filename}:{i}: a route should be a dict, not {type(route)}')
+        route = dict(route)
+        if "file" in route:
+            route["file"] = os.path.join(base_dir, route["file"])
+        try:
+            build_response(route)
+        except (ValueError, TypeError, OSError) as e:
+            raise ValueError(f'{filename}:{i}: {e}')
+        loaded.append(route)
+    return loaded
+
+
+
+def build_response(route):
+    #
+    # Build the Response of a route, see load_routes().
+    #
+    path = route.get("path")
+    if type(path) != str or not path.startswith("/"):
+        raise ValueError(f'path should start with "/", not {path}')
+    if route.get("method", "GET") not in route_methods:
+        raise ValueError(f'unsupported method: {route.get("method")}')
+    status = route.get("status", 200)
+    if status not in http.server.BaseHTTPRequestHandler.responses:
+        raise ValueError(f'unsupported status: {status}')
+    headers = route.get("headers", {"Content-Type": "application/octet-stream"})
+    if type(headers) != dict:
+        raise TypeError(f'headers should be a dict, not {type(headers)}')
+
+    sources = [key for key in ["body", "body_base64", "file"] if key in route]
+    if len(sources) != 1:
+        raise ValueError(f'a route needs one of body, body_base64 or file, not {sources}')
+    if "body" in route:
+        body = route["body"].encode("utf-8")
+    elif "body_base64" in route:
+        body = base64.b64decode(route["body_base64"])
+    else:
+        with open(route["file"], "rb") as f:
+            body = f.read()
+    return Response(status, list(headers.items()), body)
+
+
+
+def build_routes(routes):
+    #
+    # Build the route table, mapping (method, path) to its prebuilt
+    # Response, from the built-in routes followed by the given routes,
+    # which replace built-in routes of the same method and path.
+    #
+    table = {}
+    for route in DEFAULT_ROUTES + routes:
+        table[(route.get("method", "GET"), route["path"])] = build_response(route)
+    return table
+
+
+
+def route(routes, method, path, requestline, headers):
+    #
+    # The Response to a request: its prebuilt response from the route
+    # table, or else for GET and POST the request line and headers echoed
+    # back (ignoring any body).
+    #
+    # Parameters:
+    # ----------
+    #   routes: the route table, from build_routes().
+    #
+    #   method, path: of the request.
+    #
+    #   requestline: the request line, as echoed back.
+    #
+    #   headers: iterable of (name, value) request headers, as echoed back.
+    #
+    response = routes.get((method, path))
+    if response is not None:
+        return response
+    if method in route_methods:
+        echo = f'{requestline}\n' + "".join(f"{header}: {value}\n" for header, value in headers)
+        return Response(200, [("Content-type", "text/plain")], echo.encode("latin-1", "replace"))
+    return Response(501, [("Content-Type", "text/plain")], f'Unsupported method ({method})\n'.encode("latin-1", "replace"))
+
+
+
+#
+# Bulk endpoints. Generated content is sliced from one shared pattern
+# buffer, and files and uploads move through buffers of bulk_chunk bytes.
+#
+bulk_chunk = 256 * 1024
+bulk_buffer = memoryview(bytes(range(256)) * (4 * bulk_chunk // 256))
+bulk_max_size = 1 << 40
+size_pattern = re.compile(r'^([0-9]+)([kmg]?)$', re.IGNORECASE)
+size_units = {"": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30}
+
+
+
+def parse_size(text):
+    #
+    # A byte count such as 1000, 64k, 10M or 1g (binary multiples), or
+    # None if invalid or above bulk_max_size.
+    #
+    match = size_pattern.match(text)
+    if match is None:
+        return None
+    size = int(match.group(1)) * size_units[match.group(2).lower()]
+    return size if size <= bulk_max_size else None
+
+
+
+def bulk_route(method, path, files_dir):
+    #
+    # Classify a bulk endpoint request.
+    #
+    # Parameters:
+    # ----------
+    #   method, path: of the request, the path without its query.
+    #
+    #   files_dir: the directory /file/<name> serves, or None.
+    #
+    # Returns:
+    # -------
+    #   None for other paths, or one of:
+    #   ("bytes", size) for GET /bytes/<size>
+    #   ("file", filename) for GET /file/<name> of a file in files_dir
+    #   ("sink", None) for POST /sink
+    #   ("stats", None) for GET /__stats, see Metrics.snapshot()
+    #   ("error", Response) for an invalid size or unknown file
+    #
+    if method == "POST" and path == "/sink":
+        return "sink", None
+    if method == "GET" and path == "/__stats":
+        return "stats", None
+    if method != "GET":
+        return None
+    if path.startswith("/bytes/"):
+        size = parse_size(path[len("/bytes/"):])
+        if size is None:
+            return "error", Response(400, [("Content-Type", "text/plain")], b"Invalid size\n")
+        return "bytes", size
+    if path.startswith("/file/"):
+        name = urllib.parse.unquote(path[len("/file/"):])
+        filename = None
+        if files_dir is not None and name and "/" not in name and "\\" not in name and not name.startswith("."):
+            filename = os.path.join(files_dir, name)
+        if filename is None or not os.path.isfile(filename):
+            return "error", Response(404, [("Content-Type", "text/plain")], b"No such file\n")
+        return "file", filename
+    return None
+
+
+
+def bulk_head(size):
+    return Response(200, [("Content-Type", "application/octet-stream")], b"", length=size)
+
+
+
+def stats_response(metrics):
+    body = json.dumps(metrics.snapshot()).encode()
+    return Response(200, [("Content-Type", "application/json"), ("Cache-Control", "no-store")], body)
+
+
+
+def route_label(routes, method, path, bulk):
+    #
+    # The route a request is counted under: the path of a route table
+    # entry or bulk endpoint, or "echo" for the other paths, so that the
+    # number of counters does not grow with the paths requested.
+    #
+    if (method, path) in routes:
+        return path
+    if bulk is not None:
+        return "/" + path.split("?", 1)[0].split("/")[1]
+    return "echo"
+
+
+
+def sink_response(received, seconds):
+    #
+    # The response of /sink: the bytes received, the seconds from the end
+    # of the request headers to the end of the body, and the rate.
+    #
+    mbps = received * 8 / seconds / 1e6 if seconds > 0 else 0.0
+    body = json.dumps({"bytes": received, "seconds": round(seconds, 6), "mbps": round(mbps, 3)}).encode()
+    return Response(200, [("Content-Type", "application/json")], body)
+
+
+
+#
+# Upper bounds of the latency histogram buckets in milliseconds, as in
+# canisterset, with a last bucket for anything slower.
+#
+latency_buckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+
+
+class Counters:
+    #
+    # The counts of one connection (threaded backend) or of one event
+    # loop (asyncio backend). Only the thread serving it writes to it, so
+    # counting takes no lock.
+    #
+
+    def __init__(self):
+        self.requests = {}
+        self.latency = [0] * (len(latency_buckets) + 1)
+        self.max_ms = 0.0
+        self.bytes_served = 0
+        self.opened = 0
+        self.closed = 0
+
+
+    def record(self, method, label, code, size, seconds):
+        key = (method, label, code)
+        self.requests[key] = self.requests.get(key, 0) + 1
+        ms = seconds * 1000
+        self.latency[bisect.bisect_left(latency_buckets, ms)] += 1
+        if ms > self.max_ms:
+            self.max_ms = ms
+        self.bytes_served += size
+
+
+    def add(self, other):
+        #
+        # Add the counts of other, which may be being written meanwhile:
+        # its request counts are copied first, retrying if a new key is
+        # added during the copy.
+        #
+        while True:
+            try:
+                requests = list(other.requests.items())
+                break
+            except RuntimeError:
+                pass
+        for key, count in requests:
+            self.requests[key] = self.requests.get(key, 0) + count
+        for i, count in enumerate(list(other.latency)):
+            self.latency[i] += count
+        self.max_ms = max(self.max_ms, other.max_ms)
+        self.bytes_served += other.bytes_served
+        self.opened += other.opened
+        self.closed += other.closed
+
+
+
+class Metrics:
+    #
+    # What a Catcher has served since it was created: requests by method,
+    # route and status, a latency histogram, the bytes of the bodies
+    # served, and connections opened and still active.
+    #
+    # Requests are counted into Counters owned by the serving thread. The
+    # lock is only taken to add or retire Counters, once per connection
+    # for the threaded backend, and to read them all for a snapshot.
+    #
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.live = set()
+        self.retired = Counters()
+        self.started = time.time()
+
+
+    def counters(self):
+        #
+        # New Counters, included in snapshots until retired.
+        #
+        counters = Counters()
+        with self.lock:
+            self.live.add(counters)
+        return counters
+
+
+    def retire(self, counters):
+        #
+        # Fold the counts of Counters no longer written to into the totals.
+        #
+        with self.lock:
+            self.live.discard(counters)
+            self.retired.add(counters)
+
+
+    def snapshot(self):
+        #
+        # Returns:
+        # -------
+        #   Dictionary of uptime_s, requests, bytes_served, connections
+        #   (active and total), routes (method, route, status, count) and
+        #   latency_ms: the histogram as [upper bound, count] pairs, the
+        #   last bound being None, and p50, p95 and p99 as the upper bound
+        #   of the bucket they fall in (max for the last bucket).
+        #
+        totals = Counters()
+        with self.lock:
+            totals.add(self.retired)
+            for counters in list(self.live):
+                totals.add(counters)
+        requests = sum(totals.latency)
+        latency = {"histogram": [[bound, count] for bound, count in zip(latency_buckets + [None], totals.latency)]}
+        for p in [50, 95, 99]:
+            latency[f'p{p}'] = None
+            rank = -(-p * requests // 100)
+            seen = 0
+            for bound, count in zip(latency_buckets + [None], totals.latency):
+                seen += count
+                if requests > 0 and seen >= rank:
+                    latency[f'p{p}'] = bound if bound is not None else round(totals.max_ms, 3)
+                    break
+        latency["max"] = round(totals.max_ms, 3)
+        return {
+            "uptime_s": round(time.time() - self.started, 3),
+            "requests": requests,
+            "bytes_served": totals.bytes_served,
+            "connections": {"active": totals.opened - totals.closed, "total": totals.opened},
+            "routes": [
+                {"method": method, "route": label, "status": code, "count": count}
+                for (method, label, code), count in sorted(totals.requests.items(), key=str)
+            ],
+            "latency_ms": latency,
+        }
+
+
+    def report(self, interval, stopped):
+        #
+        # Log a summary every interval seconds until stopped (an Event) is
+        # set: the requests and bytes since the last summary and the rate,
+        # the active connections, the latency percentiles and the counts of
+        # each status since the start.
+        #
+        last = self.snapshot()
+        while not stopped.wait(interval):
+            stats = self.snapshot()
+            seconds = stats["uptime_s"] - last["uptime_s"]
+            requests = stats["requests"] - last["requests"]
+            mbps = (stats["bytes_served"] - last["bytes_served"]) * 8 / seconds / 1e6 if seconds > 0 else 0.0
+            statuses = {}
+            for entry in stats["routes"]:
+                statuses[entry["status"]] = statuses.get(entry["status"], 0) + entry["count"]
+            latency = stats["latency_ms"]
+            Logger.log(1, f'stats requests:{stats["requests"]} (+{requests}, {requests / seconds:.1f}/s) '
+                          f'mbps:{mbps:.1f} active:{stats["connections"]["active"]} '
+                          f'p50:{latency["p50"]} p95:{latency["p95"]} p99:{latency["p99"]} ms '
+                          f'status:{" ".join(f"{code}={count}" for code, count in sorted(statuses.items()))}')
+            last = stats
+
+
+
+def start_reporter(metrics, interval):
+    #
+    # Start Metrics.report() on a daemon thread, if interval is set.
+    # Returns the Event which stops it, or None.
+    #
+    if not interval:
+        return None
+    stopped = threading.Event()
+    threading.Thread(target=metrics.report, args=(interval, stopped), daemon=True).start()
+    return stopped
+
+
+
 class RequestHandler(http.server.BaseHTTPRequestHandler):
     #
-    # Handle GET and POST requests by echoing back the request headers
-    # and body in the response body.
+    # Handle GET and POST requests from the route table of the server,
+    # echoing back the request headers for paths without a route.
     #
 
     def log_message(self, f, *args):
@@ -33,63 +554,164 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
         Logger.log(1, text)
 
 
-    def do_GET(self):
+    def log_request(self, code="-", size="-"):
+        if self.server.log_requests:
+            super().log_request(code, size)
 
-        #
-        # EICAR file
-        #
-        if self.path == "/eicar.exe":
-            eicarb64 = "WDVPIVAlQEFQWzRcUFpYNTQoUF4pN0NDKTd9JEVJQ0FSLVNUQU5EQVJELUFOVElWSVJVUy1URVNULUZJTEUhJEgrSCo="
-            self.send_response(200)
-            self.send_header("Content-Type", "application/octet-stream")
-            self.send_header("Content-Disposition", "attachment; filename=\"eicar.exe\"")
-            self.end_headers()
-            self.wfile.write(base64.b64decode(eicarb64))
 
+    def setup(self):
         #
-        # NG EICAR file
+        # Each connection counts into its own Counters, and serves one
+        # request (HTTP/1.0), timed from the accepted connection.
         #
-        if self.path == "/ngeicar.exe":
-            ngeicarb64 = "WDVPIVAlQEFQWzRcUFpYNTQoUF4pN0NDKTd9JEVJQ0FSLVNFTlRJTkVMLUFOVElWSVJVUy1URVNULUZJTEUhJEgrSCo="
-            self.send_response(200)
-            self.send_header("Content-Type", "application/octet-stream")
-            self.send_header("Content-Disposition", "attachment; filename=\"ngeicar.exe\"")
-            self.end_headers()
-            self.wfile.write(base64.b64decode(ngeicarb64))
+        self.started = time.perf_counter()
+        self.counters = self.server.metrics.counters()
+        self.counters.opened = 1
+        super().setup()
+
+
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            self.counters.closed = 1
+            self.server.metrics.retire(self.counters)
 
+
+    def served(self, label, code, size):
+        self.counters.record(self.command, label, code, size, time.perf_counter() - self.started)
+        self.log_request(code, size)
+
+
+    def send_error(self, code, message=None, explain=None):
         #
-        # Zipped EICAR
+        # Malformed requests and invalid bodies are counted too.
         #
-        if self.path == "/eicar.zip":
-            zipfile = "UEsDBAoAAAAAADKs6yjRINsxuAAAALgAAAANAAAAZWljYXJfY29tLnppcFBLAwQKAAAAAADgmLgoPM9RaEQAAABEAAAACQAAAGVpY2FyLmNvbVg1TyFQJUBBUFs0XFBaWDU0KFBeKTdDQyk3fSRFSUNBUi1TVEFOREFSRC1BTlRJVklSVVMtVEVTVC1GSUxFISRIK0gqUEsBAhQACgAAAAAA4Ji4KDzPUWhEAAAARAAAAAkAAAAAAAAAAQAgAP+BAAAAAGVpY2FyLmNvbVBLBQYAAAAAAQABADcAAABrAAAAAABQSwECFAAKAAAAAAAyrOso0SDbMbgAAAC4AAAADQAAAAAAAAAAACAAtoEAAAAAZWljYXJfY29tLnppcFBLBQYAAAAAAQABADsAAADjAAAAAAA=="
-            self.send_response(200)
-            self.send_header("Content-Type", "application/octet-stream")
-            self.send_header("Content-Disposition", "attachment; filename=\"eicar.zip\"")
-            self.end_headers()
-            self.wfile.write(base64.b64decode(zipfile))
+        super().send_error(code, message, explain)
+        self.counters.record(self.command or "-", "invalid", code, 0, time.perf_counter() - self.started)
+
 
+    def do_GET(self):
+        self.respond()
+
+
+    def do_POST(self):
+        self.respond()
+
+
+    def respond(self):
         #
-        # Default GET: ignore the body, only send back the request headers.
+        # A single lookup and write, unless the request is for a bulk
+        # endpoint. The connection closes after the response (HTTP/1.0).
         #
+        protocol = self.protocol_version.encode()
+        bulk = None
+        if (self.command, self.path) not in self.server.routes:
+            bulk = bulk_route(self.command, self.path.split("?", 1)[0], self.server.files_dir)
+        label = route_label(self.server.routes, self.command, self.path, bulk)
+        if bulk is None:
+            response = route(self.server.routes, self.command, self.path, self.requestline, self.headers.items())
+            self.wfile.write(response.render(protocol))
+            self.served(label, response.code, len(response.body))
+            return
+
+        kind, value = bulk
+        if kind == "error":
+            self.wfile.write(value.render(protocol))
+            self.served(label, value.code, len(value.body))
+        elif kind == "stats":
+            response = stats_response(self.server.metrics)
+            self.wfile.write(response.render(protocol))
+            self.served(label, response.code, len(response.body))
+        elif kind == "sink":
+            started = time.perf_counter()
+            received = self.consume_body()
+            if received is None:
+                self.send_error(400, "Invalid request body")
+                return
+            response = sink_response(received, time.perf_counter() - started)
+            self.wfile.write(response.render(protocol))
+            self.served(label, response.code, len(response.body))
+        elif kind == "bytes":
+            self.wfile.write(bulk_head(value).render(protocol))
+            remaining = value
+            while remaining > 0:
+                count = min(remaining, len(bulk_buffer))
+                self.wfile.write(bulk_buffer[:count])
+                remaining -= count
+            self.served(label, 200, value)
         else:
-            self.send_response(200)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(f'{self.requestline}\n'.encode())
-            for header, value in self.headers.items():
-                self.wfile.write(f"{header}: {value}\n".encode())
+            with open(value, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                self.wfile.write(bulk_head(size).render(protocol))
+                send_file(self.connection, f)
+            self.served(label, 200, size)
 
 
-    def do_POST(self):
+    def consume_body(self):
         #
-        # Default POST: ignore body, send back the request headers.
+        # Read and drop the request body into one reused buffer, sized by
+        # Content-Length or chunked. Returns the body bytes, or None if
+        # the framing is invalid.
         #
-        self.send_response(200)
-        self.send_header("Content-type", "text/plain")
-        self.end_headers()
-        self.wfile.write(f'{self.requestline}\n'.encode())
-        for header, value in self.headers.items():
-            self.wfile.write(f"{header}: {value}\n".encode())
+        buffer = bytearray(bulk_chunk)
+        view = memoryview(buffer)
+        received = 0
+        if "chunked" in (self.headers.get("Transfer-Encoding") or "").lower():
+            while True:
+                try:
+                    size = int(self.rfile.readline(1024).split(b";")[0].strip(), 16)
+                except ValueError:
+                    return None
+                if size == 0:
+                    while self.rfile.readline(1024) not in [b"\r\n", b"\n", b""]:
+                        pass
+                    return received
+                if read_into(self.rfile, view, size) != size:
+                    return None
+                received += size
+                self.rfile.readline(1024)
+        length = self.headers.get("Content-Length") or "0"
+        if not length.isdigit():
+            return None
+        length = int(length)
+        if read_into(self.rfile, view, length) != length:
+            return None
+        return length
+
+
+
+def read_into(rfile, view, count):
+    #
+    # Read count bytes from a file through a buffer, returning the bytes
+    # read, fewer if the stream ended.
+    #
+    received = 0
+    while received < count:
+        n = rfile.readinto(view[:min(count - received, len(view))])
+        if not n:
+            break
+        received += n
+    return received
+
+
+
+def send_file(connection, f):
+    #
+    # Send a file on a socket: with sendfile() in the kernel for plain
+    # sockets, or through one reused buffer under TLS, which sendfile()
+    # cannot encrypt.
+    #
+    if not isinstance(connection, ssl.SSLSocket):
+        connection.sendfile(f)
+        return
+    buffer = bytearray(bulk_chunk)
+    view = memoryview(buffer)
+    while True:
+        n = f.readinto(buffer)
+        if not n:
+            break
+        connection.sendall(view[:n])
 
 
 
@@ -109,19 +731,39 @@ class Catcher:
     #
     #   keyfile: The private key part of the certificate.
     #
+    #   routes_file: optional JSON file of custom routes, see load_routes().
+    #             The route table is built here, once.
+    #
+    #   files_dir: optional directory of the files /file/<name> serves.
+    #
+    #   log_requests: log each request at level 1. Requests are counted
+    #             in self.metrics either way, see Metrics.
+    #
+    #   stats_interval: seconds between summaries of the metrics in the
+    #             log, or None for no summaries.
+    #
     def __init__(self, host="localhost", port=8443, enable_ssl=True, 
-                 certfile="cert.pem", keyfile="key.pem"):
+                 certfile="cert.pem", keyfile="key.pem", routes_file=None, files_dir=None,
+                 log_requests=True, stats_interval=None):
         self.host = host
         self.port = port
         self.certfile = certfile
         self.keyfile = keyfile
         self.enable_ssl = enable_ssl
         self.server_thread = None
+        self.routes = build_routes(load_routes(routes_file) if routes_file else [])
+        self.files_dir = files_dir
+        self.log_requests = log_requests
+        self.stats_interval = stats_interval
+        self.metrics = Metrics()
+        self.reporter = None
+        self.started = threading.Event()
 
 
     def start(self):
         #
-        # Starts the web service on a separate thread, running forever until killed or shutdown
+        # Starts the web service on a separate thread, running forever until killed or shutdown,
+        # and returns once the socket is bound (or the server has failed to start).
         #
         # This is an extremely small, limited, primitive implementation of a web server.
         # This should not be exposed to the Internet at large or used to serve other content.
@@ -134,6 +776,10 @@ class Catcher:
                 )
                 self.httpd.request_queue_size = 100
                 self.httpd.timeout = 3
+                self.httpd.routes = self.routes
+                self.httpd.files_dir = self.files_dir
+                self.httpd.metrics = self.metrics
+                self.httpd.log_requests = self.log_requests
                 if self.enable_ssl:
                     context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
                     context.load_cert_chain(self.certfile, self.keyfile)
@@ -144,6 +790,7 @@ class Catcher:
                     protocol = "https"
                 else:
                     protocol = "http"
+                self.started.set()
                 self.httpd.serve_forever()
             except PermissionError as e:
                 Logger.log(0, f"PermissionError:{e} - try using a port number > 1024")
@@ -151,21 +798,395 @@ class Catcher:
             except Exception as e:
                 Logger.log(0, f"Exception:{e}")
                 sys.exit(1)
+            finally:
+                self.started.set()
             Logger.log(1, "Exiting server thread")
+        self.started.clear()
         self.server_thread = threading.Thread(target=go)
         self.server_thread.start()
+        self.started.wait()
+        self.reporter = start_reporter(self.metrics, self.stats_interval)
 
 
     def shutdown(self):
         #
         # Send a shutdown request to the server
         #
+        if self.reporter is not None:
+            self.reporter.set()
         if self.server_thread is not None:
             Logger.log(1, "Shutting down the server")
             self.httpd.shutdown()
 
 
 
+class AsyncCatcher:
+    #
+    # asyncio backend of the Catcher web server, with the same routes and
+    # echo behaviour. All connections are served by one event loop on one
+    # thread, so thousands of concurrent connections cost no more than
+    # their sockets. Connections are kept alive (HTTP/1.1, or HTTP/1.0
+    # with "Connection: keep-alive") and pipelined requests are answered
+    # in order.
+    #
+    # Parameters:
+    # ----------
+    #   host, port, enable_ssl, certfile, keyfile, routes_file, files_dir,
+    #   log_requests, stats_interval: as for Catcher. Port 0 listens on a
+    #             free port, set in self.port by start().
+    #
+    #   keepalive_timeout: seconds an idle connection is kept open.
+    #
+    #   backlog: listen queue length, capped by the OS (somaxconn).
+    #
+    #   max_header_size: the largest request line and headers accepted.
+    #
+    def __init__(self, host="localhost", port=8443, enable_ssl=True,
+                 certfile="cert.pem", keyfile="key.pem", routes_file=None, files_dir=None,
+                 log_requests=True, stats_interval=None,
+                 keepalive_timeout=30, backlog=4096, max_header_size=65536):
+        self.host = host
+        self.port = port
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.enable_ssl = enable_ssl
+        self.keepalive_timeout = keepalive_timeout
+        self.backlog = backlog
+        self.max_header_size = max_header_size
+        self.routes = build_routes(load_routes(routes_file) if routes_file else [])
+        self.files_dir = files_dir
+        self.log_requests = log_requests
+        self.stats_interval = stats_interval
+        self.metrics = Metrics()
+        self.counters = None
+        self.reporter = None
+        self.server_thread = None
+        self.loop = None
+        self.stopping = None
+        self.connections = set()
+        self.started = threading.Event()
+
+
+    def start(self):
+        #
+        # Starts the event loop on a separate thread, and returns once the
+        # server is listening (or has failed to start).
+        #
+        # This is an extremely small, limited, primitive implementation of a web server.
+        # This should not be exposed to the Internet at large or used to serve other content.
+        #
+        def go():
+            self.loop = asyncio.new_event_loop()
+            try:
+                self.loop.run_until_complete(self.serve())
+            except PermissionError as e:
+                Logger.log(0, f"PermissionError:{e} - try using a port number > 1024")
+            except Exception as e:
+                Logger.log(0, f"Exception:{e}")
+            finally:
+                self.started.set()
+                self.loop.close()
+            Logger.log(1, "Exiting server thread")
+        self.started.clear()
+        self.server_thread = threading.Thread(target=go)
+        self.server_thread.start()
+        self.started.wait()
+        self.reporter = start_reporter(self.metrics, self.stats_interval)
+
+
+    async def serve(self):
+        #
+        # Listen until shutdown() is called, then close all connections.
+        #
+        if self.enable_ssl:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.certfile, self.keyfile)
+        else:
+            context = None
+        self.stopping = asyncio.Event()
+        #
+        # All connections are served on this thread, so count into one
+        # Counters.
+        #
+        self.counters = self.metrics.counters()
+        server = await asyncio.start_server(
+            self.handle,
+            self.host,
+            self.port,
+            ssl=context,
+            backlog=self.backlog,
+            limit=self.max_header_size,
+        )
+        self.port = server.sockets[0].getsockname()[1]
+        self.started.set()
+        Logger.log(1, f'AsyncCatcher listening on {self.host}:{self.port}')
+        async with server:
+            await self.stopping.wait()
+            server.close()
+            for task in list(self.connections):
+                task.cancel()
+            if self.connections:
+                await asyncio.wait(list(self.connections))
+        self.metrics.retire(self.counters)
+
+
+    def shutdown(self):
+        #
+        # Stop the server and wait for its thread to exit.
+        #
+        if self.reporter is not None:
+            self.reporter.set()
+        if self.server_thread is not None and self.loop is not None and not self.loop.is_closed():
+            Logger.log(1, "Shutting down the server")
+            self.loop.call_soon_threadsafe(self.stopping.set)
+            self.server_thread.join()
+
+
+    async def handle(self, reader, writer):
+        #
+        # Serve the requests of one connection, in order.
+        #
+        task = asyncio.current_task()
+        self.connections.add(task)
+        self.counters.opened += 1
+        peer = writer.get_extra_info("peername") or ("", 0)
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.keepalive_timeout)
+                except asyncio.LimitOverrunError:
+                    await self.respond(writer, "HTTP/1.0", Response(431, [], b""), False)
+                    self.served(peer, "", "-", "invalid", 431, 0, time.perf_counter())
+                    break
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+
+                started = time.perf_counter()
+                request = parse_request(head)
+                if request is None:
+                    await self.respond(writer, "HTTP/1.0", Response(400, [], b""), False)
+                    self.served(peer, "", "-", "invalid", 400, 0, started)
+                    break
+                requestline, method, path, version, headers = request
+
+                #
+                # The body is read and dropped, so the next request on the
+                # connection starts in the right place.
+                #
+                received = await discard_body(reader, headers)
+                if received is None:
+                    await self.respond(writer, version, Response(400, [], b""), False)
+                    self.served(peer, requestline, method, "invalid", 400, 0, started)
+                    break
+
+                keep_alive = wants_keep_alive(version, headers)
+                bulk = None
+                if (method, path) not in self.routes:
+                    bulk = bulk_route(method, path.split("?", 1)[0], self.files_dir)
+                label = route_label(self.routes, method, path, bulk)
+                if bulk is None:
+                    response = route(self.routes, method, path, requestline, headers)
+                elif bulk[0] == "error":
+                    response = bulk[1]
+                elif bulk[0] == "stats":
+                    response = stats_response(self.metrics)
+                elif bulk[0] == "sink":
+                    response = sink_response(received, time.perf_counter() - started)
+                else:
+                    size = await self.stream(writer, version, bulk, keep_alive)
+                    self.served(peer, requestline, method, label, 200, size, started)
+                    if not keep_alive:
+                        break
+                    continue
+                await self.respond(writer, version, response, keep_alive)
+                self.served(peer, requestline, method, label, response.code, len(response.body), started)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ssl.SSLError):
+            pass
+        except asyncio.CancelledError:
+            #
+            # Closed by shutdown()
+            #
+            pass
+        finally:
+            self.connections.discard(task)
+            self.counters.closed += 1
+            writer.close()
+
+
+    def served(self, peer, requestline, method, label, code, size, started):
+        #
+        # Count a response once sent, and log it if log_requests is set.
+        #
+        self.counters.record(method, label, code, size, time.perf_counter() - started)
+        if self.log_requests:
+            Logger.log(1, f'tc:{len(self.connections)} {peer[0]}:{peer[1]} "{requestline}" {code} {size}')
+
+
+    async def respond(self, writer, version, response, keep_alive):
+        #
+        # Send a Response. drain() only waits while the client is not
+        # reading, so pipelined responses go out back to back.
+        #
+        if not keep_alive:
+            connection = b"close"
+        elif version == "HTTP/1.0":
+            connection = b"keep-alive"
+        else:
+            connection = None
+        writer.write(response.render(b"HTTP/1.1", connection))
+        await writer.drain()
+
+
+
+    async def stream(self, writer, version, bulk, keep_alive):
+        #
+        # Send a bulk response: generated bytes from the shared buffer, or
+        # a file with the event loop's sendfile(), which falls back to
+        # chunked writes under TLS. Returns the body bytes sent.
+        #
+        kind, value = bulk
+        if not keep_alive:
+            connection = b"close"
+        elif version == "HTTP/1.0":
+            connection = b"keep-alive"
+        else:
+            connection = None
+        if kind == "bytes":
+            writer.write(bulk_head(value).render(b"HTTP/1.1", connection))
+            remaining = value
+            while remaining > 0:
+                count = min(remaining, len(bulk_buffer))
+                writer.write(bulk_buffer[:count])
+                remaining -= count
+                await writer.drain()
+            return value
+        with open(value, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            writer.write(bulk_head(size).render(b"HTTP/1.1", connection))
+            await writer.drain()
+            if writer.get_extra_info("ssl_object") is None:
+                await asyncio.get_running_loop().sendfile(writer.transport, f)
+                return size
+            buffer = bytearray(bulk_chunk)
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                #
+                # A copy, as the transport may hold on to the data
+                #
+                writer.write(bytes(buffer[:n]))
+                await writer.drain()
+        return size
+
+
+
+def parse_request(head):
+    #
+    # Parse a request line and headers.
+    #
+    # Returns:
+    # -------
+    #   (requestline, method, path, version, headers) with headers a list
+    #   of (name, value), or None if the request is malformed.
+    #
+    lines = head.decode("latin-1").split("\r\n")
+    requestline = lines[0]
+    words = requestline.split()
+    if len(words) != 3 or not words[2].startswith("HTTP/"):
+        return None
+    method, path, version = words
+    headers = []
+    for line in lines[1:]:
+        if line == "":
+            continue
+        name, separator, value = line.partition(":")
+        if separator == "" or name != name.strip():
+            return None
+        headers.append((name, value.strip()))
+    return requestline, method, path, version, headers
+
+
+
+def header_value(headers, name):
+    #
+    # The value of the first header of a name, case-insensitive, or None.
+    #
+    name = name.lower()
+    for header, value in headers:
+        if header.lower() == name:
+            return value
+    return None
+
+
+
+def wants_keep_alive(version, headers):
+    #
+    # HTTP/1.1 connections persist unless closed, HTTP/1.0 ones only if
+    # asked to (RFC 9112 9.3).
+    #
+    connection = (header_value(headers, "Connection") or "").lower()
+    if version == "HTTP/1.1":
+        return "close" not in connection
+    return "keep-alive" in connection
+
+
+
+async def discard_body(reader, headers):
+    #
+    # Read and drop a request body, sized by Content-Length or chunked,
+    # a chunk at a time. Returns the body bytes, or None if the framing
+    # is invalid: a chunk size that is not hexadecimal digits, or a chunk
+    # size or trailer line longer than the reader's limit.
+    #
+    transfer_encoding = (header_value(headers, "Transfer-Encoding") or "").lower()
+    if transfer_encoding:
+        if transfer_encoding.split(",")[-1].strip() != "chunked":
+            return None
+        received = 0
+        try:
+            while True:
+                size_line = await reader.readuntil(b"\r\n")
+                size_field = size_line.split(b";")[0].strip()
+                #
+                # int() would also take a sign, "0x" or underscores
+                #
+                if not size_field or size_field.strip(b"0123456789abcdefABCDEF"):
+                    return None
+                size = int(size_field, 16)
+                if size == 0:
+                    #
+                    # Trailers, up to the empty line
+                    #
+                    while await reader.readuntil(b"\r\n") != b"\r\n":
+                        pass
+                    return received
+                await discard_bytes(reader, size + 2)
+                received += size
+        except asyncio.LimitOverrunError:
+            return None
+
+    length = header_value(headers, "Content-Length")
+    if length is None:
+        return 0
+    if not length.isdigit():
+        return None
+    await discard_bytes(reader, int(length))
+    return int(length)
+
+
+
+async def discard_bytes(reader, count):
+    while count > 0:
+        data = await reader.read(min(count, bulk_chunk))
+        if not data:
+            raise asyncio.IncompleteReadError(b"", count)
+        count -= len(data)
+
+
+
 #
 # The main() function allows us to call this module from the command line
 # with no additional scripting required. The only parameters are the server
@@ -178,26 +1199,75 @@ def main():
     #
     # Example command line would be:
     # 
-    # python3 -m catcher <server_ip> <server_port>
+    # python3 -m catcher <server_ip> <server_port> [--backend thread|asyncio] [--routes file] [--files dir]
+    #                    [--stats seconds] [--quiet]
     #
     # server_ip: the local IP to listen on.
     # server_port: the port to listen on.
+    # --backend: optional, the thread per connection server (default), or
+    #            the asyncio server for high concurrency and keep-alive.
+    # --routes: optional, a JSON file of custom routes, see load_routes().
+    # --files: optional, the directory of the files /file/<name> serves.
+    # --stats: optional, log a summary of the metrics every so many seconds.
+    # --quiet: optional, do not log each request.
     #
 
     #
-    # Process command line
+    # Process command line, options first
     #
-    if len(sys.argv) < 3:
+    backends = {"thread": Catcher, "asyncio": AsyncCatcher}
+    backend = "thread"
+    routes_file = None
+    files_dir = None
+    stats_interval = None
+    log_requests = True
+    args = []
+    argv = sys.argv[1:]
+    while len(argv) > 0:
+        arg = argv.pop(0)
+        if arg == "--backend":
+            if len(argv) == 0 or argv[0] not in backends:
+                print(f'Error: --backend should be one of {", ".join(backends)}.')
+                sys.exit(1)
+            backend = argv.pop(0)
+        elif arg == "--routes":
+            if len(argv) == 0:
+                print("Error: --routes needs a file.")
+                sys.exit(1)
+            routes_file = argv.pop(0)
+        elif arg == "--files":
+            if len(argv) == 0 or not os.path.isdir(argv[0]):
+                print("Error: --files needs a directory.")
+                sys.exit(1)
+            files_dir = argv.pop(0)
+        elif arg == "--stats":
+            try:
+                stats_interval = float(argv.pop(0))
+            except (IndexError, ValueError):
+                stats_interval = 0
+            if stats_interval <= 0:
+                print("Error: --stats needs a positive number of seconds.")
+                sys.exit(1)
+        elif arg == "--quiet":
+            log_requests = False
+        else:
+            args.append(arg)
+    if len(args) < 2:
         print("Error: not enough arguments. Both the server IP and port must be specified.")
         print("For example: python3 -m catcher 127.0.0.1 8443")
         sys.exit(1)
-    ip = sys.argv[1]
-    port = int(sys.argv[2])
+    ip = args[0]
+    port = int(args[1])
 
     #
     # Execute, looping on input() until Ctrl-C
     #
-    C = Catcher(host=ip, port=port)
+    try:
+        C = backends[backend](host=ip, port=port, routes_file=routes_file, files_dir=files_dir,
+                              log_requests=log_requests, stats_interval=stats_interval)
+    except (OSError, ValueError) as e:
+        print(f'Error: {e}')
+        sys.exit(1)
     C.start()
     while True:
         try:
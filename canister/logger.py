@@ -18,6 +18,7 @@
 
 import datetime
 import sys
+import threading
 
 
 class Logger:
@@ -32,6 +33,12 @@ class Logger:
 	level = 1
 	print_output = True
 
+	#
+	# Serialises entries from concurrently executing tests, so that
+	# entries, callbacks and printed lines are never interleaved.
+	#
+	lock = threading.RLock()
+
 
 	@classmethod
 	def callback(cls, level, text):
@@ -72,10 +79,11 @@ class Logger:
 			date_str = f'{datetime.datetime.now(datetime.UTC)}'
 		if level <= cls.level:
 			entry = f'LOG{level} {date_str}> {text}'
-			cls.logs.append(entry)
-			cls.callback(level, text)
-			if cls.print_output:
-				print(entry)
+			with cls.lock:
+				cls.logs.append(entry)
+				cls.callback(level, text)
+				if cls.print_output:
+					print(entry)
 
 
 	@classmethod
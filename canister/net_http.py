@@ -3,15 +3,229 @@
 #
 # Contains functions for making web requests
 #
+# Connections are kept alive between requests in a pool shared by all
+# threads, one list of idle connections per scheme, host and port, and
+# TLS connections share a single SSL context. Responses are read in full
+# before their connection goes back to the pool, and a connection the
+# server asks to close (HTTP/1.0, or "Connection: close") is closed.
+#
+# Each request is timed by phase, see timed_request().
+#
+# Bulk uploads and downloads for throughput tests are made by
+# timed_transfer(), which streams through fixed buffers rather than
+# holding the body in memory.
+#
 
+import http.client
 import json
+import select
+import socket
 import ssl
+import sys
+import threading
+import time
 import urllib.parse
-import urllib.request
 
 
 
-def request(url, method="GET", headers={}, body=None):
+#
+# TLS validation is disabled as this is usually a requirement for
+# Canister testing. Built once, as building a context loads the CA store.
+#
+ssl_context = ssl._create_unverified_context()
+
+
+#
+# The default User-Agent, as sent by urllib, which earlier versions used.
+#
+user_agent = f'Python-urllib/{sys.version_info[0]}.{sys.version_info[1]}'
+
+
+#
+# Redirects are followed as urllib follows them: 301, 302 and 303 turn a
+# POST into a GET without a body, 307 and 308 are only followed for GET.
+#
+redirect_codes = [301, 302, 303, 307, 308]
+max_redirects = 10
+
+
+#
+# Methods which may be sent again if a kept-alive connection turns out
+# to have been closed by the server (RFC 9110 9.2.2).
+#
+idempotent_methods = ["GET", "HEAD", "PUT", "DELETE", "OPTIONS", "TRACE"]
+
+
+#
+# The phases timed for each request, see timed_request().
+#
+timing_fields = ["dns_ms", "connect_ms", "tls_ms", "ttfb_ms", "total_ms", "bytes"]
+
+
+#
+# Transfers read the response into, and send uploads from, buffers of
+# transfer_chunk bytes. The upload content is one shared pattern buffer.
+#
+transfer_chunk = 1024 * 1024
+transfer_buffer = memoryview(bytes(range(256)) * (transfer_chunk // 256))
+
+
+
+class TimedConnection(http.client.HTTPConnection):
+	#
+	# An http.client connection which times the DNS lookup, the TCP
+	# connect and the TLS handshake of its connect() into setup_timings,
+	# as far as connect() gets. TLS connections use the shared SSL context.
+	#
+
+
+	def __init__(self, host, port, timeout=None, tls=False):
+		super().__init__(host, port, timeout=timeout)
+		self.tls = tls
+		self.setup_timings = None
+
+
+	def connect(self):
+		self.setup_timings = {"dns_ms": None, "connect_ms": None, "tls_ms": None}
+		started = time.perf_counter()
+		addresses = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+		resolved = time.perf_counter()
+		self.setup_timings["dns_ms"] = (resolved - started) * 1000
+
+		#
+		# Try each address in turn, as socket.create_connection() does.
+		#
+		error = None
+		for family, socktype, proto, _, address in addresses:
+			sock = socket.socket(family, socktype, proto)
+			try:
+				sock.settimeout(self.timeout)
+				sock.connect(address)
+			except OSError as e:
+				sock.close()
+				error = e
+				continue
+			error = None
+			break
+		if error is not None:
+			raise error
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		connected = time.perf_counter()
+		self.setup_timings["connect_ms"] = (connected - resolved) * 1000
+
+		if self.tls:
+			try:
+				sock = ssl_context.wrap_socket(sock, server_hostname=self.host)
+			except Exception:
+				sock.close()
+				raise
+			self.setup_timings["tls_ms"] = (time.perf_counter() - connected) * 1000
+		else:
+			self.setup_timings["tls_ms"] = 0.0
+		self.sock = sock
+
+
+
+class ConnectionPool:
+	#
+	# Idle kept-alive connections, by (scheme, host, port). A connection
+	# is used by one request at a time: get() takes it out of the pool and
+	# put() returns it once its response has been read.
+	#
+
+
+	def __init__(self, max_idle=16):
+		#
+		# Parameters:
+		# ----------
+		#
+		# max_idle: the most idle connections kept per scheme, host and
+		#           port. Connections returned beyond that are closed.
+		#
+		self.max_idle = max_idle
+		self.idle = {}
+		self.lock = threading.Lock()
+
+
+	def get(self, scheme, host, port, timeout=None):
+		#
+		# Returns (connection, reused). An idle connection is reused
+		# unless the server has closed it meanwhile, otherwise a new
+		# (not yet connected) connection is returned.
+		#
+		key = (scheme, host, port)
+		while True:
+			with self.lock:
+				connections = self.idle.get(key)
+				if not connections:
+					break
+				connection = connections.pop()
+			if connection_dropped(connection):
+				connection.close()
+				continue
+			connection.timeout = timeout
+			connection.sock.settimeout(timeout)
+			return connection, True
+		return new_connection(scheme, host, port, timeout), False
+
+
+	def put(self, scheme, host, port, connection):
+		#
+		# Return a connection whose response has been read in full.
+		#
+		key = (scheme, host, port)
+		with self.lock:
+			connections = self.idle.setdefault(key, [])
+			if len(connections) < self.max_idle:
+				connections.append(connection)
+				return
+		connection.close()
+
+
+	def clear(self):
+		#
+		# Close all idle connections.
+		#
+		with self.lock:
+			idle = self.idle
+			self.idle = {}
+		for connections in idle.values():
+			for connection in connections:
+				connection.close()
+
+
+
+#
+# The pool shared by all requests.
+#
+pool = ConnectionPool()
+
+
+
+def new_connection(scheme, host, port, timeout=None):
+	#
+	# Create an unconnected connection. It connects on its first request.
+	#
+	return TimedConnection(host, port, timeout=timeout, tls=scheme == "https")
+
+
+
+def connection_dropped(connection):
+	#
+	# An idle connection which is readable has either been closed by the
+	# server or has unexpected data waiting, so cannot be reused.
+	#
+	if connection.sock is None:
+		return True
+	try:
+		readable, _, _ = select.select([connection.sock], [], [], 0)
+	except (OSError, ValueError):
+		return True
+	return len(readable) > 0
+
+
+
+def request(url, method="GET", headers={}, body=None, timeout=None, fresh=False):
 	#
 	# Make a web request. TLS validation is disabled as this is usually
 	# a requirement for Canister testing.
@@ -27,6 +241,13 @@ def request(url, method="GET", headers={}, body=None):
 	#
 	# body: a string to be encoded as the body.
 	#
+	# timeout: seconds to wait for the connection and for each read
+	#          before giving up, or None to wait for the OS TCP timeout.
+	#          A timed out request returns a response_code of None.
+	#
+	# fresh: if True, the request is sent on a new connection, which is
+	#        closed afterwards, rather than on a kept-alive connection.
+	#
 	# Returns:
 	# -------
 	#
@@ -36,44 +257,273 @@ def request(url, method="GET", headers={}, body=None):
 	# response_headers: dictionary
 	# response_body: string
 	#
+	response_code, response_reason, response_headers, response_body, timings = timed_request(
+		url,
+		method=method,
+		headers=headers,
+		body=body,
+		timeout=timeout,
+		fresh=fresh,
+	)
+	return response_code, response_reason, response_headers, response_body
+
+
+
+def timed_request(url, method="GET", headers={}, body=None, timeout=None, fresh=False):
+	#
+	# Make a web request as request() does, timing each phase.
+	#
+	# Returns:
+	# -------
+	#
+	# (response_code, response_reason, response_headers, response_body, timings)
+	# as for request(), with timings a dictionary of:
+	#
+	# dns_ms: the DNS lookup.
+	# connect_ms: the TCP connect.
+	# tls_ms: the TLS handshake, 0 for http.
+	# ttfb_ms: from the start of the request to the first byte of the
+	#          response, including the phases above.
+	# total_ms: from the start of the request to the end of the response.
+	# bytes: the response body bytes received.
+	# reused: True if the request went over a kept-alive connection, in
+	#         which case the connection phases are 0.
+	#
+	# Across redirects the phases and bytes are added up, and ttfb_ms is to
+	# the first byte of the final response. Phases a failed request did not
+	# reach are None.
+	#
+	started = time.perf_counter()
+	timings = {field: None for field in timing_fields}
+	timings["reused"] = None
 	try:
-		if body is None:
-			request = urllib.request.Request(
-				url=url, 
-				method=method,
-				headers=headers,
+		if body is not None:
+			body = json.dumps(body).encode("ascii")
+		for _ in range(max_redirects + 1):
+			response_code, response_reason, response_headers, response_body = send(
+				url,
+				method,
+				headers,
+				body,
+				timeout,
+				fresh,
+				timings,
 			)
-		else:
-			request = urllib.request.Request(
-				url=url, 
-				method=method,
-				headers=headers,
-				data=json.dumps(body).encode("ascii"),
-			)
-		response = urllib.request.urlopen(
-			request,
-			context=ssl._create_unverified_context(),
-		)
-		response_code = response.code
-		response_reason = response.reason
-		response_headers = dict(response.headers)
-		response_body = response.read().decode("utf-8","replace")
-		return response_code, response_reason, response_headers, response_body
-	except urllib.error.HTTPError as he:
-		response_code = he.code
-		response_reason = he.reason
-		response_headers = dict(he.headers)
-		response_body = he.fp.read().decode("utf-8","replace")
-		return response_code, response_reason, response_headers, response_body
-	except urllib.error.URLError as ue:
-		response_code = None
-		response_reason = ue.reason
-		response_headers = {}
-		response_body = ""
-		return response_code, response_reason, response_headers, response_body
+			timings["ttfb_ms"] = (timings.pop("first_byte") - started) * 1000
+			location = None
+			for key, value in response_headers.items():
+				if key.lower() == "location":
+					location = value
+			if response_code not in redirect_codes or location is None:
+				break
+			if response_code not in [301, 302, 303] and method not in ["GET", "HEAD"]:
+				break
+
+			#
+			# Follow the redirect, as a GET without a body
+			#
+			url = urllib.parse.urljoin(url, location)
+			if method != "HEAD":
+				method = "GET"
+			body = None
+			headers = {
+				key: value for key, value in headers.items()
+				if key.lower() not in ["content-length", "content-type"]
+			}
+		timings["total_ms"] = (time.perf_counter() - started) * 1000
+		return response_code, response_reason, response_headers, response_body.decode("utf-8","replace"), timings
 	except Exception as e:
+		timings.pop("first_byte", None)
+		timings["total_ms"] = (time.perf_counter() - started) * 1000
 		response_code = None
 		response_reason = f'{e}'
 		response_headers = {}
 		response_body = ""
-		return response_code, response_reason, response_headers, response_body
+		return response_code, response_reason, response_headers, response_body, timings
+
+
+
+def send(url, method, headers, body, timeout, fresh, timings):
+	#
+	# Send a single request and read its response, over a pooled
+	# connection unless fresh is set. The connection phases and bytes are
+	# added to timings, and the time of the first response byte is set in
+	# timings["first_byte"].
+	#
+	# Returns:
+	# -------
+	#
+	# (response_code, response_reason, response_headers, response_body)
+	# with the body as bytes.
+	#
+	scheme, host, port, path = split_url(url)
+	send_headers = request_headers(url, headers, "application/x-www-form-urlencoded" if body is not None else None, fresh)
+
+	#
+	# A kept-alive connection closed by the server between the check
+	# in get() and the request is replaced by a new one, for the methods
+	# which can safely be sent twice.
+	#
+	while True:
+		if fresh:
+			connection, reused = new_connection(scheme, host, port, timeout), False
+		else:
+			connection, reused = pool.get(scheme, host, port, timeout)
+		connection.setup_timings = None
+		try:
+			connection.request(method, path, body=body, headers=send_headers)
+			response = connection.getresponse()
+			timings["first_byte"] = time.perf_counter()
+			response_body = response.read()
+		except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+			add_setup_timings(timings, connection.setup_timings, reused)
+			connection.close()
+			if reused and method in idempotent_methods:
+				continue
+			raise
+		except Exception:
+			add_setup_timings(timings, connection.setup_timings, reused)
+			connection.close()
+			raise
+		break
+	add_setup_timings(timings, connection.setup_timings, reused)
+	timings["bytes"] = (timings["bytes"] or 0) + len(response_body)
+
+	if fresh or response.will_close:
+		connection.close()
+	else:
+		pool.put(scheme, host, port, connection)
+	return response.status, response.reason, dict(response.headers), response_body
+
+
+
+def split_url(url):
+	#
+	# Returns (scheme, host, port, path) of an http or https URL, the path
+	# including any query.
+	#
+	parts = urllib.parse.urlsplit(url)
+	scheme = parts.scheme
+	if scheme not in ["http", "https"]:
+		raise ValueError(f'unsupported URL scheme: {scheme}')
+	host = parts.hostname
+	port = parts.port or (443 if scheme == "https" else 80)
+	path = parts.path or "/"
+	if parts.query:
+		path += f'?{parts.query}'
+	return scheme, host, port, path
+
+
+
+def request_headers(url, headers, content_type, fresh):
+	#
+	# Headers as urllib sent them: the Host as in the URL, urllib's
+	# User-Agent and the given Content-Type for bodies, unless set by the
+	# test.
+	#
+	send_headers = dict(headers)
+	names = [key.lower() for key in send_headers]
+	if "host" not in names:
+		send_headers["Host"] = urllib.parse.urlsplit(url).netloc.rsplit("@", 1)[-1]
+	if "user-agent" not in names:
+		send_headers["User-Agent"] = user_agent
+	if content_type is not None and "content-type" not in names:
+		send_headers["Content-Type"] = content_type
+	if fresh:
+		send_headers["Connection"] = "close"
+	return send_headers
+
+
+
+def timed_transfer(url, method="GET", headers={}, upload=0, limit=None, timeout=None):
+	#
+	# Make a bulk transfer, timed by phase as timed_request() does. The
+	# transfer has its own connection, closed afterwards, so that parallel
+	# transfers are parallel TCP streams. Redirects are not followed.
+	#
+	# Parameters:
+	# ----------
+	#
+	# url, method, headers, timeout: as for request().
+	#
+	# upload: bytes of generated content sent as the request body, 0 for
+	#         none.
+	#
+	# limit: the most response body bytes read, the rest of the body is
+	#        dropped with the connection. None reads the whole body.
+	#
+	# Returns:
+	# -------
+	#
+	# (response_code, response_reason, timings), timings as for
+	# timed_request(), with bytes the response body bytes read and
+	# bytes_sent the request body bytes sent. The body is not kept.
+	#
+	started = time.perf_counter()
+	timings = {field: None for field in timing_fields}
+	timings["reused"] = None
+	timings["bytes_sent"] = 0
+	connection = None
+	try:
+		scheme, host, port, path = split_url(url)
+		send_headers = request_headers(url, headers, "application/octet-stream" if upload else None, True)
+		body = None
+		if upload:
+			send_headers["Content-Length"] = str(upload)
+			body = upload_chunks(upload, timings)
+		connection = new_connection(scheme, host, port, timeout)
+		try:
+			connection.request(method, path, body=body, headers=send_headers)
+			response = connection.getresponse()
+			timings["ttfb_ms"] = (time.perf_counter() - started) * 1000
+
+			#
+			# The body is read into one buffer, overwritten by each read
+			#
+			view = memoryview(bytearray(transfer_chunk))
+			received = 0
+			while limit is None or received < limit:
+				count = response.readinto(view if limit is None else view[:min(limit - received, transfer_chunk)])
+				if not count:
+					break
+				received += count
+			timings["bytes"] = received
+		finally:
+			add_setup_timings(timings, connection.setup_timings, False)
+		timings["total_ms"] = (time.perf_counter() - started) * 1000
+		return response.status, response.reason, timings
+	except Exception as e:
+		timings["total_ms"] = (time.perf_counter() - started) * 1000
+		return None, f'{e}', timings
+	finally:
+		if connection is not None:
+			connection.close()
+
+
+
+def upload_chunks(size, timings):
+	#
+	# Yield size bytes of the shared upload buffer, counting them into
+	# timings["bytes_sent"] as they are taken to be sent.
+	#
+	remaining = size
+	while remaining > 0:
+		count = min(remaining, transfer_chunk)
+		timings["bytes_sent"] += count
+		yield transfer_buffer[:count]
+		remaining -= count
+
+
+
+def add_setup_timings(timings, setup_timings, reused):
+	#
+	# Add the connection phases of one connection to timings. A reused
+	# connection adds 0, a phase the connection did not reach adds nothing.
+	#
+	if setup_timings is None and not reused:
+		return
+	for field in ["dns_ms", "connect_ms", "tls_ms"]:
+		value = 0.0 if setup_timings is None else setup_timings[field]
+		if value is not None:
+			timings[field] = (timings[field] or 0.0) + value
+	timings["reused"] = reused if timings["reused"] is None else timings["reused"] and reused
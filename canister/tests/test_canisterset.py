@@ -4,10 +4,14 @@
 # Tests the Canister set class.
 #
 
+import http.server
 import os
+import socket
+import threading
+import time
 import unittest
 
-from canisterset import CanisterSet, DEFAULT
+from canisterset import CanisterSet, DEFAULT, LOCAL, latency_summary, latency_histogram
 from logger import Logger
 Logger.print_output = False
 
@@ -20,6 +24,25 @@ Logger.print_output = False
 TARGET = os.environ.get("CANISTER_TEST_TARGET", "127.0.0.1")
 
 
+def blackhole_test(name, port):
+    #
+    # A test against a local port which accepts connections but never
+    # answers, as a firewall silently dropping the traffic would.
+    #
+    return {
+        "name": name,
+        "feature": "Internet Firewall",
+        "description": "Blackholed site",
+        "remediation": "None",
+        "method": "GET",
+        "protocol": "http",
+        "host": "127.0.0.1",
+        "port": port,
+        "path": "/",
+        "success_criteria": [{"field":"response_code","op":"is","value":403}],
+    }
+
+
 class TestSet(unittest.TestCase):
     #
     # Set tests.
@@ -34,6 +57,7 @@ class TestSet(unittest.TestCase):
         self.assertEqual(len(S), 0)
         self.assertEqual(len(S.tests), 0)
         self.assertEqual(S.target, "127.0.0.1")
+        self.assertRaises(ValueError, CanisterSet, workers=0)
 
 
     def test_load(self):
@@ -51,6 +75,171 @@ class TestSet(unittest.TestCase):
         errors = S.load(DEFAULT)
         self.assertEqual(len(errors), 0)
         self.assertTrue(len(S) > 2)
+        #
+        # Local
+        #
+        S = CanisterSet()
+        errors = S.load(LOCAL)
+        self.assertEqual(len(errors), 0)
+        self.assertTrue(all(T.host == S.target for T in S))
+
+
+    def test_execute_concurrent(self):
+        #
+        # Blackholed tests time out together rather than one after another,
+        # and keep their load order.
+        #
+        blackhole = socket.socket()
+        blackhole.bind(("127.0.0.1", 0))
+        blackhole.listen(16)
+        port = blackhole.getsockname()[1]
+        try:
+            S = CanisterSet(workers=4, timeout=1)
+            names = [f'Blackhole {i}' for i in range(4)]
+            errors = S.load([blackhole_test(name, port) for name in names])
+            self.assertEqual(len(errors), 0)
+            started = time.monotonic()
+            S.execute()
+            self.assertLess(time.monotonic() - started, 3)
+            self.assertEqual([T.name for T in S], names)
+            results = S.results()
+            self.assertEqual(results["failed"], 4)
+            self.assertEqual(results["unexecuted"], 0)
+            for T in S:
+                self.assertTrue(T.reasons[-1].startswith("No response"))
+
+            #
+            # The per-test timeout overrides the set's timeout.
+            #
+            test = blackhole_test("Short", port)
+            test["timeout"] = 0.2
+            S = CanisterSet(workers=1, timeout=30)
+            S.load([test])
+            started = time.monotonic()
+            S.execute()
+            self.assertLess(time.monotonic() - started, 2)
+            self.assertEqual(S.results()["failed"], 1)
+        finally:
+            blackhole.close()
+
+
+    def test_execute_global_timeout(self):
+        #
+        # Tests unfinished at the global timeout are left unexecuted,
+        # whether they were running or still queued.
+        #
+        blackhole = socket.socket()
+        blackhole.bind(("127.0.0.1", 0))
+        blackhole.listen(16)
+        port = blackhole.getsockname()[1]
+        try:
+            S = CanisterSet(workers=1, timeout=30, global_timeout=0.5)
+            S.load([blackhole_test(f'Blackhole {i}', port) for i in range(3)])
+            started = time.monotonic()
+            S.execute()
+            self.assertLess(time.monotonic() - started, 2)
+            time.sleep(0.5)
+            results = S.results()
+            self.assertEqual(results["unexecuted"], 3)
+            self.assertEqual(results["total"], 3)
+            self.assertEqual(S.tests[2].reasons, ["Global timeout reached before the test started"])
+        finally:
+            blackhole.close()
+
+
+    def test_run_load(self):
+        #
+        # Replay against a local server, at a rate then a concurrency.
+        #
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, f, *args):
+                pass
+            def do_GET(self):
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(b"ok")
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            test = blackhole_test("Local", server.server_address[1])
+            test["success_criteria"] = [{"field":"response_code","op":"is","value":200}]
+            S = CanisterSet(timeout=5)
+            S.load([test, dict(test, name="Local 2")])
+            self.assertRaises(ValueError, S.run_load)
+            self.assertRaises(ValueError, S.run_load, rate=10, concurrency=2)
+
+            results = S.run_load(rate=40, duration=1)
+            self.assertEqual(results["requests"], 40)
+            self.assertEqual(results["succeeded"], 40)
+            self.assertEqual(results["codes"], {200: 40})
+            self.assertEqual(results["tests"]["Local"]["requests"], 20)
+            self.assertGreater(results["achieved_rps"], 20)
+            self.assertEqual(sum(count for bound, count in results["histogram"]), 40)
+            self.assertLessEqual(results["latency_ms"]["median"], results["latency_ms"]["max"])
+
+            results = S.run_load(concurrency=2, duration=0.5)
+            self.assertGreater(results["requests"], 2)
+            self.assertEqual(results["failed"], 0)
+            self.assertIsNone(results["offered_rps"])
+            #
+            # Test state is left alone
+            #
+            self.assertFalse(S.tests[0].executed)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+    def test_run_load_limits(self):
+        #
+        # Invalid parameters are refused, and requests still queued at the
+        # end of a run against a slow target are not sent.
+        #
+        blackhole = socket.socket()
+        blackhole.bind(("127.0.0.1", 0))
+        blackhole.listen(64)
+        port = blackhole.getsockname()[1]
+        try:
+            S = CanisterSet(timeout=1)
+            S.load([blackhole_test("Blackhole", port)])
+            for params in [
+                {"rate": 0},
+                {"rate": -5},
+                {"concurrency": 0},
+                {"concurrency": 1.5},
+                {"rate": 10, "duration": 0},
+                {"concurrency": 2, "duration": -1},
+            ]:
+                self.assertRaises(ValueError, S.run_load, **params)
+
+            started = time.monotonic()
+            results = S.run_load(rate=50, duration=0.5, workers=2)
+            self.assertLess(time.monotonic() - started, 2.5)
+            self.assertEqual(results["requests"], 2)
+            self.assertEqual(results["not_sent"], 23)
+
+            #
+            # A test's own timeout applies in load mode too.
+            #
+            S = CanisterSet(timeout=10)
+            S.load([dict(blackhole_test("Blackhole", port), timeout=0.3)])
+            started = time.monotonic()
+            results = S.run_load(concurrency=1, duration=0.1)
+            self.assertLess(time.monotonic() - started, 2)
+            self.assertEqual(results["requests"], 1)
+        finally:
+            blackhole.close()
+
+
+    def test_latency_summary(self):
+        self.assertIsNone(latency_summary([]))
+        summary = latency_summary([float(i) for i in range(100, 0, -1)])
+        self.assertEqual(summary, {"min": 1.0, "median": 50.5, "p95": 95.0, "p99": 99.0, "max": 100.0})
+        histogram = latency_histogram([0.5, 1.0, 1.5, 20000.0])
+        self.assertEqual(histogram[0], (1, 2))
+        self.assertEqual(histogram[1], (2, 1))
+        self.assertEqual(histogram[-1], (None, 1))
 
 
     def test_execute(self):
@@ -6,7 +6,8 @@
 
 import unittest
 
-from canistertest import CanisterTest, mandatory_parameters, supported_methods, supported_protocols, evaluate
+from canistertest import CanisterTest, mandatory_parameters, supported_methods, supported_protocols, evaluate, timing_stats, Criterion, result_fields
+from catcher import AsyncCatcher
 from logger import Logger
 Logger.print_output = False
 
@@ -120,6 +121,71 @@ class TestCanisterTest(unittest.TestCase):
         params["success_criteria"] = [{"field": "response_code","op":"isX","value":403}]
         self.assertRaises(ValueError, CanisterTest, params) 
 
+        #
+        # Values which do not suit the op
+        #
+        for value in ["fast", [1], [1, "2"], [5, 1]]:
+            op = "between" if type(value) == list else "lt"
+            params["success_criteria"] = [{"field": "ttfb_ms","op":op,"value":value}]
+            self.assertRaises(ValueError, CanisterTest, params)
+
+        #
+        # Compiled at load
+        #
+        params["success_criteria"] = [{"field": "ttfb_ms","op":"between","value":[10, 200]}]
+        T = CanisterTest(params)
+        self.assertEqual(len(T.criteria), 1)
+        self.assertEqual(T.criteria[0].op, "between")
+
+
+    def test_timeout(self):
+        params = {X:"test" for X in mandatory_parameters}
+        params["protocol"] = supported_protocols[0]
+        params["method"] = supported_methods[0]
+        params["success_criteria"] = [{"field":"response_code","op":"is","value":403}]
+        params["timeout"] = 2.5
+        T = CanisterTest(params)
+        self.assertEqual(T.optional_parameters["timeout"], 2.5)
+        for timeout in [0, -1, "10"]:
+            params["timeout"] = timeout
+            self.assertRaises(ValueError, CanisterTest, params)
+
+
+    def test_repeat(self):
+        params = {X:"test" for X in mandatory_parameters}
+        params["protocol"] = supported_protocols[0]
+        params["method"] = supported_methods[0]
+        params["success_criteria"] = [{"field":"response_code","op":"is","value":403}]
+        params["repeat"] = 3
+        T = CanisterTest(params)
+        self.assertEqual(T.optional_parameters["repeat"], 3)
+        self.assertIsNone(T.timings)
+        for repeat in [0, 1.5, "3"]:
+            params["repeat"] = repeat
+            self.assertRaises(ValueError, CanisterTest, params)
+
+
+    def test_timing_stats(self):
+        runs = [{"dns_ms": None, "connect_ms": None, "tls_ms": None, "ttfb_ms": None, "total_ms": float(i), "bytes": None}
+                for i in range(20, 0, -1)]
+        stats = timing_stats(runs)
+        self.assertIsNone(stats["dns_ms"])
+        self.assertEqual(stats["total_ms"], {"min": 1.0, "median": 10.5, "p95": 19.0})
+        stats = timing_stats(runs[:1])
+        self.assertEqual(stats["total_ms"], {"min": 20.0, "median": 20.0, "p95": 20.0})
+
+
+    def test_fresh_connection(self):
+        params = {X:"test" for X in mandatory_parameters}
+        params["protocol"] = supported_protocols[0]
+        params["method"] = supported_methods[0]
+        params["success_criteria"] = [{"field":"response_code","op":"is","value":403}]
+        params["fresh_connection"] = True
+        T = CanisterTest(params)
+        self.assertTrue(T.optional_parameters["fresh_connection"])
+        params["fresh_connection"] = "yes"
+        self.assertRaises(TypeError, CanisterTest, params)
+
 
     def test_execution(self):
         #
@@ -164,3 +230,120 @@ class TestCanisterTest(unittest.TestCase):
         result = {"response_code":403}
         result, reasons = evaluate(result, sc)
         self.assertTrue(result)
+
+
+    def test_numeric_criteria(self):
+        timings = {"dns_ms": 1, "connect_ms": 1, "tls_ms": 0, "ttfb_ms": 40.0, "total_ms": 80.0, "bytes": 1000000}
+        results = result_fields(200, timings)
+        self.assertEqual(results["response_time_ms"], 80.0)
+        self.assertEqual(results["bytes_received"], 1000000)
+        self.assertAlmostEqual(results["throughput_mbps"], 100.0)
+
+        passing = [
+            {"field":"response_code","op":"is","value":200},
+            {"field":"response_time_ms","op":"lt","value":100},
+            {"field":"ttfb_ms","op":"le","value":40},
+            {"field":"throughput_mbps","op":"gt","value":50},
+            {"field":"bytes_received","op":"ge","value":1000000},
+            {"field":"ttfb_ms","op":"between","value":[40, 50]},
+        ]
+        result, reasons = evaluate(results, [Criterion(sc) for sc in passing])
+        self.assertTrue(result)
+        self.assertEqual(len(reasons), len(passing))
+
+        for sc in [
+            {"field":"response_time_ms","op":"lt","value":80},
+            {"field":"ttfb_ms","op":"gt","value":40},
+            {"field":"ttfb_ms","op":"between","value":[0, 39.9]},
+        ]:
+            result, reasons = evaluate(results, passing + [sc])
+            self.assertFalse(result)
+
+        #
+        # A phase the request did not reach fails
+        #
+        timings = {"dns_ms": None, "connect_ms": None, "tls_ms": None, "ttfb_ms": None, "total_ms": 3.0, "bytes": None}
+        result, reasons = evaluate(result_fields(None, timings), [{"field":"ttfb_ms","op":"lt","value":100}])
+        self.assertFalse(result)
+        self.assertEqual(reasons, ["No ttfb_ms in result"])
+
+
+
+class TestThroughput(unittest.TestCase):
+    #
+    # Throughput tests against a local Catcher.
+    #
+
+
+    @classmethod
+    def setUpClass(cls):
+        cls.service = AsyncCatcher(host="127.0.0.1", port=0)
+        cls.service.start()
+
+
+    def throughput_test(self, **params):
+        test = {
+            "name": "Throughput",
+            "ttype": "throughput",
+            "feature": "Performance",
+            "description": "Bandwidth through inspection",
+            "remediation": "Check the inspection capacity.",
+            "method": "GET",
+            "protocol": "https",
+            "host": "127.0.0.1",
+            "port": self.service.port,
+            "path": "/bytes/4m",
+            "success_criteria": [
+                {"field":"response_code","op":"is","value":200},
+                {"field":"throughput_mbps","op":"gt","value":0},
+            ],
+        }
+        test.update(params)
+        return CanisterTest(test)
+
+
+    def test_parameters(self):
+        for params in [
+            {"ttype": "ftp"},
+            {"direction": "sideways"},
+            {"size": 0},
+            {"streams": 0},
+            {"direction": "upload", "method": "POST"},
+            {"direction": "upload", "size": 1000},
+        ]:
+            self.assertRaises(ValueError, self.throughput_test, **params)
+
+
+    def test_download(self):
+        T = self.throughput_test(streams=3)
+        T.execute(timeout=10)
+        self.assertTrue(T.success, T.reasons)
+        self.assertEqual(T.timings[0]["bytes"], 3 * 4 * 1024 * 1024)
+        self.assertEqual(T.timings[0]["streams"], 3)
+        #
+        # A size limits the bytes read
+        #
+        T = self.throughput_test(path="/bytes/100m", size=1000000,
+                                 success_criteria=[{"field":"bytes_received","op":"is","value":1000000}])
+        T.execute(timeout=10)
+        self.assertTrue(T.success, T.reasons)
+
+
+    def test_upload(self):
+        T = self.throughput_test(path="/sink", method="POST", direction="upload", size=5 * 1024 * 1024 + 1, streams=2,
+                                 success_criteria=[{"field":"bytes_sent","op":"is","value":2 * (5 * 1024 * 1024 + 1)}])
+        T.execute(timeout=10)
+        self.assertTrue(T.success, T.reasons)
+        self.assertGreater(result_fields(200, T.timings[0])["throughput_mbps"], 0)
+
+
+    def test_no_response(self):
+        T = self.throughput_test(port=1)
+        T.execute(timeout=2)
+        self.assertFalse(T.success)
+        self.assertTrue(any(reason.startswith("No response") for reason in T.reasons))
+
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.service.shutdown()
@@ -4,11 +4,17 @@
 # Tests the Catcher web service.
 #
 
+import http.client
+import json
+import os
+import socket
 import ssl
+import tempfile
+import time
 import unittest
 
 import net_http
-from catcher import Catcher
+from catcher import Catcher, AsyncCatcher, build_routes, load_routes, route
 from logger import Logger
 Logger.print_output = False
 
@@ -44,6 +50,10 @@ class TestCatcherContent(unittest.TestCase):
         code, reason, headers, body = net_http.request("https://127.0.0.1:8443/eicar.exe")
         self.assertEqual(code, 200)
         self.assertTrue("EICAR-STANDARD-ANTIVIRUS-TEST-FILE" in body)
+        #
+        # Only the payload, without the echo of the default route
+        #
+        self.assertFalse("HTTP" in body)
 
 
     @classmethod
@@ -53,3 +63,333 @@ class TestCatcherContent(unittest.TestCase):
         # Shut down the server after tests.
         #
         cls.http_service.shutdown()
+
+
+
+class TestAsyncCatcherContent(unittest.TestCase):
+    #
+    # Class to run the asyncio backend tests.
+    #
+
+
+    @classmethod
+    def setUpClass(cls):
+        #
+        # Listen on a free port, over TLS and in the clear.
+        #
+        cls.https_service = AsyncCatcher(host="127.0.0.1", port=0)
+        cls.https_service.start()
+        cls.http_service = AsyncCatcher(host="127.0.0.1", port=0, enable_ssl=False)
+        cls.http_service.start()
+        cls.url = f'https://127.0.0.1:{cls.https_service.port}'
+
+
+    def test_get(self):
+        code, reason, headers, body = net_http.request(f'{self.url}/')
+        self.assertEqual(code, 200)
+        self.assertTrue(body.startswith("GET / HTTP/1.1\n"))
+
+    def test_eicar(self):
+        code, reason, headers, body = net_http.request(f'{self.url}/eicar.exe')
+        self.assertEqual(code, 200)
+        self.assertTrue(body.startswith("X5O!P%@AP"))
+        self.assertTrue("EICAR-STANDARD-ANTIVIRUS-TEST-FILE" in body)
+        self.assertFalse("HTTP" in body)
+
+    def test_post(self):
+        code, reason, headers, body = net_http.request(f'{self.url}/jdbcset', method="POST", body="x" * 100000)
+        self.assertEqual(code, 200)
+        self.assertTrue(body.startswith("POST /jdbcset HTTP/1.1\n"))
+
+
+    def test_keep_alive(self):
+        #
+        # The second request reuses the connection.
+        #
+        net_http.request(f'{self.url}/')
+        code, reason, headers, body, timings = net_http.timed_request(f'{self.url}/')
+        self.assertEqual(code, 200)
+        self.assertTrue(timings["reused"])
+
+
+    def test_pipelining(self):
+        #
+        # Pipelined requests, one with a chunked body, are answered in order.
+        #
+        with socket.create_connection(("127.0.0.1", self.http_service.port)) as s:
+            s.sendall(
+                b"GET /first HTTP/1.1\r\nHost: x\r\n\r\n"
+                b"POST /second HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nabc\r\n0\r\n\r\n"
+                b"GET /third HTTP/1.0\r\nHost: x\r\n\r\n"
+            )
+            data = b""
+            while True:
+                chunk = s.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        self.assertEqual(data.count(b"HTTP/1.1 200 OK"), 3)
+        self.assertLess(data.index(b"GET /first"), data.index(b"POST /second"))
+        self.assertLess(data.index(b"POST /second"), data.index(b"GET /third"))
+
+
+    def test_concurrent_connections(self):
+        #
+        # Many open connections are served by the one event loop.
+        #
+        sockets = [socket.create_connection(("127.0.0.1", self.http_service.port)) for _ in range(500)]
+        try:
+            for s in sockets:
+                s.sendall(b"GET / HTTP/1.1\r\nHost: x\r\n\r\n")
+            for s in sockets:
+                self.assertTrue(s.recv(65536).startswith(b"HTTP/1.1 200 OK"))
+        finally:
+            for s in sockets:
+                s.close()
+
+
+    def test_bad_request(self):
+        with socket.create_connection(("127.0.0.1", self.http_service.port)) as s:
+            s.sendall(b"NONSENSE\r\n\r\n")
+            self.assertTrue(s.recv(65536).startswith(b"HTTP/1.1 400"))
+
+
+    def test_bad_chunks(self):
+        #
+        # A negative chunk size, and a chunk size line longer than the
+        # header limit, are refused with a 400.
+        #
+        for chunk in [b"-5\r\nabcde\r\n0\r\n\r\n", b"1" * 70000 + b"\r\n"]:
+            with socket.create_connection(("127.0.0.1", self.http_service.port)) as s:
+                s.sendall(b"POST / HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\n" + chunk)
+                self.assertTrue(s.recv(65536).startswith(b"HTTP/1.1 400"))
+
+
+    @classmethod
+    def tearDownClass(cls):
+        net_http.pool.clear()
+        cls.https_service.shutdown()
+        cls.http_service.shutdown()
+
+
+
+class TestRoutes(unittest.TestCase):
+    #
+    # Route table and custom routes.
+    #
+
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.directory.name, "sample.bin"), "wb") as f:
+            f.write(b"\x00sample\xff")
+        self.routes_file = os.path.join(self.directory.name, "routes.json")
+        with open(self.routes_file, "w") as f:
+            json.dump([
+                {"path": "/sample.bin", "file": "sample.bin"},
+                {"method": "POST", "path": "/upload", "status": 403, "headers": {"Content-Type": "text/plain"},
+                 "body": "Blocked"},
+                {"path": "/eicar.exe", "body_base64": "UmVwbGFjZWQ="},
+            ], f)
+
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+    def test_table(self):
+        routes = build_routes(load_routes(self.routes_file))
+        response = route(routes, "GET", "/sample.bin", "GET /sample.bin HTTP/1.1", [])
+        self.assertEqual(response.body, b"\x00sample\xff")
+        self.assertIs(route(routes, "GET", "/sample.bin", "", []), response)
+        response = route(routes, "POST", "/upload", "POST /upload HTTP/1.1", [])
+        self.assertEqual(response.code, 403)
+        self.assertTrue(response.render(b"HTTP/1.1").startswith(b"HTTP/1.1 403 Forbidden\r\n"))
+        self.assertTrue(response.render(b"HTTP/1.1").endswith(b"\r\n\r\nBlocked"))
+        #
+        # Custom routes replace built-in ones, others are kept
+        #
+        self.assertEqual(route(routes, "GET", "/eicar.exe", "", []).body, b"Replaced")
+        self.assertEqual(route(routes, "GET", "/eicar.zip", "", []).body[:2], b"PK")
+        #
+        # Echo and unsupported methods
+        #
+        response = route(routes, "GET", "/other", "GET /other HTTP/1.1", [("Host", "x")])
+        self.assertEqual(response.body, b"GET /other HTTP/1.1\nHost: x\n")
+        self.assertEqual(route(routes, "PUT", "/", "PUT / HTTP/1.1", []).code, 501)
+
+
+    def test_invalid(self):
+        for invalid in [
+            {"dict": "not a list"},
+            [{"path": "no-slash", "body": ""}],
+            [{"path": "/x", "method": "PUT", "body": ""}],
+            [{"path": "/x", "status": 999, "body": ""}],
+            [{"path": "/x"}],
+            [{"path": "/x", "body": "", "file": "sample.bin"}],
+            [{"path": "/x", "file": "missing.bin"}],
+        ]:
+            with open(self.routes_file, "w") as f:
+                json.dump(invalid, f)
+            self.assertRaises(ValueError, load_routes, self.routes_file)
+            self.assertRaises(ValueError, AsyncCatcher, routes_file=self.routes_file)
+
+
+    def test_serve(self):
+        #
+        # Custom routes are served
+        #
+        service = AsyncCatcher(host="127.0.0.1", port=0, enable_ssl=False, routes_file=self.routes_file)
+        service.start()
+        try:
+            code, reason, headers, body = net_http.request(f'http://127.0.0.1:{service.port}/upload', method="POST", body="x")
+            self.assertEqual(code, 403)
+            self.assertEqual(body, "Blocked")
+        finally:
+            service.shutdown()
+
+
+
+class TestBulk(unittest.TestCase):
+    #
+    # Bulk endpoints, on both backends, over TLS and in the clear.
+    #
+
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.content = os.urandom(3 * 1024 * 1024 + 7)
+        with open(os.path.join(cls.directory.name, "large.bin"), "wb") as f:
+            f.write(cls.content)
+        cls.services = [
+            AsyncCatcher(host="127.0.0.1", port=0, files_dir=cls.directory.name),
+            AsyncCatcher(host="127.0.0.1", port=0, enable_ssl=False, files_dir=cls.directory.name),
+            Catcher(host="127.0.0.1", port=0, files_dir=cls.directory.name),
+            Catcher(host="127.0.0.1", port=0, enable_ssl=False, files_dir=cls.directory.name),
+        ]
+        cls.servers = []
+        for service in cls.services:
+            service.start()
+            if isinstance(service, Catcher):
+                port = service.httpd.server_address[1]
+            else:
+                port = service.port
+            cls.servers.append((service.enable_ssl, port))
+
+
+    def fetch(self, tls, port, method, path, body=None, headers={}, encode_chunked=False):
+        if tls:
+            connection = http.client.HTTPSConnection("127.0.0.1", port, context=net_http.ssl_context, timeout=10)
+        else:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        try:
+            connection.request(method, path, body=body, headers=headers, encode_chunked=encode_chunked)
+            response = connection.getresponse()
+            return response.status, response.getheader("Content-Length"), response.read()
+        finally:
+            connection.close()
+
+
+    def test_bytes(self):
+        for tls, port in self.servers:
+            code, length, body = self.fetch(tls, port, "GET", "/bytes/5m")
+            self.assertEqual(code, 200)
+            self.assertEqual(int(length), 5 * 1024 * 1024)
+            self.assertEqual(len(body), 5 * 1024 * 1024)
+            self.assertEqual(body[:4], b"\x00\x01\x02\x03")
+            self.assertEqual(self.fetch(tls, port, "GET", "/bytes/0?x=1")[2], b"")
+            self.assertEqual(self.fetch(tls, port, "GET", "/bytes/lots")[0], 400)
+
+
+    def test_file(self):
+        for tls, port in self.servers:
+            code, length, body = self.fetch(tls, port, "GET", "/file/large.bin")
+            self.assertEqual(code, 200)
+            self.assertEqual(int(length), len(self.content))
+            self.assertTrue(body == self.content)
+            self.assertEqual(self.fetch(tls, port, "GET", "/file/missing.bin")[0], 404)
+            self.assertEqual(self.fetch(tls, port, "GET", "/file/..%2Flarge.bin")[0], 404)
+
+
+    def test_sink(self):
+        for tls, port in self.servers:
+            upload = b"x" * (4 * 1024 * 1024 + 1)
+            code, length, body = self.fetch(tls, port, "POST", "/sink", body=upload)
+            self.assertEqual(code, 200)
+            result = json.loads(body)
+            self.assertEqual(result["bytes"], len(upload))
+            self.assertGreaterEqual(result["seconds"], 0)
+            #
+            # A chunked upload
+            #
+            code, length, body = self.fetch(tls, port, "POST", "/sink", body=iter([b"abc", b"de" * 100000]),
+                                            headers={"Transfer-Encoding": "chunked"}, encode_chunked=True)
+            self.assertEqual(json.loads(body)["bytes"], 200003)
+
+
+    @classmethod
+    def tearDownClass(cls):
+        for service in cls.services:
+            service.shutdown()
+        cls.directory.cleanup()
+
+
+
+class TestStats(unittest.TestCase):
+    #
+    # Metrics, the /__stats endpoint and the periodic summary.
+    #
+
+
+    def stats(self, url):
+        code, reason, headers, body = net_http.request(f'{url}/__stats', fresh=True)
+        self.assertEqual(code, 200)
+        return json.loads(body)
+
+
+    def check(self, service, url):
+        Logger.logs = []
+        for path in ["/eicar.exe", "/eicar.exe", "/bytes/1000", "/bytes/x", "/other/1", "/other/2"]:
+            net_http.request(f'{url}{path}', fresh=True)
+        stats = self.stats(url)
+        counts = {(entry["method"], entry["route"], entry["status"]): entry["count"] for entry in stats["routes"]}
+        self.assertEqual(counts[("GET", "/eicar.exe", 200)], 2)
+        self.assertEqual(counts[("GET", "/bytes", 200)], 1)
+        self.assertEqual(counts[("GET", "/bytes", 400)], 1)
+        self.assertEqual(counts[("GET", "echo", 200)], 2)
+        self.assertEqual(stats["requests"], 6)
+        self.assertGreaterEqual(stats["bytes_served"], 1000 + 2 * 68)
+        self.assertEqual(sum(count for bound, count in stats["latency_ms"]["histogram"]), 6)
+        self.assertIsNotNone(stats["latency_ms"]["p99"])
+        self.assertEqual(stats["connections"]["total"], 7)
+        #
+        # Requests are not logged, but summarised
+        #
+        self.assertFalse(any("/eicar.exe" in entry for entry in Logger.logs))
+        time.sleep(0.3)
+        self.assertTrue(any("stats requests:" in entry for entry in Logger.logs))
+
+
+    def test_async(self):
+        service = AsyncCatcher(host="127.0.0.1", port=0, enable_ssl=False, log_requests=False, stats_interval=0.1)
+        service.start()
+        try:
+            self.check(service, f'http://127.0.0.1:{service.port}')
+            #
+            # Kept-alive connections are active
+            #
+            with socket.create_connection(("127.0.0.1", service.port)):
+                time.sleep(0.1)
+                self.assertEqual(self.stats(f'http://127.0.0.1:{service.port}')["connections"]["active"], 2)
+        finally:
+            service.shutdown()
+
+
+    def test_thread(self):
+        service = Catcher(host="127.0.0.1", port=0, enable_ssl=False, log_requests=False, stats_interval=0.1)
+        service.start()
+        try:
+            self.check(service, f'http://127.0.0.1:{service.httpd.server_address[1]}')
+        finally:
+            service.shutdown()
@@ -4,9 +4,49 @@
 # Tests for the net_http functions
 #
 
+import http.server
+import threading
 import unittest
 
 import net_http
+from canisterset import CanisterSet
+from logger import Logger
+Logger.print_output = False
+
+
+
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+	#
+	# HTTP/1.1 handler which answers with the number of the connection
+	# the request came in on, and redirects /redirect to /.
+	#
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, f, *args):
+		pass
+
+	def setup(self):
+		super().setup()
+		with self.server.lock:
+			self.server.connections += 1
+			self.connection_number = self.server.connections
+
+	def do_GET(self):
+		if self.path == "/redirect":
+			self.send_response(302)
+			self.send_header("Location", "/")
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+			return
+		body = f'{self.connection_number}'.encode()
+		self.send_response(200)
+		self.send_header("Content-Length", f'{len(body)}')
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_POST(self):
+		self.rfile.read(int(self.headers["Content-Length"]))
+		self.do_GET()
 
 
 
@@ -31,3 +71,140 @@ class HttpTests(unittest.TestCase):
 		self.assertEqual(code, 404)
 		self.assertEqual(reason, "Not Found")
 
+
+
+class KeepAliveTests(unittest.TestCase):
+	#
+	# Connection reuse against a local HTTP/1.1 server.
+	#
+
+
+	@classmethod
+	def setUpClass(cls):
+		cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+		cls.server.lock = threading.Lock()
+		cls.server.connections = 0
+		cls.server.daemon_threads = True
+		cls.url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+		threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+
+	def setUp(self):
+		net_http.pool.clear()
+
+
+	def test_reuse(self):
+		code, reason, headers, body = net_http.request(f'{self.url}/')
+		self.assertEqual(code, 200)
+		first = body
+		for _ in range(3):
+			code, reason, headers, body = net_http.request(f'{self.url}/', method="POST", body="x")
+			self.assertEqual(code, 200)
+			self.assertEqual(body, first)
+
+
+	def test_fresh(self):
+		code, reason, headers, first = net_http.request(f'{self.url}/')
+		code, reason, headers, second = net_http.request(f'{self.url}/', fresh=True)
+		self.assertEqual(code, 200)
+		self.assertNotEqual(first, second)
+		code, reason, headers, third = net_http.request(f'{self.url}/')
+		self.assertEqual(third, first)
+
+
+	def test_timings(self):
+		code, reason, headers, body, timings = net_http.timed_request(f'{self.url}/', fresh=True)
+		self.assertEqual(code, 200)
+		self.assertFalse(timings["reused"])
+		self.assertEqual(timings["tls_ms"], 0)
+		self.assertEqual(timings["bytes"], len(body))
+		for field in ["dns_ms", "connect_ms", "ttfb_ms", "total_ms"]:
+			self.assertGreaterEqual(timings[field], 0)
+		self.assertLessEqual(timings["dns_ms"] + timings["connect_ms"], timings["ttfb_ms"])
+		self.assertLessEqual(timings["ttfb_ms"], timings["total_ms"])
+
+		#
+		# A kept-alive connection has no connection phases
+		#
+		net_http.request(f'{self.url}/')
+		code, reason, headers, body, timings = net_http.timed_request(f'{self.url}/')
+		self.assertTrue(timings["reused"])
+		self.assertEqual(timings["dns_ms"], 0)
+		self.assertEqual(timings["connect_ms"], 0)
+
+		#
+		# A failed request has the phases it reached
+		#
+		code, reason, headers, body, timings = net_http.timed_request("http://127.0.0.1:1/", fresh=True)
+		self.assertIsNone(code)
+		self.assertIsNotNone(timings["dns_ms"])
+		self.assertIsNone(timings["connect_ms"])
+		self.assertIsNone(timings["ttfb_ms"])
+		self.assertIsNotNone(timings["total_ms"])
+
+
+	def test_redirect(self):
+		code, reason, headers, body = net_http.request(f'{self.url}/redirect')
+		self.assertEqual(code, 200)
+
+
+	def test_dropped(self):
+		#
+		# An idle connection which can no longer be used is replaced.
+		#
+		code, reason, headers, first = net_http.request(f'{self.url}/')
+		for connections in net_http.pool.idle.values():
+			for connection in connections:
+				connection.sock.close()
+		code, reason, headers, second = net_http.request(f'{self.url}/')
+		self.assertEqual(code, 200)
+		self.assertNotEqual(first, second)
+
+
+	def test_concurrent(self):
+		#
+		# Concurrent tests each take their own connection, and the
+		# connections are kept for the next run.
+		#
+		port = self.server.server_address[1]
+		test = {
+			"name": "Local",
+			"feature": "None",
+			"description": "Local keep-alive server",
+			"remediation": "None",
+			"method": "GET",
+			"protocol": "http",
+			"host": "127.0.0.1",
+			"port": port,
+			"path": "/",
+			"success_criteria": [{"field":"response_code","op":"is","value":200}],
+		}
+		S = CanisterSet(workers=4)
+		S.load([dict(test, name=f'Local {i}') for i in range(8)])
+		S.execute()
+		self.assertEqual(S.results()["succeeded"], 8)
+		connections = self.server.connections
+		S.execute()
+		self.assertEqual(S.results()["succeeded"], 8)
+		self.assertEqual(self.server.connections, connections)
+
+		#
+		# Repeated tests report the timings over their runs
+		#
+		S = CanisterSet(workers=2)
+		S.load([dict(test, repeat=5), test])
+		S.execute()
+		results = S.results()
+		self.assertEqual(results["succeeded"], 2)
+		self.assertEqual([timings["runs"] for timings in results["timings"]], [5, 1])
+		stats = results["timings"][0]["total_ms"]
+		self.assertLessEqual(stats["min"], stats["median"])
+		self.assertLessEqual(stats["median"], stats["p95"])
+		self.assertEqual(len(S.tests[0].timings), 5)
+
+
+	@classmethod
+	def tearDownClass(cls):
+		net_http.pool.clear()
+		cls.server.shutdown()
+		cls.server.server_close()
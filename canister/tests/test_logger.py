@@ -5,6 +5,7 @@
 #
 
 
+import threading
 import unittest 
 
 from logger import Logger
@@ -39,3 +40,30 @@ class TestLogger(unittest.TestCase):
 		#
 		Logger.level = 3
 		self.assertEqual(Logger.level, 3)
+
+
+	def test_logger_threads(self):
+
+		#
+		# Entries and callbacks from many threads are neither lost
+		# nor interleaved.
+		#
+		Logger.reset()
+		Logger.print_output = False
+		entries = []
+		callback = Logger.__dict__["callback"]
+		Logger.callback = lambda level, text: entries.append(text)
+		def worker(n):
+			for i in range(200):
+				Logger.log(1, f'{n}:{i}')
+		threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		Logger.callback = callback
+		self.assertEqual(len(Logger.logs), 1600)
+		self.assertEqual(len(entries), 1600)
+		self.assertEqual([entry.split("> ")[1] for entry in Logger.logs], entries)
+		Logger.reset()
+		Logger.print_output = False
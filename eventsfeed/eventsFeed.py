@@ -13,6 +13,20 @@
 # The script provides the -n option for sending events to a TCP socket, and the -z option
 # for sending events directly into Microsoft Sentinel.
 #
+# With -d, the marker is kept in a SQLite database (WAL mode) instead of the config file,
+# together with a delivery cursor per network destination, so that a page which already
+# reached a destination is not sent to it again when a run is restarted mid-page. The first
+# run with -d imports the marker from the config file if one exists. The database schema is
+# shared with auditFeed.py, so both scripts can use the same database.
+#
+# With -D, events that were already sent are dropped, so that a page fetched again after a
+# crash, or re-read with -m, is not sent twice. Sent events are remembered in one Bloom filter
+# per hour of event time, for the last --dedup-window hours, sized for --dedup-capacity events
+# per hour at a false-positive rate of --dedup-fp-rate. The filter is saved after each page and
+# before the marker: in CONFIG_FILE.dedup, or in the database with -d. Within a page, the
+# fingerprints of delivered events are journalled as they are delivered, after each event sent
+# over TCP and after each post to Sentinel, so a run that stops mid-page does not send them again.
+#
 # Usage: eventsFeed.py [options]
 #
 # Options:
@@ -32,6 +46,21 @@
 #                       of events (default=1)
 #   -r RUNTIME_LIMIT    Stop execution if total runtime exceeds this many
 #                       seconds (default=infinite)
+#   -d STATE_DB         Keep state in this SQLite database instead of the
+#                       config file, migrating from the config file on first use
+#   -D                  Drop events that were already sent, using a
+#                       time-bucketed Bloom filter stored alongside the marker
+#   --dedup-fp-rate DEDUP_FP_RATE
+#                       Target false-positive rate of the -D filter
+#                       (default=0.001)
+#   --dedup-capacity DEDUP_CAPACITY
+#                       Events per hour the -D filter is sized for
+#                       (default=100000)
+#   --dedup-window DEDUP_WINDOW
+#                       Hours of event time remembered by the -D filter
+#                       (default=24)
+#   --stream            Decompress and parse responses incrementally, one
+#                       record at a time, to bound memory use
 #   -v                  Print debug info
 #   -V                  Print detailed debug info
 #
@@ -59,6 +88,12 @@
 # To only see NG Anti Malware and Anti Malware subtype events:
 #   python3 eventsFeed.py -K YOURAPIKEY -I 1714 -p -s "NG Anti Malware,Anti Malware"
 #
+# To keep the marker in a SQLite database, importing the existing ./config.txt on the first run:
+#   python3 eventsFeed.py -K YOURAPIKEY -I 1714 -d ./state.db -n 192.168.1.1:8000
+#
+# To resend nothing that was already sent when replaying the queue from the start:
+#   python3 eventsFeed.py -K YOURAPIKEY -I 1714 -D -m "" -n 192.168.1.1:8000
+#
 # This script is supplied as a demonstration of how to access the Cato API with Python. It
 # is not an official Cato release and is provided with no guarantees of support. Error handling
 # is restricted to the bare minimum required for the script to work with the API, and may not be
@@ -67,18 +102,23 @@
 
 import argparse
 import base64
+import codecs
+import contextlib
 import datetime
 import gzip
 import hmac
 import hashlib
 import json
+import math
 import os
 import socket
+import sqlite3
 import ssl
 import sys
 import time
 import urllib.parse
 import urllib.request
+import zlib
 
 
 ########################################################################################
@@ -97,9 +137,170 @@ def logd(text):
         log(text)
 
 
-# send GQL query string to API, return JSON
+# Responses are decoded incrementally with --stream. The in-body rate-limit
+# and error checks only need the start of the body.
+RATE_LIMIT_PREFIX = '{"errors":[{"message":"rate limit for operation:'
+ERRORS_PREFIX = '{"errors"'
+
+
+class FeedStream:
+    """Incremental decoder for a FEED API response.
+
+    The body is read in CHUNK_SIZE pieces, gunzipped with a zlib
+    decompressobj and parsed with a small pull parser. Iterating yields
+    (account_id, record) for each entry of data.FEED.accounts[].records,
+    decoded one record at a time with json.JSONDecoder.raw_decode, so memory
+    is bounded by the record size rather than the page size. The scalar
+    fields of data.FEED (marker, fetchedCount, ...) are collected in .fields
+    as they are parsed, and the whole response with the records arrays left
+    empty is available as .envelope once iteration is complete.
+
+    GraphQL returns fields in query order, so marker and the account id are
+    known before the records that follow them."""
+
+    CHUNK_SIZE = 65536
+
+    def __init__(self, response, feed):
+        self.response = response
+        self.feed = feed
+        self.decompressor = None
+        self.decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self.json_decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.started = False
+        self.eof = False
+        self.fields = {}
+        self.envelope = None
+        self.account_id = None
+
+    def _fill(self):
+        """Append the next decoded chunk to the buffer, dropping what has
+        already been parsed. Returns False at the end of the body."""
+        global total_bytes_compressed
+        global total_bytes_uncompressed
+        if self.eof:
+            return False
+        raw = self.response.read(self.CHUNK_SIZE)
+        if not self.started:
+            self.started = True
+            if raw[:2] == b"\x1f\x8b":
+                self.decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        total_bytes_compressed += len(raw)
+        if raw:
+            data = self.decompressor.decompress(raw) if self.decompressor else raw
+        else:
+            self.eof = True
+            data = self.decompressor.flush() if self.decompressor else b""
+        total_bytes_uncompressed += len(data)
+        self.buf = self.buf[self.pos:] + self.decoder.decode(data, final=self.eof)
+        self.pos = 0
+        return True
+
+    def startswith(self, prefix):
+        while len(self.buf) - self.pos < len(prefix) and self._fill():
+            pass
+        return self.buf.startswith(prefix, self.pos)
+
+    def _peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def _next(self, expected):
+        ch = self._peek()
+        if not ch or ch not in expected:
+            raise ValueError(f"Unexpected {ch!r} in {self.feed} response, expected one of {expected!r}")
+        self.pos += 1
+        return ch
+
+    def _value(self):
+        """Decode one complete JSON value, reading more of the body as needed."""
+        self._peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number at the end of the buffer may continue in the next chunk
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def _parse(self, path):
+        """Parse the value at path, yielding records along the way, and return
+        it with the records arrays left empty."""
+        target = ("data", self.feed, "accounts", None, "records")
+        on_path = all(t is None or p == t for p, t in zip(path, target))
+        ch = self._peek()
+        if not on_path or ch not in ("{", "["):
+            return self._value()
+        if ch == "{":
+            return (yield from self._object(path))
+        return (yield from self._array(path))
+
+    def _object(self, path):
+        self._next("{")
+        result = {}
+        if len(path) == 4:
+            self.account_id = None
+        if self._peek() == "}":
+            self.pos += 1
+            return result
+        while True:
+            if self._peek() != '"':
+                raise ValueError(f"Expected an object key in {self.feed} response")
+            key = self._value()
+            self._next(":")
+            value = yield from self._parse(path + (key,))
+            result[key] = value
+            if len(path) == 4 and key == "id":
+                self.account_id = value
+            elif len(path) == 2:
+                self.fields[key] = value
+            if self._next(",}") == "}":
+                return result
+
+    def _array(self, path):
+        self._next("[")
+        result = []
+        if self._peek() == "]":
+            self.pos += 1
+            return result
+        if len(path) == 5:
+            # data.FEED.accounts[i].records: yield each record, keep none
+            while True:
+                yield self.account_id, self._value()
+                if self._next(",]") == "]":
+                    return result
+        index = 0
+        while True:
+            result.append((yield from self._parse(path + (index,))))
+            index += 1
+            if self._next(",]") == "]":
+                return result
+
+    def __iter__(self):
+        self.envelope = yield from self._parse(())
+
+    def read_all(self):
+        """Consume the rest of the body and return the parsed response."""
+        for _ in self:
+            pass
+        return self.envelope
+
+
+# send GQL query string to API, return JSON, or a FeedStream over the response
+# body when stream is set
 # if we hit a network error, retry ten times with a 2 second sleep
-def send(query):
+def send(query, stream=False):
     global api_call_count
     global total_bytes_compressed
     global total_bytes_uncompressed
@@ -126,6 +327,18 @@ def send(query):
             time.sleep(2)
             retry_count += 1
             continue
+        if stream:
+            feed_stream = FeedStream(response, "eventsFeed")
+            if feed_stream.startswith(RATE_LIMIT_PREFIX):
+                log("RATE LIMIT sleeping 5 seconds then retrying")
+                response.close()
+                time.sleep(5)
+                continue
+            if feed_stream.startswith(ERRORS_PREFIX):
+                result = feed_stream.read_all()
+                log(f"API error: {json.dumps(result)}")
+                return False,result
+            return True,feed_stream
         zipped_data = response.read()
         total_bytes_compressed += len(zipped_data)
         result_data = gzip.decompress(zipped_data)
@@ -142,6 +355,322 @@ def send(query):
     return True,result
 
 
+########################################################################################
+########################################################################################
+########################################################################################
+# SQLite state store
+
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS markers (
+    feed TEXT NOT NULL,
+    account_group TEXT NOT NULL,
+    time_frame TEXT NOT NULL,
+    marker TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (feed, account_group, time_frame)
+);
+CREATE TABLE IF NOT EXISTS seen (
+    feed TEXT NOT NULL,
+    account_group TEXT NOT NULL,
+    time_frame TEXT NOT NULL,
+    identity TEXT NOT NULL,
+    seen_at REAL NOT NULL,
+    PRIMARY KEY (feed, account_group, time_frame, identity)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS seen_expiry ON seen (seen_at);
+CREATE TABLE IF NOT EXISTS cursors (
+    feed TEXT NOT NULL,
+    account_group TEXT NOT NULL,
+    time_frame TEXT NOT NULL,
+    sink TEXT NOT NULL,
+    from_marker TEXT NOT NULL,
+    to_marker TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (feed, account_group, time_frame, sink)
+);
+CREATE TABLE IF NOT EXISTS leases (
+    feed TEXT NOT NULL,
+    account_group TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (feed, account_group)
+);
+CREATE TABLE IF NOT EXISTS dedup (
+    feed TEXT NOT NULL,
+    account_group TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    params TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    filter BLOB NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (feed, account_group, bucket)
+);
+CREATE TABLE IF NOT EXISTS dedup_journal (
+    feed TEXT NOT NULL,
+    account_group TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    fingerprint BLOB NOT NULL,
+    PRIMARY KEY (feed, account_group, bucket, fingerprint)
+) WITHOUT ROWID;
+"""
+
+# The events feed is a queue rather than a time window, so its markers are
+# stored with an empty time_frame.
+NO_TIME_FRAME = ""
+
+
+class SqliteState:
+    """Feed state in a SQLite database, shared with auditFeed.py.
+
+    markers: current marker per account
+    cursors: the last page (from_marker -> to_marker) delivered to each
+             network destination
+    dedup:   Bloom filter buckets of sent events (-D), one row per hour
+    dedup_journal: fingerprints of events delivered since the filter was
+             last saved
+
+    Every update is a short BEGIN IMMEDIATE transaction."""
+
+    def __init__(self, path, feed):
+        self.feed = feed
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(STATE_SCHEMA)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.db
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def get_marker(self, group):
+        row = self.db.execute(
+            "SELECT marker FROM markers WHERE feed = ? AND account_group = ? AND time_frame = ?",
+            (self.feed, group, NO_TIME_FRAME)).fetchone()
+        return None if row is None else row[0]
+
+    def save_marker(self, group, marker):
+        with self.transaction() as db:
+            db.execute(
+                "INSERT INTO markers (feed, account_group, time_frame, marker, updated) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (feed, account_group, time_frame) DO UPDATE SET marker = excluded.marker, updated = excluded.updated",
+                (self.feed, group, NO_TIME_FRAME, marker, time.time()))
+
+    def load_dedup(self, group, dedup):
+        """Load the dedup filter and replay the journal into it. Returns the
+        number of buckets and of journalled fingerprints read."""
+        rows = self.db.execute(
+            "SELECT bucket, count, filter FROM dedup WHERE feed = ? AND account_group = ? AND params = ?",
+            (self.feed, group, dedup.params())).fetchall()
+        for bucket, count, blob in rows:
+            dedup.load_bucket(bucket, count, zlib.decompress(blob))
+        journal = self.db.execute(
+            "SELECT bucket, fingerprint FROM dedup_journal WHERE feed = ? AND account_group = ?",
+            (self.feed, group)).fetchall()
+        dedup.replay(journal)
+        return len(rows), len(journal)
+
+    def journal_dedup(self, group, fingerprints):
+        """Record the (bucket, fingerprint) of events that were delivered."""
+        with self.transaction() as db:
+            db.executemany(
+                "INSERT OR IGNORE INTO dedup_journal (feed, account_group, bucket, fingerprint) VALUES (?, ?, ?, ?)",
+                [(self.feed, group, bucket, fingerprint) for bucket, fingerprint in fingerprints])
+
+    def save_dedup(self, group, dedup):
+        """Store the changed buckets of the dedup filter, which now hold the
+        journalled fingerprints, and clear the journal."""
+        with self.transaction() as db:
+            # buckets outside the window, or built with other parameters, are dropped
+            db.execute(
+                "DELETE FROM dedup WHERE feed = ? AND account_group = ? AND (params != ? OR bucket < ?)",
+                (self.feed, group, dedup.params(), dedup.oldest_bucket()))
+            now = time.time()
+            for bucket, count, bits in dedup.changed_buckets():
+                db.execute(
+                    "INSERT INTO dedup (feed, account_group, bucket, params, count, filter, updated) VALUES (?, ?, ?, ?, ?, ?, ?)"
+                    " ON CONFLICT (feed, account_group, bucket) DO UPDATE SET"
+                    " params = excluded.params, count = excluded.count, filter = excluded.filter, updated = excluded.updated",
+                    (self.feed, group, bucket, dedup.params(), count, zlib.compress(bits, 1), now))
+            db.execute("DELETE FROM dedup_journal WHERE feed = ? AND account_group = ?", (self.feed, group))
+
+    def delivered(self, group, sink, from_marker, to_marker):
+        """Record that the page from_marker -> to_marker reached a destination."""
+        with self.transaction() as db:
+            db.execute(
+                "INSERT INTO cursors (feed, account_group, time_frame, sink, from_marker, to_marker, updated)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (feed, account_group, time_frame, sink) DO UPDATE SET"
+                " from_marker = excluded.from_marker, to_marker = excluded.to_marker, updated = excluded.updated",
+                (self.feed, group, NO_TIME_FRAME, sink, from_marker, to_marker, time.time()))
+
+    def was_delivered(self, group, sink, from_marker, to_marker):
+        row = self.db.execute(
+            "SELECT from_marker, to_marker FROM cursors"
+            " WHERE feed = ? AND account_group = ? AND time_frame = ? AND sink = ?",
+            (self.feed, group, NO_TIME_FRAME, sink)).fetchone()
+        return row is not None and tuple(row) == (from_marker, to_marker)
+
+
+########################################################################################
+########################################################################################
+########################################################################################
+# Event deduplication (-D)
+
+BUCKET_FORMAT = "%Y-%m-%dT%H"
+
+
+class EventDedup:
+    """Remembers which events have been sent, so that events re-fetched after a
+    crash or re-read with -m are dropped instead of being sent again.
+
+    Events are fingerprinted with BLAKE2b over their time and fields, and the
+    fingerprints are added to a Bloom filter for the hour of the event time.
+    Only the most recent `window` hours are kept, so memory is bounded by
+    window * bits / 8 bytes. Each bucket is sized for `capacity` events at
+    false-positive rate `fp_rate`; a false positive drops an event that was
+    never sent. Events older than the window are passed through unchecked.
+
+    The fingerprints of events recorded since the last call to take_pending()
+    are kept in `pending`, so that they can be journalled once the events
+    have been delivered, and replayed into the filter after a crash."""
+
+    def __init__(self, fp_rate, capacity, window):
+        self.bits = math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2 / 8) * 8
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.capacity = capacity
+        self.window = window
+        self.buckets = {}  # "YYYY-MM-DDTHH" -> [bytearray, count]
+        self.changed = set()
+        self.encoded = {}  # bucket -> entry of the dedup file, see save()
+        self.newest = None
+        self.pending = []  # (bucket, fingerprint) of events not journalled yet
+        self.hits = 0
+        self.too_old = 0
+
+    def params(self):
+        return f"{self.bits}:{self.hashes}"
+
+    def oldest_bucket(self):
+        if self.newest is None:
+            return ""
+        oldest = datetime.datetime.strptime(self.newest, BUCKET_FORMAT) - datetime.timedelta(hours=self.window - 1)
+        return oldest.strftime(BUCKET_FORMAT)
+
+    def load_bucket(self, bucket, count, bits):
+        self.buckets[bucket] = [bytearray(bits), count]
+        if self.newest is None or bucket > self.newest:
+            self.newest = bucket
+
+    def changed_buckets(self):
+        changed = [(bucket, self.buckets[bucket][1], bytes(self.buckets[bucket][0]))
+                   for bucket in sorted(self.changed) if bucket in self.buckets]
+        self.changed = set()
+        return changed
+
+    def _bucket(self, name):
+        if self.newest is None or name > self.newest:
+            self.newest = name
+            oldest = self.oldest_bucket()
+            for old in [b for b in self.buckets if b < oldest]:
+                del self.buckets[old]
+        if name < self.oldest_bucket():
+            return None
+        if name not in self.buckets:
+            self.buckets[name] = [bytearray(self.bits // 8), 0]
+        return self.buckets[name]
+
+    def seen(self, event):
+        """Return True if the event was already sent, otherwise record it."""
+        name = (event.get("time") or "")[:13]
+        if len(name) < 13:
+            name = datetime.datetime.now(datetime.UTC).strftime(BUCKET_FORMAT)
+        bucket = self._bucket(name)
+        if bucket is None:
+            self.too_old += 1
+            return False
+        digest = hashlib.blake2b(json.dumps(event, sort_keys=True).encode("utf-8"), digest_size=16).digest()
+        if not self._add(name, bucket, digest):
+            self.hits += 1
+            return True
+        self.pending.append((name, digest))
+        return False
+
+    def _add(self, name, bucket, digest):
+        # returns False if every bit of the fingerprint was already set
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        bits = bucket[0]
+        positions = [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+        if all(bits[p >> 3] & (1 << (p & 7)) for p in positions):
+            return False
+        for p in positions:
+            bits[p >> 3] |= 1 << (p & 7)
+        bucket[1] += 1
+        if bucket[1] == self.capacity + 1:
+            log(f"Dedup bucket {name} exceeds {self.capacity} events, false-positive rate is now above target")
+        self.changed.add(name)
+        return True
+
+    def take_pending(self):
+        pending, self.pending = self.pending, []
+        return pending
+
+    def replay(self, fingerprints):
+        """Add journalled (bucket, fingerprint) pairs to the filter. Replaying
+        a fingerprint that is already in the filter changes nothing."""
+        for name, digest in fingerprints:
+            bucket = self._bucket(name)
+            if bucket is not None:
+                self._add(name, bucket, digest)
+
+    def load(self, path):
+        """Load a dedup file written by save(). Returns the number of buckets read."""
+        with open(path, "r") as File:
+            saved = json.load(File)
+        if saved.get("params") != self.params():
+            log(f"Dedup file {path} was written with other -D parameters, starting with an empty filter")
+            return 0
+        for bucket, entry in saved["buckets"].items():
+            self.load_bucket(bucket, entry["count"], zlib.decompress(base64.b64decode(entry["filter"])))
+        self.encoded = saved["buckets"]
+        return len(saved["buckets"])
+
+    def load_journal(self, path):
+        """Replay the journal written by journal(). Returns the number of
+        fingerprints read."""
+        with open(path, "r") as File:
+            fingerprints = [line.split() for line in File if line.strip()]
+        # a line cut short by a crash is ignored
+        fingerprints = [(bucket, bytes.fromhex(digest)) for bucket, digest in (f for f in fingerprints if len(f) == 2)
+                        if len(digest) == 32]
+        self.replay(fingerprints)
+        return len(fingerprints)
+
+    def journal(self, path, fingerprints):
+        with open(path, "a") as File:
+            File.write("".join(f"{bucket} {digest.hex()}\n" for bucket, digest in fingerprints))
+
+    def save(self, path):
+        """Write the filter, which now holds the journalled fingerprints, and
+        remove the journal."""
+        # only changed buckets are recompressed
+        for bucket, count, bits in self.changed_buckets():
+            self.encoded[bucket] = {"count": count, "filter": base64.b64encode(zlib.compress(bits, 1)).decode("ascii")}
+        oldest = self.oldest_bucket()
+        self.encoded = {bucket: entry for bucket, entry in self.encoded.items() if bucket >= oldest}
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as File:
+            json.dump({"params": self.params(), "buckets": self.encoded}, File)
+        os.replace(tmp_path, path)
+        if os.path.isfile(path + ".journal"):
+            os.remove(path + ".journal")
+
+
 ########################################################################################
 ########################################################################################
 ########################################################################################
@@ -212,6 +741,12 @@ parser.add_argument("-t", dest="event_types", help="Comma-separated list of even
 parser.add_argument("-s", dest="event_sub_types", help="Comma-separated list of event sub types to filter on")
 parser.add_argument("-f", dest="fetch_limit", help="Stop execution if a fetch returns less than this number of events (default=1)")
 parser.add_argument("-r", dest="runtime_limit", help="Stop execution if total runtime exceeds this many seconds (default=infinite)")
+parser.add_argument("-d", dest="state_db", help="Keep state in this SQLite database instead of the config file, migrating from the config file on first use")
+parser.add_argument("-D", dest="dedup", action="store_true", help="Drop events that were already sent, using a time-bucketed Bloom filter stored alongside the marker")
+parser.add_argument("--dedup-fp-rate", dest="dedup_fp_rate", type=float, default=0.001, help="Target false-positive rate of the -D filter (default=0.001)")
+parser.add_argument("--dedup-capacity", dest="dedup_capacity", type=int, default=100000, help="Events per hour the -D filter is sized for (default=100000)")
+parser.add_argument("--dedup-window", dest="dedup_window", type=int, default=24, help="Hours of event time remembered by the -D filter (default=24)")
+parser.add_argument("--stream", dest="stream", action="store_true", help="Decompress and parse responses incrementally, one record at a time, to bound memory use")
 parser.add_argument("-v", dest="verbose", action="store_true", help="Print debug info")
 parser.add_argument("-V", dest="veryverbose", action="store_true", help="Print detailed debug info")
 args = parser.parse_args()
@@ -228,7 +763,17 @@ if args.config_file is None:
 else:
     config_file = args.config_file
     log(f"Using config file from -c parameter: {config_file}")
-if args.marker is None:
+if args.state_db is not None:
+    log(f"Using SQLite state database: {args.state_db}")
+    state_db = SqliteState(args.state_db, "eventsFeed")
+    stored_marker = state_db.get_marker(args.ID)
+else:
+    state_db = None
+    stored_marker = None
+if args.marker is None and stored_marker is not None:
+    marker = stored_marker
+    log(f"Read marker from state database: {marker}")
+elif args.marker is None:
     log("No marker value supplied, setting marker = \"\"")
 	# does the config file exist, if so load the marker value
     if os.path.isfile(config_file):
@@ -240,12 +785,49 @@ if args.marker is None:
                 log(str(E))
                 log(f"Couldn't read marker from config file, leaving marker as {marker}")
             log(f"Read marker from config_file: {marker}")
+        if state_db is not None:
+            # first use of the database: migrate the config file marker
+            state_db.save_marker(args.ID, marker)
+            log(f"Migrated marker from {config_file} to {args.state_db}")
     else:
         log("Config file does not exist, sticking with default marker")
 else:
     marker = args.marker
     log(f"Using marker value from -m parameter: {marker}")
 
+# load the dedup filter stored alongside the marker
+dedup = None
+dedup_file = config_file + ".dedup"
+if args.dedup:
+    if not 0 < args.dedup_fp_rate < 1 or args.dedup_capacity < 1 or args.dedup_window < 1:
+        print("Error: --dedup-fp-rate must be between 0 and 1, --dedup-capacity and --dedup-window must be positive")
+        sys.exit(1)
+    dedup = EventDedup(args.dedup_fp_rate, args.dedup_capacity, args.dedup_window)
+    log(f"Dedup filter: {dedup.hashes} hashes, {dedup.bits // 8} bytes per hour, {args.dedup_window} hours")
+    if state_db is not None:
+        loaded, journalled = state_db.load_dedup(args.ID, dedup)
+        log(f"Loaded {loaded} dedup buckets and {journalled} journalled events from {args.state_db}")
+    else:
+        if os.path.isfile(dedup_file):
+            loaded = dedup.load(dedup_file)
+            log(f"Loaded {loaded} dedup buckets from {dedup_file}")
+        if os.path.isfile(dedup_file + ".journal"):
+            journalled = dedup.load_journal(dedup_file + ".journal")
+            log(f"Loaded {journalled} journalled events from {dedup_file}.journal")
+
+
+def checkpoint_dedup():
+    """Journal the fingerprints of the events delivered since the last
+    checkpoint, so that they are not sent again if the run stops before the
+    filter is saved."""
+    fingerprints = dedup.take_pending()
+    if not fingerprints:
+        return
+    if state_db is not None:
+        state_db.journal_dedup(args.ID, fingerprints)
+    else:
+        dedup.journal(dedup_file + ".journal", fingerprints)
+
 # process event_type filters
 if args.event_types is not None:
     log(f"Event type filter parameter: {args.event_types}")
@@ -295,6 +877,109 @@ if args.runtime_limit is None:
 else:
     RUNTIME_LIMIT = int(args.runtime_limit)
 
+# Sentinel body size at which a streamed page (--stream) is posted in parts,
+# so the pending body stays small. Without --stream each page is one post.
+SENTINEL_BATCH_BYTES = 1024 * 1024
+
+
+class PageOutput:
+    """Sends the events of one page to the configured outputs as they are
+    produced: printed straight away, written to a TCP connection opened for
+    the page, and serialized into the Sentinel body. With -d, destinations
+    that already received the page in an earlier, interrupted run are
+    skipped. With -D, the fingerprints of the events are journalled once
+    they reached every destination: after each event when TCP is the only
+    network destination, otherwise after each post to Sentinel."""
+
+    def __init__(self, sent_marker, feed_fields):
+        self.sent_marker = sent_marker
+        self.feed_fields = feed_fields
+        self.sock = None
+        self.skip_tcp = None
+        self.skip_sentinel = None
+        self.sentinel_body = bytearray()
+        self.sentinel_count = 0
+
+    def marker(self):
+        return self.feed_fields.get("marker") or ""
+
+    def already_delivered(self, sink):
+        return state_db is not None and state_db.was_delivered(args.ID, sink, self.sent_marker, self.marker())
+
+    def emit(self, event):
+        # print output
+        if args.print_events:
+            if args.prettify:
+                print(json.dumps(event,indent=2, ensure_ascii=False))
+            else:
+                try:
+                    print(json.dumps(event, ensure_ascii=False))
+                except Exception as e:
+                    print(json.dumps(event))
+
+        # network stream
+        if args.stream_events is not None:
+            if self.skip_tcp is None:
+                self.skip_tcp = self.already_delivered("tcp")
+                if self.skip_tcp:
+                    log(f"Page already delivered to {args.stream_events}, not sending it again")
+            if not self.skip_tcp:
+                if self.sock is None:
+                    logd(f"Sending events to {network_elements[0]}:{network_elements[1]}")
+                    self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    self.sock.connect((network_elements[0], int(network_elements[1])))
+                self.sock.sendall(json.dumps(event, ensure_ascii=False).encode("utf-8"))
+
+        # send to Microsoft Sentinel
+        if args.sentinel is not None:
+            if self.skip_sentinel is None:
+                self.skip_sentinel = self.already_delivered("sentinel")
+                if self.skip_sentinel:
+                    log(f"Page already delivered to Azure workspace ID {sentinel_elements[0]}, not sending it again")
+            if not self.skip_sentinel:
+                self.sentinel_body += b"," if self.sentinel_count else b"["
+                self.sentinel_body += json.dumps(event).encode('ascii')
+                self.sentinel_count += 1
+                if args.stream and len(self.sentinel_body) >= SENTINEL_BATCH_BYTES:
+                    self.post_sentinel()
+
+        if dedup is not None and args.stream_events is not None and args.sentinel is None:
+            checkpoint_dedup()
+
+    def post_sentinel(self):
+        logd(f"Sending {self.sentinel_count} events to Azure workspace ID {sentinel_elements[0]}")
+        response_status = post_data(sentinel_elements[0],sentinel_elements[1],bytes(self.sentinel_body + b"]"))
+        if response_status < 200 or response_status > 299:
+            print(f"Send to Azure returned {response_status}, exiting")
+            sys.exit(1)
+        logd(f"Send to Azure response code:{response_status}")
+        self.sentinel_body = bytearray()
+        self.sentinel_count = 0
+        if dedup is not None:
+            checkpoint_dedup()
+
+    def close(self):
+        # finish the page once every event has been emitted
+        marker = self.marker()
+        if self.sock is not None:
+            self.sock.close()
+        if args.stream_events is not None and not self.skip_tcp and state_db is not None:
+            state_db.delivered(args.ID, "tcp", self.sent_marker, marker)
+        if args.sentinel is not None and not self.skip_sentinel:
+            if self.sentinel_count:
+                self.post_sentinel()
+            if state_db is not None:
+                state_db.delivered(args.ID, "sentinel", self.sent_marker, marker)
+
+    def abort(self):
+        # stop part way through the page: only the events that reached every
+        # destination are journalled, those still in the Sentinel body are not
+        if self.sock is not None:
+            self.sock.close()
+        if dedup is not None and args.sentinel is None:
+            checkpoint_dedup()
+
+
 # API call loop
 iteration = 1
 total_count = 0
@@ -317,71 +1002,79 @@ while True:
   }
 }'''
 
+    sent_marker = marker
     logd(query)
-    success,resp = send(query)
+    success,resp = send(query, stream=args.stream)
     if not success:
         print(resp)
         sys.exit(1)
-    logd(resp)
-    marker = resp["data"]["eventsFeed"]["marker"]
-    fetched_count = int(resp["data"]["eventsFeed"]["fetchedCount"])
-    total_count += fetched_count
-    line = f"iteration:{iteration} fetched:{fetched_count} total_count:{total_count} marker:{marker}"
-    if len(resp["data"]["eventsFeed"]["accounts"][0]["records"]) > 0:
-        line += " "+resp["data"]["eventsFeed"]["accounts"][0]["records"][0]["time"]
-        line += " "+resp["data"]["eventsFeed"]["accounts"][0]["records"][-1]["time"]
-    log(line)
+    if args.stream:
+        # events are parsed one at a time as they are read from the body
+        feed_fields = resp.fields
+        records = resp
+    else:
+        logd(resp)
+        feed_fields = resp["data"]["eventsFeed"]
+        records = ((None, event) for event in feed_fields["accounts"][0]["records"])
 
 
-    # Construct list of events, with added timestamp, reordering (for Splunk) and optional filtering
-    events_list = []
-    for event in resp["data"]["eventsFeed"]["accounts"][0]["records"]:
+    # Emit each event, with added timestamp, reordering (for Splunk) and optional filtering
+    output = PageOutput(sent_marker, feed_fields)
+    first_time = last_time = None
+    page_hits = 0
+    for account_id, event in records:
+        if dedup is not None and dedup.seen(event):
+            page_hits += 1
+            continue
         event["fieldsMap"]["event_timestamp"] = event["time"]
         event_reorder = dict(sorted(event["fieldsMap"].items(),key=lambda i: i[0] == 'event_timestamp', reverse= True))
 
         # filtering
         # if something_we_don't_want:
         #   continue
-        
-
-        events_list.append(event_reorder)
 
 
-	# print output
-    if args.print_events:
-        for event in events_list:
-            if args.prettify:
-                print(json.dumps(event,indent=2, ensure_ascii=False))
-            else:
-                try:
-                    print(json.dumps(event, ensure_ascii=False))
-                except Exception as e:
-                    print(json.dumps(event))
-
-
-    # network stream
-    if args.stream_events is not None:
-        logd(f"Sending events to {network_elements[0]}:{network_elements[1]}")
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((network_elements[0], int(network_elements[1])))
-            for event in events_list:
-                s.sendall(json.dumps(event, ensure_ascii=False).encode("utf-8"))
-
+        if first_time is None:
+            first_time = event["time"]
+        last_time = event["time"]
+        output.emit(event_reorder)
+    if args.stream and "errors" in resp.envelope:
+        # errors reported after the data: the marker is not advanced, so the
+        # page will be fetched again by the next run, which drops the events
+        # already delivered with -D
+        output.abort()
+        print(resp.envelope)
+        sys.exit(1)
+    output.close()
 
-    # send to Microsoft Sentinel
-    if args.sentinel is not None:
-        logd(f"Sending events to Azure workspace ID {sentinel_elements[0]}")
-        response_status = post_data(sentinel_elements[0],sentinel_elements[1],json.dumps(events_list).encode('ascii'))
-        if response_status < 200 or response_status > 299:
-            print(f"Send to Azure returned {response_status}, exiting")
-            sys.exit(1)
-        logd(f"Send to Azure response code:{response_status}")
+    marker = feed_fields["marker"]
+    fetched_count = int(feed_fields["fetchedCount"])
+    total_count += fetched_count
+    line = f"iteration:{iteration} fetched:{fetched_count} total_count:{total_count} marker:{marker}"
+    if dedup is not None:
+        line += f" duplicates:{page_hits}"
+    if first_time is not None:
+        line += " "+first_time
+        line += " "+last_time
+    log(line)
 
 
-    # write marker back out
-    logd("Writing marker to " + config_file)
-    with open(config_file,"w") as File:
-        File.write(marker)
+    # write the dedup filter, then the marker, so that the filter never lags the marker
+    if dedup is not None:
+        dedup.take_pending()
+        if state_db is not None:
+            logd("Writing dedup filter to " + args.state_db)
+            state_db.save_dedup(args.ID, dedup)
+        else:
+            logd("Writing dedup filter to " + dedup_file)
+            dedup.save(dedup_file)
+    if state_db is not None:
+        logd("Writing marker to " + args.state_db)
+        state_db.save_marker(args.ID, marker)
+    else:
+        logd("Writing marker to " + config_file)
+        with open(config_file,"w") as File:
+            File.write(marker)
 
     # increment counter and check if we hit any limits for stopping
     iteration += 1
@@ -394,4 +1087,6 @@ while True:
         break
 
 end = datetime.datetime.now()
+if dedup is not None:
+    log(f"Dedup dropped {dedup.hits} duplicate events, {dedup.too_old} events were older than the {args.dedup_window} hour window")
 log(f"OK {total_count} events from {api_call_count} API calls with {total_bytes_uncompressed} bytes uncompressed, {total_bytes_compressed} bytes compressed in {end-start}")
@@ -0,0 +1,195 @@
+"""Percentile and peak statistics of the hourly bandwidth in a WAN app stats
+report: p50, p95 and p99 of the hourly bandwidth, the peak hour and the 95th
+percentile burst rate, per application, per user and in total"""
+import csv
+import math
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Percentiles are the hourly value at rank p / 100 * (hours - 1), rounded
+# down, without interpolating between hours, the same for both methods
+PERCENTILES = (50, 95, 99)
+
+# Largest groups x hours matrix summed at once by the exact statistics. More
+# groups are summed in blocks of rows, so memory does not grow with the range
+DENSE_STATS_CELLS = 1 << 22
+
+STATS_FIELDS = ['group', 'name', 'hours', 'total_mb', 'mean_mb', 'p50_mb', 'p95_mb', 'p99_mb',
+                'peak_mb', 'peak_hour', 'p95_mbps']
+
+
+class DDSketch:
+    """Streaming quantile sketch with relative accuracy (DDSketch): every
+    quantile is within `relative_accuracy` of the exact value. Values are
+    counted in logarithmic bins, so memory depends on the spread of the values,
+    not on their number, and is capped at `max_bins` by merging the lowest
+    bins, which only loses accuracy on the lowest quantiles"""
+    
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.bins = {}
+        self.zeros = 0
+        self.count = 0
+    
+    def add(self, value, count=1):
+        self.count += count
+        if value <= 0:
+            self.zeros += count
+            return
+        index = math.ceil(math.log(value) / self.log_gamma)
+        self.bins[index] = self.bins.get(index, 0) + count
+        if len(self.bins) > self.max_bins:
+            keys = sorted(self.bins)
+            extra = len(keys) - self.max_bins
+            self.bins[keys[extra]] += sum(self.bins.pop(key) for key in keys[:extra])
+    
+    def quantile(self, q):
+        """Return the q quantile, 0 <= q <= 1, or None when empty"""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zeros:
+            return 0.0
+        seen = self.zeros
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+def hour_indexes(hourly_records, bucket_seconds=None, start_ms=None, end_ms=None):
+    """Return the hour of every bucket of the report in time order, and the
+    hour index of each record. The buckets are those of the response, with
+    or without traffic, and with `start_ms` and `end_ms` every bucket of the
+    report range on the same grid, so that hours without traffic anywhere are
+    counted. Buckets are keyed by timestamp, so the two hours of a DST
+    fall-back that format the same stay apart"""
+    timestamps = set(hourly_records.bucket_timestamps)
+    timestamps.update(hourly_records.timestamps)
+    if timestamps and bucket_seconds and start_ms is not None and end_ms is not None:
+        bucket_ms = bucket_seconds * 1000
+        anchor = min(timestamps)
+        first = anchor - (anchor - start_ms) // bucket_ms * bucket_ms
+        index = 0
+        while first + index * bucket_ms < end_ms:
+            timestamps.add(round(first + index * bucket_ms))
+            index += 1
+    axis = sorted(timestamps)
+    timestamp_codes = {timestamp_ms: code for code, timestamp_ms in enumerate(axis)}
+    return ([hourly_records.time_name(timestamp_ms) for timestamp_ms in axis],
+            array('i', map(timestamp_codes.__getitem__, hourly_records.timestamps)))
+
+def exact_group_stats(codes, hours, values, group_count, hour_names):
+    """Exact statistics of each group with numpy, from the group code and hour
+    index of every record. Hours without traffic count as 0. Returns one
+    (total, p50, p95, p99, peak, peak_hour) tuple per group"""
+    codes = np.frombuffer(codes, dtype=np.int32)
+    hours = np.frombuffer(hours, dtype=np.int32)
+    values = np.frombuffer(values, dtype=np.float64)
+    hour_count = len(hour_names)
+    block = max(1, DENSE_STATS_CELLS // hour_count)
+    ranks = [int(p / 100 * (hour_count - 1)) for p in PERCENTILES]
+    
+    stats = []
+    for first in range(0, group_count, block):
+        rows = min(block, group_count - first)
+        if rows == group_count:
+            selected = slice(None)
+        else:
+            selected = (codes >= first) & (codes < first + rows)
+        matrix = np.bincount((codes[selected] - first).astype(np.int64) * hour_count + hours[selected],
+                             weights=values[selected], minlength=rows * hour_count).reshape(rows, hour_count)
+        percentiles = np.sort(matrix, axis=1)[:, ranks].tolist()
+        peaks = matrix.argmax(axis=1)
+        for row, total in enumerate(matrix.sum(axis=1).tolist()):
+            stats.append((total, *percentiles[row], matrix[row, peaks[row]].item(), hour_names[peaks[row]]))
+    return stats
+
+def streaming_group_stats(records, group_count, hour_names):
+    """Approximate statistics of each group, from (hour index, group code,
+    value) records ordered by hour. The records are summed one hour at a
+    time, so memory is one sketch per group whatever the range. Percentiles
+    are within 1% of the exact ones, totals and peaks are exact"""
+    sketches = [DDSketch() for _ in range(group_count)]
+    totals = [0.0] * group_count
+    peaks = [(0.0, None)] * group_count
+    
+    def close_hour(hour, sums):
+        for code, value in sums.items():
+            sketches[code].add(value)
+            totals[code] += value
+            if value > peaks[code][0]:
+                peaks[code] = (value, hour_names[hour])
+    
+    current, sums = None, {}
+    for hour, code, value in records:
+        if hour != current:
+            if sums:
+                close_hour(current, sums)
+            current, sums = hour, {}
+        sums[code] = sums.get(code, 0.0) + value
+    if sums:
+        close_hour(current, sums)
+    
+    stats = []
+    for sketch, total, (peak, peak_hour) in zip(sketches, totals, peaks):
+        # hours without traffic count as 0
+        sketch.add(0.0, len(hour_names) - sketch.count)
+        stats.append((total, *(sketch.quantile(p / 100) for p in PERCENTILES), peak, peak_hour or hour_names[0]))
+    return stats
+
+def bandwidth_stats(hourly_records, bucket_seconds=3600, method='auto', start_ms=None, end_ms=None):
+    """Compute the statistics of every application, every user and the total.
+    `method` is 'exact' (numpy), 'approx' (streaming sketches) or 'auto',
+    exact when numpy is installed. `start_ms` and `end_ms` are the report
+    range, see hour_indexes(). Returns one dict per row of the stats CSV"""
+    if method == 'auto':
+        method = 'exact' if np is not None else 'approx'
+    hour_names, hours = hour_indexes(hourly_records, bucket_seconds, start_ms, end_ms)
+    groups = [
+        ('application', hourly_records.applications, hourly_records.application_codes),
+        ('user', hourly_records.users, hourly_records.user_codes),
+        ('total', ['(total)'], array('i', [0]) * len(hourly_records)),
+    ]
+    
+    rows = []
+    for group, names, codes in groups:
+        if method == 'exact':
+            stats = exact_group_stats(codes, hours, hourly_records.values, len(names), hour_names)
+        else:
+            stats = streaming_group_stats(zip(hours, codes, hourly_records.values), len(names), hour_names)
+        for name, (total, p50, p95, p99, peak, peak_hour) in zip(names, stats):
+            rows.append({
+                'group': group,
+                'name': name,
+                'hours': len(hour_names),
+                'total_mb': round(total, 3),
+                'mean_mb': round(total / len(hour_names), 3),
+                'p50_mb': round(p50, 3),
+                'p95_mb': round(p95, 3),
+                'p99_mb': round(p99, 3),
+                'peak_mb': round(peak, 3),
+                'peak_hour': peak_hour,
+                # 95th percentile burst rate, as billed for burstable links
+                'p95_mbps': round(p95 * 8 / bucket_seconds, 3),
+            })
+    
+    # Groups by p95 descending, names in order within ties
+    group_order = {group: index for index, (group, _, _) in enumerate(groups)}
+    rows.sort(key=lambda row: (group_order[row['group']], -row['p95_mb'], row['name']))
+    return rows
+
+def save_stats_csv(rows, filename):
+    """Save the rows of bandwidth_stats() to CSV"""
+    with open(filename, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=STATS_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Created {filename} with {len(rows)} rows")
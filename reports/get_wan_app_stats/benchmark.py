@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+import json
+import gzip
+import os
+import io
+import argparse
+import contextlib
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+import get_app_stats
+from bandwidth_stats import bandwidth_stats, save_stats_csv
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the WAN app stats report path on synthetic or saved data')
+    parser.add_argument('--users', type=int, default=300, help='Number of synthetic users (default: 300)')
+    parser.add_argument('--apps', type=int, default=40, help='Number of synthetic applications (default: 40)')
+    parser.add_argument('--apps-per-user', type=int, default=10,
+                        help='Number of applications each synthetic user has traffic for (default: 10)')
+    parser.add_argument('--buckets', type=int, default=336, help='Number of hourly buckets per series (default: 336)')
+    parser.add_argument('--sparsity', type=float, default=0.5,
+                        help='Share of the buckets of each series without traffic, from 0 to 1 (default: 0.5)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed of the synthetic data (default: 1)')
+    parser.add_argument('--input', help='Benchmark a saved raw response (.json or .json.gz) instead of synthetic data')
+    parser.add_argument('--save-raw', help='Write the synthetic response to this .json or .json.gz file and exit')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of every stage, the fastest is reported (default: 3)')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Also measure the peak Python memory of every stage with tracemalloc, which slows the stages down')
+    parser.add_argument('--output-dir', help='Keep the report files in this directory (default: a temporary directory)')
+    parser.add_argument('--json', help='Also write the results to this JSON file, to compare runs')
+    
+    args = parser.parse_args()
+    
+    if args.input:
+        print(f"Loading {args.input}")
+        with open_raw(args.input) as f:
+            data = json.load(f)
+    else:
+        print(f"Generating {args.users} users x {args.apps_per_user} of {args.apps} applications x {args.buckets} buckets, "
+              f"sparsity {args.sparsity}")
+        data = generate_app_stats(args.users, args.apps, args.apps_per_user, args.buckets, args.sparsity, args.seed)
+    
+    if args.save_raw:
+        with (gzip.open(args.save_raw, 'wt', encoding='utf-8') if args.save_raw.endswith('.gz') else open(args.save_raw, 'w')) as f:
+            json.dump(data, f, separators=(',', ':'))
+        print(f"Saved synthetic data to {args.save_raw}")
+        return
+    
+    with contextlib.ExitStack() as stack:
+        output_dir = args.output_dir or stack.enter_context(tempfile.TemporaryDirectory())
+        os.makedirs(output_dir, exist_ok=True)
+        results = run_benchmark(data, output_dir, args.repeat, args.trace_memory)
+    
+    print(f"\n{'stage':<28}{'seconds':>10}{'peak MB':>10}")
+    for stage in results['stages']:
+        peak = f"{stage['peak_mb']:.1f}" if stage['peak_mb'] is not None else '-'
+        print(f"{stage['name']:<28}{stage['seconds']:>10.3f}{peak:>10}")
+    print(f"\nRecords: {results['records']}")
+    if results['max_rss_mb'] is not None:
+        print(f"Max RSS: {results['max_rss_mb']:.1f} MB")
+    
+    if args.json:
+        results['parameters'] = {key: value for key, value in vars(args).items() if key not in ('json', 'output_dir')}
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results to {args.json}")
+
+def open_raw(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt', encoding='utf-8')
+    return open(filename)
+
+def generate_app_stats(users, apps, apps_per_user, buckets, sparsity, seed=1):
+    """Build an appStatsTimeSeries response in the shape the API returns for the
+    report query: one upstream and one downstream series per user and
+    application, with hourly buckets ending at the current hour. Each user
+    has traffic for `apps_per_user` applications, and `sparsity` of the
+    buckets of each series are empty"""
+    rng = random.Random(seed)
+    end = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    start = end - timedelta(hours=buckets)
+    timestamps = [int((start + timedelta(hours=i)).timestamp() * 1000) for i in range(buckets)]
+    
+    timeseries = []
+    for user in range(users):
+        user_name = f"User {user}"
+        for app in sorted(rng.sample(range(apps), min(apps_per_user, apps))):
+            app_name = f"App {app}"
+            # heavy-tailed per series volume, most users are light
+            scale = rng.lognormvariate(0, 1.5)
+            for measure in ('downstream', 'upstream'):
+                data = [[timestamp_ms, round(rng.expovariate(1 / scale), 6) if rng.random() >= sparsity else 0]
+                        for timestamp_ms in timestamps]
+                timeseries.append({
+                    'label': f"sum({measure}) for application_name='{app_name}', user_name='{user_name}'",
+                    'data': data,
+                    'dimensions': [{'label': 'user_name', 'value': user_name}, {'label': 'application_name', 'value': app_name}],
+                    'key': {
+                        'measureFieldName': measure,
+                        'dimensions': [{'fieldName': 'user_name', 'value': user_name},
+                                       {'fieldName': 'application_name', 'value': app_name}],
+                    },
+                    'sum': sum(value for _, value in data),
+                    'units': 'MB',
+                    'info': [],
+                })
+    return {
+        'data': {
+            'appStatsTimeSeries': {
+                'from': start.isoformat(),
+                'to': end.isoformat(),
+                'granularity': 3600,
+                'timeseries': timeseries,
+            }
+        }
+    }
+
+def run_benchmark(data, output_dir, repeat, trace_memory):
+    """Time every stage of the report path on `data`, keeping the fastest of
+    `repeat` runs. With `trace_memory` the peak memory allocated during each
+    stage is measured in a separate, traced run"""
+    prefix = os.path.join(output_dir, 'benchmark')
+    state = {}
+    
+    def process():
+        state['records'] = get_app_stats.process_data_to_csv(data)
+    
+    def aggregate():
+        state['totals'] = get_app_stats.aggregate_records(state['records'])
+    
+    def statistics():
+        save_stats_csv(bandwidth_stats(state['records']), f"{prefix}_stats.csv")
+    
+    stages = [
+        ('process_data_to_csv', process),
+        ('save_hourly_csv', lambda: get_app_stats.save_hourly_csv(state['records'], f"{prefix}_hourly.csv")),
+        ('aggregate_records', aggregate),
+        ('create_pivot_summary', lambda: get_app_stats.create_pivot_summary(state['records'], state['totals'],
+                                                                           f"{prefix}_summary.csv")),
+        ('create_pivot_summary_long', lambda: get_app_stats.create_pivot_summary(state['records'], state['totals'],
+                                                                                f"{prefix}_summary_long.csv",
+                                                                                pivot_format='long')),
+        ('bandwidth_stats', statistics),
+        ('save_raw_archive', lambda: get_app_stats.save_raw_archive(data, prefix, 'gzip')),
+    ]
+    if get_app_stats.pyarrow is not None:
+        stages.insert(2, ('save_hourly_parquet', lambda: get_app_stats.save_hourly_parquet(
+            state['records'], f"{prefix}_hourly.parquet")))
+    
+    results = []
+    for name, stage in stages:
+        seconds = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                stage()
+            elapsed = time.perf_counter() - started
+            seconds = elapsed if seconds is None else min(seconds, elapsed)
+        
+        peak_mb = None
+        if trace_memory:
+            tracemalloc.start()
+            with contextlib.redirect_stdout(io.StringIO()):
+                stage()
+            peak_mb = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+            tracemalloc.stop()
+        results.append({'name': name, 'seconds': seconds, 'peak_mb': peak_mb})
+        print(f"{name}: {seconds:.3f}s")
+    
+    return {
+        'records': len(state['records']),
+        'stages': results,
+        'max_rss_mb': max_rss_mb(),
+    }
+
+def max_rss_mb():
+    """Peak resident memory of the process so far, or None where unavailable"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return max_rss / 1024 / 1024 if sys.platform == 'darwin' else max_rss / 1024
+
+
+if __name__ == "__main__":
+    main()
@@ -1,87 +1,313 @@
 #!/usr/bin/env python3
 import json
 import csv
+import gzip
+import hashlib
+import http.client
+import io
+import os
+import ssl
 import subprocess
 import argparse
+import configparser
+import functools
+import itertools
 import re
-from datetime import datetime
+import sqlite3
+import threading
+import time
+import urllib.parse
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from collections import defaultdict
 
+from bandwidth_stats import bandwidth_stats, save_stats_csv
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+DEFAULT_ENDPOINT = "https://api.catonetworks.com/api/v1/graphql2"
+
+# Same selection set as catocli's generated appStatsTimeSeries query, so both
+# client paths return the same raw JSON
+APP_STATS_QUERY = """query appStatsTimeSeries ( $accountID:ID! $timeFrame:TimeFrame! $measure:[Measure] $dimension:[Dimension] $appStatsFilter:[AppStatsFilter!] $buckets:Int! ) {
+	appStatsTimeSeries ( accountID:$accountID timeFrame:$timeFrame measures:$measure dimensions:$dimension filters:$appStatsFilter ) {
+		id
+		from
+		to
+		granularity
+		timeseries ( buckets:$buckets ) {
+			data
+			label
+			dimensions {
+				label
+				value
+			}
+			key {
+				measureFieldName
+				dimensions {
+					fieldName
+					value
+				}
+			}
+			sum
+			units
+			info
+		}
+	}
+}"""
+
+# Filters, dimensions and measures of the report. The cache (--cache) keeps
+# buckets per account and per shape of this query
+WAN_APP_STATS_QUERY = {
+    "appStatsFilter": [
+        {
+            "fieldName": "traffic_direction",
+            "operator": "is",
+            "values": ["WANBOUND"]
+        }
+    ],
+    "dimension": [
+        {"fieldName": "user_name"},
+        {"fieldName": "application_name"}
+    ],
+    "measure": [
+        {"aggType": "sum", "fieldName": "upstream"},
+        {"aggType": "sum", "fieldName": "downstream"}
+    ]
+}
+
 
 def main():
     parser = argparse.ArgumentParser(description='Get WAN app stats from Cato and generate CSV reports')
-    parser.add_argument('--account-id', required=True, help='Cato account ID')
+    parser.add_argument('--account-id', nargs='+', default=[],
+                        help='Cato account ID, or several IDs separated by spaces or commas to report on each of them')
+    parser.add_argument('--accounts-file', help='File with one Cato account ID per line, # starts a comment (default: none)')
+    parser.add_argument('--account-workers', type=int, default=2,
+                        help='Number of accounts reported on at the same time, each with its own --workers queries (default: 2)')
+    parser.add_argument('--max-rps', type=float, default=0,
+                        help='Most API queries started per second, over all accounts and windows (default: no limit)')
+    parser.add_argument('--rollup', action='store_true',
+                        help='With several accounts, also write one CSV of the bandwidth per account and application')
     parser.add_argument('--days', type=int, default=14, help='Number of days to look back (default: 14)')
     parser.add_argument('--buckets', type=int, default=336, help='Number of time buckets (default: 336)')
     parser.add_argument('--granularity', type=int, default=3600, help='Granularity of the data in seconds (default: 3600)')
     parser.add_argument('--output-prefix', default='wan_app_stats', help='Output file prefix (default: wan_app_stats)')
+    parser.add_argument('--client', choices=['auto', 'api', 'catocli'], default='auto',
+                        help='Query the API directly (api) or through the catocli command (catocli). '
+                             'auto uses the API when credentials are found, otherwise catocli (default: auto)')
+    parser.add_argument('--profile', help='catocli profile to read the API key and endpoint from (default: the active catocli profile)')
+    parser.add_argument('--chunk-days', type=int, default=1,
+                        help='Split the time range into windows of this many days, fetched concurrently. 0 fetches the whole range in one query (default: 1)')
+    parser.add_argument('--workers', type=int, default=4, help='Number of windows fetched at the same time (default: 4)')
+    parser.add_argument('--retries', type=int, default=3, help='Retries per window after a failed or rate-limited query (default: 3)')
+    parser.add_argument('--pivot-format', choices=['wide', 'long'], default='wide',
+                        help='Summary layout: one row per application and one column per user (wide), '
+                             'or one application,user_name,bandwidth_mb row per pair (long) (default: wide)')
+    parser.add_argument('--top-apps', type=int, default=0,
+                        help='Only list the N applications with the most bandwidth in the summary, the rest as one (other) row (default: all)')
+    parser.add_argument('--top-users', type=int, default=0,
+                        help='Only list the N users with the most bandwidth in the summary, the rest as one other column (default: all)')
+    parser.add_argument('--stats', choices=['auto', 'exact', 'approx', 'none'], default='auto',
+                        help='Percentile and peak statistics CSV: exact (requires numpy), approx (streaming sketches, within 1%%), '
+                             'auto (exact when numpy is installed), or none (default: auto)')
+    parser.add_argument('--raw-format', choices=['gzip', 'zstd', 'json', 'none'], default='gzip',
+                        help='Raw API response archive: compact JSON, gzip or zstd compressed, or uncompressed (json), or none (default: gzip)')
+    parser.add_argument('--parquet', action='store_true', help='Also write the hourly records to a Parquet file (requires pyarrow)')
+    parser.add_argument('--cache', help='SQLite file caching the fetched buckets between runs. Only buckets newer than the cache are fetched (default: no cache)')
     
     args = parser.parse_args()
     
-    print(f"Fetching WAN app stats for last {args.days} days")
-    print(f"Account ID: {args.account_id}")
-    print(f"Buckets: {args.buckets}")
+    try:
+        account_ids = read_account_ids(args.account_id, args.accounts_file)
+    except OSError as e:
+        print(f"Failed to read accounts file: {e}")
+        return
+    if not account_ids:
+        print("No account ID given with --account-id or --accounts-file")
+        return
     
-    # Get data from catocli
-    data = get_wan_app_stats(args.account_id, args.days, args.buckets)
+    if args.raw_format == 'zstd' and zstandard is None:
+        print("--raw-format zstd requires the zstandard module: pip install zstandard")
+        return
+    if args.parquet and pyarrow is None:
+        print("--parquet requires the pyarrow module: pip install pyarrow")
+        return
+    if args.stats == 'exact' and np is None:
+        print("--stats exact requires the numpy module: pip install numpy")
+        return
+    if args.chunk_days > 0 and not whole_buckets(args.chunk_days * 86400, args.days * 86400 / args.buckets):
+        print(f"Warning: --chunk-days {args.chunk_days} is not a whole number of "
+              f"{args.days * 86400 / args.buckets:g}s buckets, fetching the range in one query (--chunk-days 0)")
+        args.chunk_days = 0
     
-    if not data:
-        print("Failed to get app stats data")
+    client = None
+    if args.client != 'catocli':
+        credentials = resolve_credentials(args.profile)
+        if credentials:
+            rate_limiter = RateLimiter(args.max_rps) if args.max_rps > 0 else None
+            client = CatoClient(credentials['endpoint'], credentials['cato_token'], rate_limiter=rate_limiter)
+        elif args.client == 'api':
+            print("No API key found in the catocli profile or the CATO_TOKEN environment variable")
+            return
+    if client is None and args.max_rps > 0:
+        # catocli runs in its own process per query, outside the shared limiter
+        print("--max-rps requires the API client, but the queries would run through catocli "
+              "(--client catocli, or no API key found)")
         return
     
+    # One cache for all accounts, whose reads and writes take turns
+    cache = BucketCache(args.cache) if args.cache else None
+    try:
+        if len(account_ids) == 1:
+            run_account_report(account_ids[0], args, client, args.output_prefix, cache)
+            return
+        
+        # One report per account, with the account ID in the file names. A failed
+        # account is reported at the end and does not stop the others
+        print(f"Reporting on {len(account_ids)} accounts, {args.account_workers} at a time")
+        with ThreadPoolExecutor(max_workers=args.account_workers) as executor:
+            futures = [
+                executor.submit(run_account_report_safely, account_id, args, client,
+                                f"{args.output_prefix}_{account_id}", cache)
+                for account_id in account_ids
+            ]
+            results = [future.result() for future in futures]
+    finally:
+        if cache is not None:
+            cache.close()
+    
+    print(f"\nAccounts:")
+    for account_id, result in zip(account_ids, results):
+        if result is None:
+            print(f"  - {account_id}: FAILED")
+        else:
+            print(f"  - {account_id}: {result['records']} records, {result['total']:.2f} MB")
+    
+    if args.rollup:
+        save_rollup_csv(account_ids, results, f"{args.output_prefix}_rollup.csv")
+
+def read_account_ids(account_args, accounts_file=None):
+    """Collect the account IDs of --account-id and --accounts-file, in order,
+    without duplicates"""
+    account_ids = []
+    for arg in account_args:
+        account_ids += arg.split(',')
+    if accounts_file:
+        with open(accounts_file) as f:
+            for line in f:
+                account_ids.append(line.split('#', 1)[0])
+    account_ids = [account_id.strip() for account_id in account_ids]
+    return list(dict.fromkeys(account_id for account_id in account_ids if account_id))
+
+def run_account_report_safely(account_id, args, client, output_prefix, cache=None):
+    """run_account_report() for one of several accounts: an exception fails
+    this account only"""
+    try:
+        return run_account_report(account_id, args, client, output_prefix, cache)
+    except Exception as e:
+        print(f"Report for account {account_id} failed: {e}")
+        return None
+
+def run_account_report(account_id, args, client, output_prefix, cache=None):
+    """Fetch the stats of one account and write its reports, through the
+    BucketCache `cache` if given. Returns the record count and the totals per
+    application and measure, or None if no data was fetched"""
+    print(f"[{account_id}] Fetching WAN app stats for last {args.days} days in {args.buckets} buckets")
+    
+    # Get data from the API, or from catocli when no client is configured
+    if cache is not None:
+        data = get_wan_app_stats_cached(cache, account_id, args.days, args.buckets, args.granularity,
+                                        args.chunk_days or args.days, args.workers, args.retries, client)
+    elif args.chunk_days > 0:
+        data = get_wan_app_stats_chunked(account_id, args.days, args.buckets, args.granularity,
+                                         args.chunk_days, args.workers, args.retries, client)
+    else:
+        data = get_wan_app_stats(account_id, args.days, args.buckets, client)
+    
+    if not data:
+        print(f"Failed to get app stats data for account {account_id}")
+        return None
+    
     # Save raw JSON
-    raw_filename = f"{args.output_prefix}_raw.json"
-    with open(raw_filename, 'w') as f:
-        json.dump(data, f, indent=2)
-    print(f"Saved raw data to {raw_filename}")
+    if args.raw_format != 'none':
+        raw_filename = save_raw_archive(data, output_prefix, args.raw_format)
+        print(f"Saved raw data to {raw_filename}")
     
-    # Process data
+    # Process data, then release the response, the records hold all that is left to write
     hourly_records = process_data_to_csv(data)
+    del data
     
-    if hourly_records:
-        # Save hourly CSV
-        hourly_filename = f"{args.output_prefix}_hourly.csv"
-        save_hourly_csv(hourly_records, hourly_filename)
-        
-        # Create pivot summary
-        summary_filename = f"{args.output_prefix}_summary.csv"
-        create_pivot_summary(hourly_records, summary_filename)
-        
-        # Print statistics
-        total_records = len(hourly_records)
-        total_bandwidth = sum(record['bandwidth_mb'] for record in hourly_records)
-        
-        # Calculate upstream and downstream totals
-        upstream_total = sum(record['bandwidth_mb'] for record in hourly_records if record['measure_type'] == 'upstream')
-        downstream_total = sum(record['bandwidth_mb'] for record in hourly_records if record['measure_type'] == 'downstream')
-        
-        print(f"\nStatistics:")
-        print(f"  - Total records: {total_records}")
-        print(f"  - Total bandwidth: {total_bandwidth:.2f} MB")
-        print(f"  - Total upstream: {upstream_total:.2f} MB")
-        print(f"  - Total downstream: {downstream_total:.2f} MB")
-        
-        # Top applications
-        app_totals = defaultdict(float)
-        for record in hourly_records:
-            app_totals[record['application']] += record['bandwidth_mb']
-        
-        top_apps = sorted(app_totals.items(), key=lambda x: x[1], reverse=True)[:10]
-        print(f"\nTop 10 Applications by Bandwidth:")
-        for app, bandwidth in top_apps:
-            print(f"  - {app}: {bandwidth:.2f} MB")
-        
-        # Usage by user
-        user_totals = defaultdict(float)
-        for record in hourly_records:
-            user_totals[record['user_name']] += record['bandwidth_mb']
-        
-        print(f"\nBandwidth by User:")
-        for user, bandwidth in sorted(user_totals.items(), key=lambda x: x[1], reverse=True):
-            user_display = user if user else "(Unknown)"
-            print(f"  - {user_display}: {bandwidth:.2f} MB")
-    else:
-        print("No data processed")
+    if not hourly_records:
+        print(f"[{account_id}] No data processed")
+        return {'records': 0, 'total': 0.0, 'applications_measures': {}}
+    
+    # Save hourly CSV
+    hourly_filename = f"{output_prefix}_hourly.csv"
+    save_hourly_csv(hourly_records, hourly_filename)
+    if args.parquet:
+        save_hourly_parquet(hourly_records, f"{output_prefix}_hourly.parquet")
+    
+    # Totals for the pivot summary and the statistics, in one pass
+    totals = aggregate_records(hourly_records)
+    
+    # Create pivot summary
+    summary_filename = f"{output_prefix}_summary.csv"
+    create_pivot_summary(hourly_records, totals, summary_filename,
+                         args.top_apps, args.top_users, args.pivot_format)
+    
+    # Percentiles and peaks of the hourly bandwidth
+    stats_rows = []
+    if args.stats != 'none':
+        start, end = report_range(args.days, args.granularity)
+        stats_rows = bandwidth_stats(hourly_records, args.days * 86400 / args.buckets, args.stats,
+                                     int(start.timestamp() * 1000), int(end.timestamp() * 1000))
+        save_stats_csv(stats_rows, f"{output_prefix}_stats.csv")
+    
+    # Print statistics, in one print so that those of concurrent accounts do not interleave
+    lines = [f"\nStatistics of account {account_id}:"]
+    lines.append(f"  - Total records: {len(hourly_records)}")
+    lines.append(f"  - Total bandwidth: {totals['total']:.2f} MB")
+    lines.append(f"  - Total upstream: {totals['measures'].get('upstream', 0):.2f} MB")
+    lines.append(f"  - Total downstream: {totals['measures'].get('downstream', 0):.2f} MB")
+    for row in stats_rows:
+        if row['group'] == 'total':
+            lines.append(f"  - Peak hour: {row['peak_hour']} ({row['peak_mb']:.2f} MB)")
+            lines.append(f"  - Hourly p95 / p99: {row['p95_mb']:.2f} / {row['p99_mb']:.2f} MB ({row['p95_mbps']:.2f} Mbps at p95)")
+    
+    # Top applications
+    top_apps = sorted(totals['applications'].items(), key=lambda x: x[1], reverse=True)[:10]
+    lines.append(f"\nTop 10 Applications by Bandwidth of account {account_id}:")
+    for app, bandwidth in top_apps:
+        lines.append(f"  - {app}: {bandwidth:.2f} MB")
+    
+    # Usage by user
+    lines.append(f"\nBandwidth by User of account {account_id}:")
+    for user, bandwidth in sorted(totals['users'].items(), key=lambda x: x[1], reverse=True):
+        user_display = user if user else "(Unknown)"
+        lines.append(f"  - {user_display}: {bandwidth:.2f} MB")
+    print('\n'.join(lines))
+    
+    return {
+        'records': len(hourly_records),
+        'total': totals['total'],
+        'applications_measures': application_measure_totals(hourly_records) if args.rollup else {},
+    }
 
 
 def exec_cli(command):
@@ -103,83 +329,611 @@ def exec_cli(command):
         print(f"Failed to execute command: {e}")
         return None
 
-def get_wan_app_stats(account_id, days=14, buckets=336):
-    """Get WAN app stats using the exact catocli command structure"""
-    query = {
-        "appStatsFilter": [
-            {
-                "fieldName": "traffic_direction",
-                "operator": "is",
-                "values": ["WANBOUND"]
-            }
-        ],
-        "buckets": buckets,
-        "dimension": [
-            {"fieldName": "user_name"},
-            {"fieldName": "application_name"}
-        ],
-        "measure": [
-            {"aggType": "sum", "fieldName": "upstream"},
-            {"aggType": "sum", "fieldName": "downstream"}
-        ],
-        "timeFrame": f"last.P{days}D"
-    }
+def resolve_credentials(profile=None):
+    """Find the API key and endpoint the way catocli does: the named profile, or
+    the CATO_PROFILE environment variable, or the active profile in
+    ~/.cato/config, read from ~/.cato/credentials. Falls back to the CATO_TOKEN
+    environment variable. Returns None when no API key is found."""
+    cato_dir = os.path.join(os.path.expanduser('~'), '.cato')
+    if not profile:
+        profile = os.getenv('CATO_PROFILE')
+    if not profile:
+        config = configparser.ConfigParser()
+        config.read(os.path.join(cato_dir, 'config'))
+        profile = config.get('default', 'profile', fallback='default')
+    
+    credentials = configparser.RawConfigParser()
+    credentials.read(os.path.join(cato_dir, 'credentials'))
+    if credentials.has_section(profile) and credentials.get(profile, 'cato_token', fallback=None):
+        return {
+            'endpoint': credentials.get(profile, 'endpoint', fallback=DEFAULT_ENDPOINT),
+            'cato_token': credentials.get(profile, 'cato_token'),
+        }
+    if os.getenv('CATO_TOKEN'):
+        return {'endpoint': DEFAULT_ENDPOINT, 'cato_token': os.getenv('CATO_TOKEN')}
+    return None
+
+class RateLimiter:
+    """Spaces out queries to at most `rate` per second, over all the threads
+    that share it"""
+    
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def wait(self):
+        """Block until the next query may start"""
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+class CatoClient:
+    """Minimal GraphQL client for the Cato API. Connections are kept alive and
+    reused between queries, and responses are requested gzip-compressed. The
+    client is shared by all threads, and so is its optional RateLimiter."""
+    
+    def __init__(self, endpoint, api_key, timeout=120, rate_limiter=None):
+        url = urllib.parse.urlsplit(endpoint)
+        self.scheme = url.scheme
+        self.host = url.netloc
+        self.path = url.path or '/'
+        self.api_key = api_key
+        self.timeout = timeout
+        self.ssl_context = ssl.create_default_context()
+        self.rate_limiter = rate_limiter
+        self.idle = []
+        self.lock = threading.Lock()
+    
+    def _connection(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        if self.scheme == 'http':
+            return http.client.HTTPConnection(self.host, timeout=self.timeout)
+        return http.client.HTTPSConnection(self.host, timeout=self.timeout, context=self.ssl_context)
+    
+    def _release(self, connection):
+        with self.lock:
+            self.idle.append(connection)
+    
+    def query(self, query, variables, operation_name=None):
+        """Post a query and return the parsed JSON response, or None on error"""
+        body = json.dumps({'query': query, 'variables': variables, 'operationName': operation_name}).encode('utf-8')
+        headers = {
+            'Content-Type': 'application/json',
+            'Accept-Encoding': 'gzip',
+            'x-api-key': self.api_key,
+        }
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait()
+        # a kept-alive connection may have been closed by the server, so retry
+        # once on a fresh connection
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request('POST', self.path, body, headers)
+                response = connection.getresponse()
+                payload = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                if attempt == 0:
+                    continue
+                print(f"Failed to query the API: {e}")
+                return None
+            self._release(connection)
+            break
+        
+        if response.getheader('Content-Encoding') == 'gzip':
+            payload = gzip.decompress(payload)
+        if response.status != 200:
+            print(f"API request failed with HTTP status {response.status}")
+            print(f"Error: {payload.decode('utf-8', errors='replace')}")
+            return None
+        try:
+            result = json.loads(payload)
+        except json.JSONDecodeError as e:
+            print(f"Failed to parse JSON response: {e}")
+            return None
+        if result.get('errors'):
+            print(f"API returned errors: {json.dumps(result['errors'])}")
+        return result
+
+def get_wan_app_stats(account_id, days=14, buckets=336, client=None, time_frame=None):
+    """Get WAN app stats with the same query catocli sends. Uses the in-process
+    client when one is given, otherwise runs catocli"""
+    query = dict(WAN_APP_STATS_QUERY, buckets=buckets, timeFrame=time_frame or f"last.P{days}D")
+    
+    if client is not None:
+        print(f"[{account_id}] Querying appStatsTimeSeries at {client.host} for {query['timeFrame']}")
+        started = time.monotonic()
+        result = client.query(APP_STATS_QUERY, dict(query, accountID=account_id), 'appStatsTimeSeries')
+        print(f"[{account_id}] Query completed in {time.monotonic() - started:.2f}s")
+        return result
     
     command = f"catocli query appStatsTimeSeries -accountID={account_id} '{json.dumps(query)}'"
     return exec_cli(command)
 
+def format_time_frame(start, end):
+    """Format a UTC window as a Cato utc.* TimeFrame. The end is inclusive, so
+    the window stops one second before end"""
+    end = end - timedelta(seconds=1)
+    if start.year != end.year:
+        return f"utc.{{{start:%Y-%m-%d/%H:%M:%S}--{end:%Y-%m-%d/%H:%M:%S}}}"
+    if start.month != end.month:
+        return f"utc.{start:%Y}-{{{start:%m-%d/%H:%M:%S}--{end:%m-%d/%H:%M:%S}}}"
+    return f"utc.{start:%Y-%m}-{{{start:%d/%H:%M:%S}--{end:%d/%H:%M:%S}}}"
+
+def report_range(days, granularity, now=None):
+    """Return the start and end of the last `days` days. The range ends at the
+    next bucket boundary, so it starts and ends on bucket boundaries"""
+    now = now or datetime.now(timezone.utc)
+    end = datetime.fromtimestamp(-(-int(now.timestamp()) // granularity) * granularity, timezone.utc)
+    return end - timedelta(days=days), end
+
+def time_windows(days, granularity, chunk_days, now=None):
+    """Split the last `days` days into windows of `chunk_days` days, oldest
+    first. Windows start on bucket boundaries, so no bucket is split between
+    two windows"""
+    start, end = report_range(days, granularity, now)
+    return split_range(start, end, chunk_days)
+
+def split_range(start, end, chunk_days):
+    windows = []
+    while start < end:
+        window_end = min(start + timedelta(days=chunk_days), end)
+        windows.append((start, window_end))
+        start = window_end
+    return windows
+
+def whole_buckets(seconds, bucket_seconds):
+    """Whether `seconds` is a whole number of buckets, so that a window of
+    that length gets buckets of the same width as the whole range"""
+    count = seconds / bucket_seconds
+    return abs(count - round(count)) < 1e-9
+
+def fetch_window(account_id, start, end, buckets, retries, client):
+    """Fetch one window, retrying failed and rate-limited queries with backoff"""
+    time_frame = format_time_frame(start, end)
+    for attempt in range(retries + 1):
+        if attempt:
+            delay = 2 ** attempt
+            print(f"[{account_id}] Retrying {time_frame} in {delay}s (attempt {attempt + 1} of {retries + 1})")
+            time.sleep(delay)
+        result = get_wan_app_stats(account_id, buckets=buckets, client=client, time_frame=time_frame)
+        if result is None:
+            continue
+        if result.get('errors'):
+            if 'rate limit' in json.dumps(result['errors']).lower():
+                continue
+            # not transient, a retry would fail the same way
+            return None
+        return result
+    return None
+
+def merge_timeseries(results, query_name='appStatsTimeSeries'):
+    """Stitch the `query_name` responses of consecutive windows into one
+    response of the same shape, joining the series by label and the points
+    by timestamp. The windows are in time order and do not overlap, so the
+    points of each window are appended to the series, and each window is
+    released from `results` once it has been merged. A bucket split between
+    two windows is added up, which raises ValueError for series that are
+    not sums or counts"""
+    if len(results) == 1:
+        return results[0]
+    
+    first = results[0]['data'][query_name]
+    last = results[-1]['data'][query_name]
+    merged = {}
+    for index, result in enumerate(results):
+        results[index] = None
+        for series in result['data'][query_name].get('timeseries') or []:
+            label = series.get('label', '')
+            data = series.get('data') or []
+            if label not in merged:
+                merged[label] = series
+                continue
+            merged_data = merged[label].setdefault('data', [])
+            if data and merged_data and merged_data[-1][0] == data[0][0]:
+                # a bucket split at the window boundary: the sums add up
+                aggregation = label.split('(', 1)[0]
+                if aggregation not in ('sum', 'count'):
+                    raise ValueError(f"{label} has a bucket split between two windows, "
+                                     f"and {aggregation} values cannot be added up")
+                merged_data[-1] = [data[0][0], (merged_data[-1][1] or 0) + (data[0][1] or 0)]
+                data = data[1:]
+            merged_data.extend(data)
+    
+    timeseries = list(merged.values())
+    for series in timeseries:
+        if series.get('sum') is not None:
+            series['sum'] = sum(value or 0 for _, value in series['data'])
+    
+    return {
+        'data': {
+            query_name: {
+                'from': first.get('from'),
+                'to': last.get('to'),
+                'granularity': first.get('granularity'),
+                'timeseries': timeseries,
+            }
+        }
+    }
+
+def get_wan_app_stats_chunked(account_id, days, buckets, granularity, chunk_days, workers, retries, client=None):
+    """Get WAN app stats for the last `days` days as concurrent queries over
+    windows of `chunk_days` days, merged into one response"""
+    windows = time_windows(days, granularity, chunk_days)
+    print(f"[{account_id}] Fetching {len(windows)} windows of up to {chunk_days} days with {workers} workers")
+    results = fetch_windows(account_id, windows, days * 86400 / buckets, workers, retries, client)
+    if results is None:
+        return None
+    return merge_timeseries(results)
+
+def fetch_windows(account_id, windows, bucket_seconds, workers, retries, client):
+    """Fetch the windows concurrently. Returns the responses in window order,
+    or None if any window failed"""
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(fetch_window, account_id, start, end,
+                            max(1, round((end - start).total_seconds() / bucket_seconds)), retries, client)
+            for start, end in windows
+        ]
+        results = [future.result() for future in futures]
+    
+    for (start, end), result in zip(windows, results):
+        if result is None or 'appStatsTimeSeries' not in (result.get('data') or {}):
+            print(f"[{account_id}] Failed to get app stats for {format_time_frame(start, end)}")
+            return None
+    print(f"[{account_id}] Fetched {len(windows)} windows in {time.monotonic() - started:.2f}s")
+    return results
+
+class BucketCache:
+    """Buckets fetched by earlier runs, in a SQLite file. Buckets are keyed by
+    account, query shape, series label and timestamp. `coverage` records the
+    range of complete buckets held for an account and query shape.
+    
+    One cache is shared by the accounts of a run. SQLite lets one writer at a
+    time in, and storing a large tenant takes longer than its busy timeout,
+    so the reports of concurrent accounts take turns on the connection"""
+    
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS buckets (
+        account_id TEXT NOT NULL,
+        shape TEXT NOT NULL,
+        label TEXT NOT NULL,
+        ts INTEGER NOT NULL,
+        value REAL,
+        PRIMARY KEY (account_id, shape, label, ts)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS series (
+        account_id TEXT NOT NULL,
+        shape TEXT NOT NULL,
+        label TEXT NOT NULL,
+        info TEXT NOT NULL,
+        PRIMARY KEY (account_id, shape, label)
+    );
+    CREATE TABLE IF NOT EXISTS coverage (
+        account_id TEXT NOT NULL,
+        shape TEXT NOT NULL,
+        start_ms INTEGER NOT NULL,
+        end_ms INTEGER NOT NULL,
+        PRIMARY KEY (account_id, shape)
+    );
+    """
+    
+    def __init__(self, path):
+        # another process writing the same file is waited for, for longer
+        # than a large store takes
+        self.db = sqlite3.connect(path, timeout=300, check_same_thread=False)
+        self.db.executescript(self.SCHEMA)
+        self.lock = threading.Lock()
+    
+    def close(self):
+        with self.lock:
+            self.db.close()
+    
+    def coverage(self, account_id, shape):
+        """Return (start_ms, end_ms) of the complete buckets held, or None"""
+        with self.lock:
+            row = self.db.execute("SELECT start_ms, end_ms FROM coverage WHERE account_id = ? AND shape = ?",
+                                  (account_id, shape)).fetchone()
+        return tuple(row) if row else None
+    
+    def store(self, account_id, shape, results, start_ms, end_ms):
+        """Add the fetched responses, drop buckets before start_ms and record
+        that the buckets from start_ms to end_ms are complete"""
+        with self.lock, self.db:
+            for result in results:
+                for series in result['data']['appStatsTimeSeries'].get('timeseries') or []:
+                    label = series.get('label', '')
+                    info = {key: value for key, value in series.items() if key not in ('data', 'sum')}
+                    self.db.execute("INSERT OR REPLACE INTO series (account_id, shape, label, info) VALUES (?, ?, ?, ?)",
+                                    (account_id, shape, label, json.dumps(info)))
+                    self.db.executemany(
+                        "INSERT OR REPLACE INTO buckets (account_id, shape, label, ts, value) VALUES (?, ?, ?, ?, ?)",
+                        [(account_id, shape, label, timestamp_ms, value) for timestamp_ms, value in series.get('data', [])])
+            self.db.execute("DELETE FROM buckets WHERE account_id = ? AND shape = ? AND ts < ?",
+                            (account_id, shape, start_ms))
+            self.db.execute("INSERT OR REPLACE INTO coverage (account_id, shape, start_ms, end_ms) VALUES (?, ?, ?, ?)",
+                            (account_id, shape, start_ms, end_ms))
+    
+    def load(self, account_id, shape, start_ms, end_ms):
+        """Return the cached buckets from start_ms to end_ms as a response"""
+        with self.lock:
+            series_info = {label: json.loads(info) for label, info in self.db.execute(
+                "SELECT label, info FROM series WHERE account_id = ? AND shape = ?", (account_id, shape))}
+            points = defaultdict(list)
+            for label, timestamp_ms, value in self.db.execute(
+                    "SELECT label, ts, value FROM buckets WHERE account_id = ? AND shape = ? AND ts >= ? AND ts < ?"
+                    " ORDER BY label, ts", (account_id, shape, start_ms, end_ms)):
+                points[label].append([timestamp_ms, value])
+        
+        timeseries = []
+        for label, data in points.items():
+            series = dict(series_info.get(label, {'label': label}))
+            series['data'] = data
+            series['sum'] = sum(value or 0 for _, value in data)
+            timeseries.append(series)
+        return {
+            'data': {
+                'appStatsTimeSeries': {
+                    'from': datetime.fromtimestamp(start_ms / 1000, timezone.utc).isoformat(),
+                    'to': datetime.fromtimestamp(end_ms / 1000, timezone.utc).isoformat(),
+                    'timeseries': timeseries,
+                }
+            }
+        }
+
+def query_shape(bucket_seconds):
+    """Identify the filters, dimensions, measures and bucket size of the query"""
+    shape = dict(WAN_APP_STATS_QUERY, bucketSeconds=bucket_seconds)
+    return hashlib.sha256(json.dumps(shape, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def get_wan_app_stats_cached(cache, account_id, days, buckets, granularity, chunk_days, workers, retries, client=None):
+    """Get WAN app stats for the last `days` days, fetching only the buckets
+    that are not in the cache. The last bucket of each run is still filling
+    up, so it is not counted as cached and is fetched again by the next run"""
+    start, end = report_range(days, granularity)
+    bucket_seconds = days * 86400 / buckets
+    shape = query_shape(bucket_seconds)
+    start_ms, end_ms = int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+    
+    missing = [(start_ms, end_ms)]
+    coverage = cache.coverage(account_id, shape)
+    if coverage and coverage[0] < end_ms and coverage[1] > start_ms:
+        missing = [(a, b) for a, b in ((start_ms, coverage[0]), (coverage[1], end_ms)) if a < b]
+        print(f"[{account_id}] Cache holds {(min(coverage[1], end_ms) - max(coverage[0], start_ms)) // 3600000} hours of this range")
+        # gaps that are not whole buckets would be fetched with buckets of
+        # another width than the cached ones
+        if not all(whole_buckets((b - a) / 1000, bucket_seconds) for a, b in missing):
+            print(f"[{account_id}] The cached range does not end on a bucket boundary of this run, fetching the whole range")
+            missing = [(start_ms, end_ms)]
+    
+    windows = []
+    for a, b in missing:
+        windows += split_range(datetime.fromtimestamp(a / 1000, timezone.utc),
+                               datetime.fromtimestamp(b / 1000, timezone.utc), chunk_days)
+    print(f"[{account_id}] Fetching {len(windows)} windows not in the cache with {workers} workers")
+    results = fetch_windows(account_id, windows, bucket_seconds, workers, retries, client)
+    if results is None:
+        return None
+    
+    cache.store(account_id, shape, results, start_ms, end_ms - int(bucket_seconds * 1000))
+    return cache.load(account_id, shape, start_ms, end_ms)
+
+# Example label: "sum(downstream) for application_name='Company APP', user_name='PM Analyst'"
+APPLICATION_PATTERN = re.compile(r"application_name='([^']+)'")
+USER_PATTERN = re.compile(r"user_name='([^']+)'")
+MEASURE_PATTERN = re.compile(r"sum\(([^)]+)\)")
+
+@functools.lru_cache(maxsize=None)
+def parse_label(label):
+    """Extract the application, user and measure from a series label"""
+    app_match = APPLICATION_PATTERN.search(label)
+    user_match = USER_PATTERN.search(label)
+    measure_match = MEASURE_PATTERN.search(label)
+    return (app_match.group(1) if app_match else 'Unknown',
+            user_match.group(1) if user_match else 'Unknown',
+            measure_match.group(1) if measure_match else 'unknown')
+
+def format_hour(timestamp_ms):
+    return datetime.fromtimestamp(timestamp_ms / 1000).strftime('%Y-%m-%d %H:%M:%S')
+
+class SeriesRecords:
+    """Records of time series stored by column: one row per dimension values,
+    measure and bucket. Timestamps and values are arrays, dimension values and
+    measures are stored once and referenced by code, and each bucket time is
+    formatted once per distinct timestamp. Untimed records, such as those of
+    appStats, have a timestamp of 0 and no time column"""
+    
+    def __init__(self, dimensions, timed=True):
+        self.dimensions = list(dimensions)
+        self.timed = timed
+        self.names = [[] for _ in self.dimensions]
+        self.measures = []
+        self.times = {}
+        self.timestamps = array('q')
+        self.codes = [array('i') for _ in self.dimensions]
+        self.measure_codes = array('i')
+        self.values = array('d')
+        self._codes = {}
+    
+    def __len__(self):
+        return len(self.values)
+    
+    def _code(self, names, name):
+        codes = self._codes.setdefault(id(names), {})
+        if name not in codes:
+            codes[name] = len(names)
+            names.append(name)
+        return codes[name]
+    
+    def add_series(self, values, measure, points):
+        """Append the (timestamp_ms, value) points of one series. `values` are
+        the dimension values of the series, in dimension order"""
+        count = len(points)
+        self.timestamps.extend(timestamp_ms for timestamp_ms, _ in points)
+        self.values.extend(value for _, value in points)
+        for names, codes, value in zip(self.names, self.codes, values):
+            codes.extend(itertools.repeat(self._code(names, value), count))
+        self.measure_codes.extend(itertools.repeat(self._code(self.measures, measure), count))
+    
+    def time_name(self, timestamp_ms):
+        return self.times.get(timestamp_ms) or format_hour(timestamp_ms)
+    
+    def sort_by_time(self):
+        """Order the records by bucket timestamp, keeping the order of records
+        within a bucket. Series added in dimension and measure order end up
+        sorted by time, then dimensions, then measure. The two hours of a DST
+        fall-back are kept apart, one after the other"""
+        if not self.timed:
+            return
+        for timestamp_ms in set(self.timestamps):
+            if timestamp_ms not in self.times:
+                self.times[timestamp_ms] = format_hour(timestamp_ms)
+        
+        keys = self.timestamps
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        self.timestamps = array('q', [self.timestamps[i] for i in order])
+        self.measure_codes = array('i', [self.measure_codes[i] for i in order])
+        self.values = array('d', [self.values[i] for i in order])
+        self.codes = [array('i', [codes[i] for i in order]) for codes in self.codes]
+    
+    def rows(self):
+        """Yield ([time,] dimension values..., measure, value) rows"""
+        names, measures, times = self.names, self.measures, self.times
+        for timestamp_ms, measure, value, *codes in zip(self.timestamps, self.measure_codes, self.values, *self.codes):
+            row = [names[index][code] for index, code in enumerate(codes)]
+            if self.timed:
+                row.insert(0, times[timestamp_ms])
+            row += [measures[measure], value]
+            yield row
+
+class HourlyRecords(SeriesRecords):
+    """Hourly records of the WAN app stats, by application and user.
+    `bucket_timestamps` holds every bucket of the response, including those
+    without a record"""
+    
+    def __init__(self):
+        super().__init__(['application', 'user_name'])
+        self.bucket_timestamps = set()
+    
+    @property
+    def applications(self):
+        return self.names[0]
+    
+    @property
+    def users(self):
+        return self.names[1]
+    
+    @property
+    def application_codes(self):
+        return self.codes[0]
+    
+    @property
+    def user_codes(self):
+        return self.codes[1]
+
 def process_data_to_csv(data):
     """Process the JSON timeseries data into hourly records"""
     if not data or 'data' not in data or 'appStatsTimeSeries' not in data['data']:
         print("No valid app stats data found")
-        return []
+        return HourlyRecords()
     
     app_stats = data['data']['appStatsTimeSeries']
     if 'timeseries' not in app_stats:
         print("No timeseries found in app stats data")
-        return []
+        return HourlyRecords()
     
-    hourly_records = []
+    hourly_records = HourlyRecords()
     
-    # Parse each timeseries
-    for series in app_stats['timeseries']:
-        label = series.get('label', '')
-        data_points = series.get('data', [])
-        
-        # Extract application and user from the label using regex
-        # Example: "sum(downstream) for application_name='Company APP', user_name='PM Analyst'"
-        app_match = re.search(r"application_name='([^']+)'", label)
-        user_match = re.search(r"user_name='([^']+)'", label)
-        measure_match = re.search(r"sum\(([^)]+)\)", label)
-        
-        application_name = app_match.group(1) if app_match else 'Unknown'
-        user_name = user_match.group(1) if user_match else 'Unknown'
-        measure_type = measure_match.group(1) if measure_match else 'unknown'
-        
-        # Process each data point in the timeseries
-        for timestamp_ms, value in data_points:
-            if value > 0:  # Only include non-zero values
-                # Convert timestamp from milliseconds to datetime
-                timestamp_sec = timestamp_ms / 1000
-                dt = datetime.fromtimestamp(timestamp_sec)
-                hour_str = dt.strftime('%Y-%m-%d %H:%M:%S')
-                
-                # Data is already in MB
-                bandwidth_mb = round(value, 3)
-                
-                hourly_records.append({
-                    'hour': hour_str,
-                    'application': application_name,
-                    'user_name': user_name,
-                    'measure_type': measure_type,
-                    'bandwidth_mb': bandwidth_mb
-                })
+    # Parse each timeseries, in application, user and measure order
+    labelled_series = sorted(((parse_label(series.get('label', '')), series) for series in app_stats['timeseries']),
+                             key=lambda x: x[0])
+    for (application_name, user_name, measure_type), series in labelled_series:
+        # Only include non-zero values, but keep every bucket for the
+        # statistics. Data is already in MB
+        hourly_records.bucket_timestamps.update(timestamp_ms for timestamp_ms, _ in series.get('data', []))
+        points = [(timestamp_ms, round(value, 3)) for timestamp_ms, value in series.get('data', []) if value and value > 0]
+        hourly_records.add_series((application_name, user_name), measure_type, points)
     
     # Sort by hour, then application, then user
-    hourly_records.sort(key=lambda x: (x['hour'], x['application'], x['user_name'], x['measure_type']))
+    hourly_records.sort_by_time()
     
     return hourly_records
 
+def aggregate_records(hourly_records):
+    """Total the bandwidth overall, per measure, per application, per user and
+    per application and user, in a single pass over the records"""
+    total = 0.0
+    measure_totals = defaultdict(float)
+    app_totals = defaultdict(float)
+    user_totals = defaultdict(float)
+    app_user_totals = defaultdict(float)
+    for a, u, m, value in zip(hourly_records.application_codes, hourly_records.user_codes,
+                              hourly_records.measure_codes, hourly_records.values):
+        total += value
+        measure_totals[m] += value
+        app_totals[a] += value
+        user_totals[u] += value
+        app_user_totals[a, u] += value
+    
+    applications, users = hourly_records.applications, hourly_records.users
+    return {
+        'total': total,
+        'measures': {hourly_records.measures[m]: value for m, value in measure_totals.items()},
+        'applications': {applications[a]: value for a, value in app_totals.items()},
+        'users': {users[u]: value for u, value in user_totals.items()},
+        'applications_users': {(applications[a], users[u]): value for (a, u), value in app_user_totals.items()},
+    }
+
+def application_measure_totals(hourly_records):
+    """Total the bandwidth per application and measure, for the rollup"""
+    totals = defaultdict(float)
+    for a, m, value in zip(hourly_records.application_codes, hourly_records.measure_codes, hourly_records.values):
+        totals[a, m] += value
+    return {(hourly_records.applications[a], hourly_records.measures[m]): value for (a, m), value in totals.items()}
+
+def save_rollup_csv(account_ids, results, filename):
+    """Save the bandwidth of every account and application, one row each,
+    accounts in the order given and applications by total descending"""
+    with open(filename, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['account_id', 'application', 'upstream_mb', 'downstream_mb', 'total_mb'])
+        rows = 0
+        for account_id, result in zip(account_ids, results):
+            if result is None:
+                continue
+            applications = defaultdict(dict)
+            for (app, measure), bandwidth in result['applications_measures'].items():
+                applications[app][measure] = bandwidth
+            for app, measures in sorted(applications.items(), key=lambda x: (-round(sum(x[1].values()), 3), x[0])):
+                writer.writerow([account_id, app, round(measures.get('upstream', 0), 3),
+                                 round(measures.get('downstream', 0), 3), round(sum(measures.values()), 3)])
+                rows += 1
+    print(f"Created {filename} with {rows} rows")
+
+RAW_EXTENSIONS = {'json': '.json', 'gzip': '.json.gz', 'zstd': '.json.zst'}
+
+def save_raw_archive(data, output_prefix, raw_format):
+    """Write the raw response as compact JSON, encoded and compressed as it is
+    written. Returns the file name"""
+    filename = f"{output_prefix}_raw{RAW_EXTENSIONS[raw_format]}"
+    if raw_format == 'gzip':
+        f = gzip.open(filename, 'wt', encoding='utf-8', compresslevel=6)
+    elif raw_format == 'zstd':
+        f = io.TextIOWrapper(zstandard.ZstdCompressor(level=9).stream_writer(open(filename, 'wb')), encoding='utf-8')
+    else:
+        f = open(filename, 'w', encoding='utf-8')
+    with f:
+        json.dump(data, f, separators=(',', ':'))
+    return filename
+
 def save_hourly_csv(hourly_records, filename):
     """Save hourly timeseries data to CSV in the format: hour,application,user_name,measure_type,bandwidth_mb"""
     if not hourly_records:
@@ -187,66 +941,168 @@ def save_hourly_csv(hourly_records, filename):
         return
     
     with open(filename, 'w', newline='') as csvfile:
-        fieldnames = ['hour', 'application', 'user_name', 'measure_type', 'bandwidth_mb']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(hourly_records)
+        writer = csv.writer(csvfile)
+        writer.writerow(['hour', 'application', 'user_name', 'measure_type', 'bandwidth_mb'])
+        writer.writerows(hourly_records.rows())
     
     print(f"Created {filename} with {len(hourly_records)} hourly records")
 
-def create_pivot_summary(hourly_records, filename):
-    """Create a pivot table summary by application and user from hourly records"""
-    if not hourly_records:
+# Name of the row and column that --top-apps and --top-users merge the rest into
+OTHER = '(other)'
+
+# Largest application x user matrix summed as a dense array. Larger pivots
+# are mostly empty and are summed as sparse (row, column) cells instead
+DENSE_PIVOT_CELLS = 1 << 22
+
+def pivot_cells_numpy(hourly_records, top_apps=0, top_users=0):
+    """Aggregate the records into application x user cells with numpy. Returns
+    the application and user names and the cells as (row, column, bandwidth),
+    sorted by row and column. Rows and columns are in name order, with the
+    (other) row and column last"""
+    def name_ranks(names):
+        ranks = np.empty(len(names), dtype=np.int64)
+        ranks[sorted(range(len(names)), key=names.__getitem__)] = np.arange(len(names))
+        return ranks
+    
+    def merge(rows, cols, values, columns):
+        # one cell per non-empty (row, column), summed in record order
+        keys = rows * columns + cols
+        if (rows.max() + 1) * columns <= DENSE_PIVOT_CELLS:
+            matrix = np.bincount(keys, weights=values)
+            cells = np.flatnonzero(matrix)
+            sums = matrix[cells]
+        else:
+            cells, inverse = np.unique(keys, return_inverse=True)
+            sums = np.bincount(inverse.ravel(), weights=values)
+        return cells // columns, cells % columns, sums
+    
+    def top(index, values, count, n):
+        # new index of every row or column: top n by bandwidth keep their
+        # order, the rest map to n (other)
+        totals = np.bincount(index, weights=values, minlength=count)
+        keep = np.zeros(count, dtype=bool)
+        keep[np.argsort(-totals, kind='stable')[:n]] = True
+        return keep, np.where(keep, np.cumsum(keep) - 1, n)
+    
+    applications = sorted(hourly_records.applications)
+    users = sorted(hourly_records.users)
+    rows = name_ranks(hourly_records.applications)[np.frombuffer(hourly_records.application_codes, dtype=np.int32)]
+    cols = name_ranks(hourly_records.users)[np.frombuffer(hourly_records.user_codes, dtype=np.int32)]
+    rows, cols, values = merge(rows, cols, np.frombuffer(hourly_records.values, dtype=np.float64), len(users))
+    
+    if top_users and len(users) > top_users:
+        keep, index = top(cols, values, len(users), top_users)
+        users = [user for user, kept in zip(users, keep) if kept] + [OTHER]
+        rows, cols, values = merge(rows, index[cols], values, len(users))
+    if top_apps and len(applications) > top_apps:
+        keep, index = top(rows, values, len(applications), top_apps)
+        applications = [app for app, kept in zip(applications, keep) if kept] + [OTHER]
+        rows, cols, values = merge(index[rows], cols, values, len(users))
+    
+    return applications, users, list(zip(rows.tolist(), cols.tolist(), values.tolist()))
+
+def pivot_cells(app_user_data, top_apps=0, top_users=0):
+    """Same as pivot_cells_numpy(), from the application/user totals of
+    aggregate_records(), for when numpy is not installed"""
+    def top(names, cells, axis, n):
+        totals = defaultdict(float)
+        for cell, bandwidth in cells:
+            totals[cell[axis]] += bandwidth
+        kept = sorted(sorted(range(len(names)), key=lambda i: totals[i], reverse=True)[:n])
+        index = defaultdict(lambda: n, {old: new for new, old in enumerate(kept)})
+        return [names[i] for i in kept] + [OTHER], index
+    
+    def merge(cells, row_index, col_index):
+        merged = defaultdict(float)
+        for (row, col), bandwidth in cells:
+            merged[row_index[row], col_index[col]] += bandwidth
+        return sorted(merged.items())
+    
+    applications = sorted(set(app for app, _ in app_user_data))
+    users = sorted(set(user for _, user in app_user_data))
+    app_index = {app: i for i, app in enumerate(applications)}
+    user_index = {user: i for i, user in enumerate(users)}
+    cells = sorted(((app_index[app], user_index[user]), bandwidth) for (app, user), bandwidth in app_user_data.items())
+    
+    if top_users and len(users) > top_users:
+        users, index = top(users, cells, 1, top_users)
+        cells = merge(cells, range(len(applications)), index)
+    if top_apps and len(applications) > top_apps:
+        applications, index = top(applications, cells, 0, top_apps)
+        cells = merge(cells, index, range(len(users)))
+    
+    return applications, users, [(row, col, bandwidth) for (row, col), bandwidth in cells]
+
+def save_hourly_parquet(hourly_records, filename):
+    """Save the hourly records to Parquet, with the same columns as the CSV.
+    The arrays are handed to pyarrow without copying, and the hour,
+    application, user and measure columns are dictionary encoded"""
+    def column(values, arrow_type):
+        return pyarrow.Array.from_buffers(arrow_type, len(values), [None, pyarrow.py_buffer(values)])
+    
+    def codes(values):
+        return column(values, pyarrow.int32())
+    
+    hour_names = sorted(set(hourly_records.times.values()))
+    hour_codes = {hour: code for code, hour in enumerate(hour_names)}
+    timestamp_codes = {timestamp_ms: hour_codes[hour] for timestamp_ms, hour in hourly_records.times.items()}
+    hours = array('i', map(timestamp_codes.__getitem__, hourly_records.timestamps))
+    
+    table = pyarrow.table({
+        'hour': pyarrow.DictionaryArray.from_arrays(codes(hours), pyarrow.array(hour_names)),
+        'application': pyarrow.DictionaryArray.from_arrays(codes(hourly_records.application_codes), pyarrow.array(hourly_records.applications)),
+        'user_name': pyarrow.DictionaryArray.from_arrays(codes(hourly_records.user_codes), pyarrow.array(hourly_records.users)),
+        'measure_type': pyarrow.DictionaryArray.from_arrays(codes(hourly_records.measure_codes), pyarrow.array(hourly_records.measures)),
+        'bandwidth_mb': column(hourly_records.values, pyarrow.float64()),
+    })
+    pyarrow.parquet.write_table(table, filename, compression='zstd')
+    print(f"Created {filename} with {len(hourly_records)} hourly records")
+
+def create_pivot_summary(hourly_records, totals, filename, top_apps=0, top_users=0, pivot_format='wide'):
+    """Create a pivot table summary by application and user. Applications are
+    ordered by total bandwidth, descending, with the (other) row last"""
+    if not totals['applications_users']:
         print("No data to create pivot summary")
         return
     
-    # Aggregate data by application and user
-    app_user_data = defaultdict(float)
-    applications = set()
-    users = set()
+    if np is not None:
+        applications, users, cells = pivot_cells_numpy(hourly_records, top_apps, top_users)
+    else:
+        applications, users, cells = pivot_cells(totals['applications_users'], top_apps, top_users)
     
-    for record in hourly_records:
-        app = record['application']
-        user = record['user_name']
-        bandwidth = record['bandwidth_mb']
-        
-        applications.add(app)
-        users.add(user)
-        app_user_data[(app, user)] += bandwidth
-    
-    # Create pivot table
-    pivot_rows = []
-    for app in sorted(applications):
-        row_data = {'application': app}
-        app_total = 0
-        
-        for user in sorted(users):
-            user_display = user if user else "Unknown"
-            bandwidth = app_user_data.get((app, user), 0)
-            row_data[f"{user_display}_mb"] = round(bandwidth, 3) if bandwidth > 0 else 0
-            app_total += bandwidth
-        
-        row_data['total_mb'] = round(app_total, 3)
-        pivot_rows.append(row_data)
+    # Cells and totals of each application, adding the users in name order
+    row_cells = [[] for _ in applications]
+    row_totals = [0] * len(applications)
+    for row, col, bandwidth in cells:
+        row_cells[row].append((col, bandwidth))
+        row_totals[row] += bandwidth
     
     # Sort by total bandwidth descending
-    pivot_rows.sort(key=lambda x: x['total_mb'], reverse=True)
-    
-    # Write to CSV
-    if pivot_rows:
-        fieldnames = ['application']
-        for user in sorted(users):
-            user_display = user if user else "Unknown"
-            fieldnames.append(f"{user_display}_mb")
-        fieldnames.append('total_mb')
-        
-        with open(filename, 'w', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(pivot_rows)
-        
-        print(f"Created {filename} with {len(pivot_rows)} applications")
-
+    order = [row for row in range(len(applications)) if applications[row] is not OTHER]
+    order.sort(key=lambda row: round(row_totals[row], 3), reverse=True)
+    order += [row for row in range(len(applications)) if applications[row] is OTHER]
+    
+    with open(filename, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        if pivot_format == 'long':
+            writer.writerow(['application', 'user_name', 'bandwidth_mb'])
+            for row in order:
+                for col, bandwidth in row_cells[row]:
+                    writer.writerow([applications[row], users[col] or "Unknown", round(bandwidth, 3)])
+        else:
+            header = ['application']
+            for user in users:
+                user_display = 'other' if user is OTHER else user if user else "Unknown"
+                header.append(f"{user_display}_mb")
+            header.append('total_mb')
+            writer.writerow(header)
+            for row in order:
+                values = [0] * len(users)
+                for col, bandwidth in row_cells[row]:
+                    values[col] = round(bandwidth, 3) if bandwidth > 0 else 0
+                writer.writerow([applications[row]] + values + [round(row_totals[row], 3)])
+    
+    print(f"Created {filename} with {len(applications)} applications")
 
 if __name__ == "__main__":
     main()
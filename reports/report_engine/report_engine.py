@@ -0,0 +1,552 @@
+#!/usr/bin/env python3
+import json
+import csv
+import os
+import sys
+import argparse
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+
+# The API client, credentials, time windows and raw archive are shared with
+# the WAN app stats report
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'get_wan_app_stats'))
+from get_app_stats import (CatoClient, SeriesRecords, resolve_credentials, exec_cli, format_time_frame, report_range,
+                           split_range, whole_buckets, merge_timeseries, save_raw_archive, zstandard)
+
+
+# Series selection shared by the *TimeSeries queries
+TIMESERIES_SELECTION = """timeseries ( buckets:$buckets ) {
+			data
+			label
+			key {
+				measureFieldName
+				dimensions {
+					fieldName
+					value
+				}
+			}
+			sum
+			units
+			info
+		}"""
+
+class QueryType:
+    """How a catocli query type is sent and read. `kind` is 'timeseries' for
+    the *TimeSeries queries, 'metrics' for accountMetrics and 'records' for
+    appStats. The variable names map the generic dimensions, measures,
+    filters and sort of a report spec to the query's own variables"""
+    
+    def __init__(self, name, kind, query, dimension=None, measure=None, filter=None, sort=None):
+        self.name = name
+        self.kind = kind
+        self.query = query
+        self.dimension = dimension
+        self.measure = measure
+        self.filter = filter
+        self.sort = sort
+    
+    @property
+    def chunked(self):
+        """Time series are merged by timestamp, so they can be fetched in windows"""
+        return self.kind == 'timeseries'
+
+QUERY_TYPES = {query_type.name: query_type for query_type in [
+    QueryType('appStatsTimeSeries', 'timeseries', """query appStatsTimeSeries ( $accountID:ID! $timeFrame:TimeFrame! $measure:[Measure] $dimension:[Dimension] $appStatsFilter:[AppStatsFilter!] $buckets:Int! ) {
+	appStatsTimeSeries ( accountID:$accountID timeFrame:$timeFrame measures:$measure dimensions:$dimension filters:$appStatsFilter ) {
+		from
+		to
+		granularity
+		""" + TIMESERIES_SELECTION + """
+	}
+}""", dimension='dimension', measure='measure', filter='appStatsFilter'),
+    QueryType('eventsTimeSeries', 'timeseries', """query eventsTimeSeries ( $accountID:ID! $timeFrame:TimeFrame! $eventsMeasure:[EventsMeasure] $eventsDimension:[EventsDimension] $eventsFilter:[EventsFilter] $buckets:Int! ) {
+	eventsTimeSeries ( accountID:$accountID timeFrame:$timeFrame measures:$eventsMeasure dimensions:$eventsDimension filters:$eventsFilter ) {
+		from
+		to
+		granularity
+		""" + TIMESERIES_SELECTION + """
+	}
+}""", dimension='eventsDimension', measure='eventsMeasure', filter='eventsFilter'),
+    QueryType('socketPortMetricsTimeSeries', 'timeseries', """query socketPortMetricsTimeSeries ( $accountID:ID! $timeFrame:TimeFrame! $socketPortMetricsMeasure:[SocketPortMetricsMeasure] $socketPortMetricsDimension:[SocketPortMetricsDimension] $socketPortMetricsFilter:[SocketPortMetricsFilter] $buckets:Int! ) {
+	socketPortMetricsTimeSeries ( accountID:$accountID timeFrame:$timeFrame measures:$socketPortMetricsMeasure dimensions:$socketPortMetricsDimension filters:$socketPortMetricsFilter ) {
+		from
+		to
+		granularity
+		""" + TIMESERIES_SELECTION + """
+	}
+}""", dimension='socketPortMetricsDimension', measure='socketPortMetricsMeasure', filter='socketPortMetricsFilter'),
+    QueryType('accountMetrics', 'metrics', """query accountMetrics ( $accountID:ID! $timeFrame:TimeFrame! $groupInterfaces:Boolean $groupDevices:Boolean $siteIDs:[ID!] $userIDs:[ID!] $labels:[TimeseriesMetricType!] $buckets:Int! $perSecond:Boolean $withMissingData:Boolean $toRate:Boolean $useDefaultSizeBucket:Boolean ) {
+	accountMetrics ( accountID:$accountID timeFrame:$timeFrame groupInterfaces:$groupInterfaces groupDevices:$groupDevices ) {
+		from
+		to
+		sites ( siteIDs:$siteIDs ) {
+			id
+			name
+			interfaces {
+				name
+				timeseries ( labels:$labels buckets:$buckets perSecond:$perSecond withMissingData:$withMissingData toRate:$toRate useDefaultSizeBucket:$useDefaultSizeBucket ) {
+					label
+					data
+					units
+					sum
+				}
+			}
+		}
+		users ( userIDs:$userIDs ) {
+			id
+			name
+			interfaces {
+				name
+				timeseries ( labels:$labels buckets:$buckets perSecond:$perSecond withMissingData:$withMissingData toRate:$toRate useDefaultSizeBucket:$useDefaultSizeBucket ) {
+					label
+					data
+					units
+					sum
+				}
+			}
+		}
+	}
+}""", measure='labels'),
+    QueryType('appStats', 'records', """query appStats ( $accountID:ID! $timeFrame:TimeFrame! $measure:[Measure] $dimension:[Dimension] $appStatsFilter:[AppStatsFilter!] $appStatsSort:[AppStatsSort!] $limit:Int $from:Int ) {
+	appStats ( accountID:$accountID timeFrame:$timeFrame measures:$measure dimensions:$dimension filters:$appStatsFilter sort:$appStatsSort limit:$limit from:$from ) {
+		from
+		to
+		records {
+			fieldsMap
+			fieldsUnitTypes
+		}
+	}
+}""", dimension='dimension', measure='measure', filter='appStatsFilter', sort='appStatsSort'),
+]}
+
+# Dimensions of accountMetrics series: the site or user and its interface
+METRICS_DIMENSIONS = ['entity_type', 'entity_name', 'interface_name']
+
+OUTPUT_FILES = ('raw', 'timeseries', 'summary', 'pivot')
+
+AGGREGATIONS = ('sum', 'avg', 'max', 'min', 'count', 'count_distinct')
+
+# Example measure: "sum(upstream)", or "rtt" for accountMetrics
+MEASURE_PATTERN = re.compile(r"^(\w+)\(([^)]+)\)$")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the Cato reports of a report spec file and write their CSV files')
+    parser.add_argument('--spec', required=True, help='JSON file listing the reports to run')
+    parser.add_argument('--account-id', help='Cato account ID (default: account_id of the spec file)')
+    parser.add_argument('--only', nargs='+', metavar='NAME', help='Only run the reports with these names (default: all reports)')
+    parser.add_argument('--output-dir', default='.', help='Directory the report files are written to (default: current directory)')
+    parser.add_argument('--client', choices=['auto', 'api', 'catocli'], default='auto',
+                        help='Query the API directly (api) or through the catocli command (catocli). '
+                             'auto uses the API when credentials are found, otherwise catocli (default: auto)')
+    parser.add_argument('--profile', help='catocli profile to read the API key and endpoint from (default: the active catocli profile)')
+    parser.add_argument('--workers', type=int, default=4, help='Number of queries run at the same time, over all reports (default: 4)')
+    parser.add_argument('--retries', type=int, default=3, help='Retries per query after a failed or rate-limited query (default: 3)')
+    
+    args = parser.parse_args()
+    
+    try:
+        spec = load_spec(args.spec)
+    except (OSError, ValueError) as e:
+        print(f"Invalid report spec {args.spec}: {e}")
+        return
+    
+    account_id = args.account_id or spec.get('account_id')
+    if not account_id:
+        print("No account ID given with --account-id or in the spec file")
+        return
+    
+    reports = spec['reports']
+    if args.only:
+        reports = [report for report in reports if report['name'] in args.only]
+        missing = set(args.only) - set(report['name'] for report in reports)
+        if missing:
+            print(f"No reports named {', '.join(sorted(missing))} in {args.spec}")
+            return
+    if any(report['output']['raw_format'] == 'zstd' for report in reports) and zstandard is None:
+        print("raw_format zstd requires the zstandard module: pip install zstandard")
+        return
+    
+    client = None
+    if args.client != 'catocli':
+        credentials = resolve_credentials(args.profile)
+        if credentials:
+            client = CatoClient(credentials['endpoint'], credentials['cato_token'])
+        elif args.client == 'api':
+            print("No API key found in the catocli profile or the CATO_TOKEN environment variable")
+            return
+    
+    os.makedirs(args.output_dir, exist_ok=True)
+    results = run_reports(reports, account_id, client, args.workers, args.retries, args.output_dir)
+    
+    print(f"\nReports:")
+    for report in reports:
+        status = 'ok' if results[report['name']] else 'FAILED'
+        print(f"  - {report['name']} ({report['query']}): {status}")
+
+def load_spec(path):
+    """Read a report spec file and fill in the defaults of every report.
+    Raises ValueError for an invalid spec"""
+    with open(path) as f:
+        spec = json.load(f)
+    if not isinstance(spec.get('reports'), list) or not spec['reports']:
+        raise ValueError("the spec needs a non-empty reports list")
+    
+    names = set()
+    for report in spec['reports']:
+        name = report.get('name')
+        if not name or name in names:
+            raise ValueError(f"every report needs a unique name, got {name!r}")
+        names.add(name)
+        if report.get('query') not in QUERY_TYPES:
+            raise ValueError(f"report {name}: query must be one of {', '.join(QUERY_TYPES)}")
+        query_type = QUERY_TYPES[report['query']]
+        
+        try:
+            report['measures'] = [parse_measure(measure, query_type) for measure in report.get('measures', [])]
+        except ValueError as e:
+            raise ValueError(f"report {name}: {e}")
+        if not report['measures']:
+            raise ValueError(f"report {name}: no measures")
+        report['dimensions'] = [dimension if isinstance(dimension, str) else dimension['fieldName']
+                                for dimension in report.get('dimensions', [])]
+        if query_type.kind == 'metrics' and report['dimensions']:
+            raise ValueError(f"report {name}: accountMetrics series are always by {', '.join(METRICS_DIMENSIONS)}")
+        report.setdefault('filters', [])
+        report.setdefault('sort', [])
+        report.setdefault('options', {})
+        
+        if 'time_frame' not in report:
+            report.setdefault('days', 1)
+            report.setdefault('granularity', 3600)
+            report.setdefault('buckets', report['days'] * 86400 // report['granularity'])
+            report.setdefault('chunk_days', 1 if query_type.chunked else 0)
+        else:
+            report.setdefault('buckets', 24)
+            report['chunk_days'] = 0
+        if report['chunk_days'] and not query_type.chunked:
+            raise ValueError(f"report {name}: {query_type.name} cannot be fetched in chunks")
+        bucket_seconds = report.get('days', 1) * 86400 / report['buckets']
+        if report['chunk_days'] and not whole_buckets(report['chunk_days'] * 86400, bucket_seconds):
+            # windows would split buckets, and get buckets of another width
+            print(f"Warning: report {name}: chunk_days {report['chunk_days']} is not a whole number of "
+                  f"{bucket_seconds:g}s buckets, fetching it in one query (chunk_days 0)")
+            report['chunk_days'] = 0
+        count_distinct = [measure['fieldName'] for measure in report['measures'] if measure['aggType'] == 'count_distinct']
+        if count_distinct and query_type.kind != 'records':
+            # distinct counts of separate buckets do not add up
+            raise ValueError(f"report {name}: count_distinct is only supported by appStats")
+        
+        output = report.setdefault('output', {})
+        output.setdefault('prefix', name)
+        output.setdefault('files', ['raw', 'timeseries', 'summary'])
+        output.setdefault('raw_format', 'gzip')
+        output.setdefault('skip_zero', False)
+        output.setdefault('summary_by', report_dimensions(report))
+        unknown = set(output['files']) - set(OUTPUT_FILES)
+        if unknown:
+            raise ValueError(f"report {name}: unknown output files {', '.join(sorted(unknown))}")
+        if 'pivot' in output['files']:
+            pivot = output.get('pivot') or {}
+            for axis in ('rows', 'columns'):
+                if pivot.get(axis) not in report_dimensions(report):
+                    raise ValueError(f"report {name}: pivot {axis} must be one of the report dimensions")
+            pivot.setdefault('measure', report['measures'][0]['fieldName'])
+            output['pivot'] = pivot
+        # an appStats record holds the distinct count of its dimension values,
+        # which only carries over to groups of one record
+        if count_distinct and 'summary' in output['files'] and set(output['summary_by']) != set(report_dimensions(report)):
+            raise ValueError(f"report {name}: count_distinct needs summary_by to be all the report dimensions")
+        if (count_distinct and 'pivot' in output['files'] and output['pivot']['measure'] in count_distinct
+                and {output['pivot']['rows'], output['pivot']['columns']} != set(report_dimensions(report))):
+            raise ValueError(f"report {name}: a count_distinct pivot needs rows and columns to be all the report dimensions")
+    return spec
+
+def parse_measure(measure, query_type):
+    """Return a measure of the spec as {"aggType", "fieldName"}. Measures are
+    given as objects or as "aggType(fieldName)", and accountMetrics labels
+    on their own, which are summed"""
+    if isinstance(measure, str):
+        match = MEASURE_PATTERN.match(measure)
+        if match:
+            measure = {'aggType': match.group(1), 'fieldName': match.group(2)}
+        elif query_type.kind == 'metrics':
+            measure = {'aggType': 'sum', 'fieldName': measure}
+        else:
+            raise ValueError(f"measure {measure!r} is not of the form aggType(fieldName)")
+    if measure.get('aggType') not in AGGREGATIONS:
+        raise ValueError(f"measure {measure.get('fieldName')!r}: aggType must be one of {', '.join(AGGREGATIONS)}")
+    return measure
+
+def report_dimensions(report):
+    if QUERY_TYPES[report['query']].kind == 'metrics':
+        return METRICS_DIMENSIONS
+    return report['dimensions']
+
+def query_variables(report, time_frame, buckets):
+    """Build the variables of a report query for one time frame"""
+    query_type = QUERY_TYPES[report['query']]
+    variables = dict(report['options'], timeFrame=time_frame)
+    if query_type.kind == 'metrics':
+        variables['labels'] = [measure['fieldName'] for measure in report['measures']]
+    else:
+        variables[query_type.measure] = report['measures']
+        variables[query_type.dimension] = [{'fieldName': dimension} for dimension in report['dimensions']]
+        if report['filters']:
+            variables[query_type.filter] = report['filters']
+    if query_type.sort and report['sort']:
+        variables[query_type.sort] = report['sort']
+    if query_type.kind != 'records':
+        variables['buckets'] = buckets
+    return variables
+
+def report_queries(report):
+    """Return the (time_frame, variables) of the queries of a report, oldest
+    window first"""
+    if 'time_frame' in report:
+        return [(report['time_frame'], query_variables(report, report['time_frame'], report['buckets']))]
+    if not report['chunk_days']:
+        time_frame = f"last.P{report['days']}D"
+        return [(time_frame, query_variables(report, time_frame, report['buckets']))]
+    
+    start, end = report_range(report['days'], report['granularity'])
+    bucket_seconds = report['days'] * 86400 / report['buckets']
+    queries = []
+    for window_start, window_end in split_range(start, end, report['chunk_days']):
+        time_frame = format_time_frame(window_start, window_end)
+        buckets = max(1, round((window_end - window_start).total_seconds() / bucket_seconds))
+        queries.append((time_frame, query_variables(report, time_frame, buckets)))
+    return queries
+
+def run_query(query_type, account_id, variables, client):
+    """Run one query through the in-process client, or catocli when no client
+    is configured"""
+    if client is not None:
+        return client.query(query_type.query, dict(variables, accountID=account_id), query_type.name)
+    command = f"catocli query {query_type.name} -accountID={account_id} '{json.dumps(variables)}'"
+    return exec_cli(command)
+
+def fetch_query(query_type, account_id, time_frame, variables, retries, client):
+    """Run one query, retrying failed and rate-limited queries with backoff"""
+    for attempt in range(retries + 1):
+        if attempt:
+            delay = 2 ** attempt
+            print(f"Retrying {query_type.name} {time_frame} in {delay}s (attempt {attempt + 1} of {retries + 1})")
+            time.sleep(delay)
+        result = run_query(query_type, account_id, variables, client)
+        if result is None:
+            continue
+        if result.get('errors'):
+            if 'rate limit' in json.dumps(result['errors']).lower():
+                continue
+            # not transient, a retry would fail the same way
+            return None
+        if query_type.name not in (result.get('data') or {}):
+            return None
+        return result
+    return None
+
+def run_reports(reports, account_id, client, workers, retries, output_dir):
+    """Run the reports with one pool of `workers` queries shared by all of
+    them. The queries of every report are queued up front, and each report is
+    written as soon as its own queries are done, while the queries of the
+    next reports are still running. Returns {name: True if written}"""
+    written = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for report in reports:
+            query_type = QUERY_TYPES[report['query']]
+            queries = report_queries(report)
+            print(f"Queueing {report['name']}: {len(queries)} {query_type.name} queries")
+            futures = [executor.submit(fetch_query, query_type, account_id, time_frame, variables, retries, client)
+                       for time_frame, variables in queries]
+            pending.append((report, queries, futures))
+        
+        for report, queries, futures in pending:
+            started = time.monotonic()
+            results = [future.result() for future in futures]
+            failed = [time_frame for (time_frame, _), result in zip(queries, results) if result is None]
+            if failed:
+                print(f"Failed to get {report['name']} for {', '.join(failed)}")
+                written[report['name']] = False
+                continue
+            
+            # the futures hold the responses too, release them with the merge
+            futures.clear()
+            try:
+                data = merge_timeseries(results, report['query'])
+                write_report(report, data, output_dir)
+            except Exception as e:
+                print(f"Failed to write {report['name']}: {e}")
+                written[report['name']] = False
+                continue
+            written[report['name']] = True
+            print(f"Finished {report['name']} in {time.monotonic() - started:.2f}s after its queries")
+    return written
+
+# Example label: "sum(downstream) for application_name='Company APP', user_name='PM Analyst'"
+LABEL_MEASURE_PATTERN = re.compile(r"^\w+\(([^)]+)\)")
+LABEL_DIMENSION_PATTERN = re.compile(r"(\w+)='([^']*)'")
+
+def series_key(series):
+    """Return the measure and the {dimension: value} of a time series, from
+    its key, or parsed from its label when the key was not selected"""
+    key = series.get('key')
+    if key and key.get('measureFieldName'):
+        return key['measureFieldName'], {d['fieldName']: d.get('value') or '' for d in key.get('dimensions') or []}
+    label = series.get('label', '')
+    match = LABEL_MEASURE_PATTERN.search(label)
+    return match.group(1) if match else label, dict(LABEL_DIMENSION_PATTERN.findall(label))
+
+def process_report(report, data):
+    """Parse the response of a report into SeriesRecords"""
+    query_type = QUERY_TYPES[report['query']]
+    dimensions = report_dimensions(report)
+    response = data['data'][query_type.name] or {}
+    skip_zero = report['output']['skip_zero']
+    
+    def points_of(series):
+        return [(timestamp_ms, value) for timestamp_ms, value in series.get('data') or []
+                if value is not None and (value or not skip_zero)]
+    
+    labelled = []
+    if query_type.kind == 'timeseries':
+        for series in response.get('timeseries') or []:
+            measure, values = series_key(series)
+            labelled.append((tuple(values.get(dimension, '') for dimension in dimensions), measure, points_of(series)))
+    elif query_type.kind == 'metrics':
+        for entity_type in ('sites', 'users'):
+            for entity in response.get(entity_type) or []:
+                for interface in entity.get('interfaces') or []:
+                    values = (entity_type[:-1], entity.get('name') or entity.get('id') or '', interface.get('name') or '')
+                    for series in interface.get('timeseries') or []:
+                        labelled.append((values, series.get('label', ''), points_of(series)))
+    else:
+        # one record per dimension values, with a field per measure
+        for record in response.get('records') or []:
+            fields = record.get('fieldsMap') or {}
+            values = tuple(str(fields.get(dimension, '')) for dimension in dimensions)
+            for measure in report['measures']:
+                value = fields.get(measure['fieldName'])
+                if value not in (None, '') and (float(value) or not skip_zero):
+                    labelled.append((values, measure['fieldName'], [(0, float(value))]))
+    
+    records = SeriesRecords(dimensions, timed=query_type.kind != 'records')
+    # Add the series in dimension and measure order, then sort by time
+    labelled.sort(key=lambda x: (x[0], x[1]))
+    for values, measure, points in labelled:
+        records.add_series(values, measure, points)
+    records.sort_by_time()
+    return records
+
+def aggregate_records(records, group_by, aggregations):
+    """Aggregate the records per value of the `group_by` dimensions and per
+    measure, in a single pass. `aggregations` maps a measure to how its
+    buckets combine: sum, avg, max or min. Counts are summed, and distinct
+    counts are only allowed where each group is a single record. Returns
+    {(group values..., measure): value}"""
+    index = [records.dimensions.index(dimension) for dimension in group_by]
+    columns = [records.codes[i] for i in index]
+    accumulators = {}
+    for measure, value, *codes in zip(records.measure_codes, records.values, *columns):
+        key = (*codes, measure)
+        accumulator = accumulators.get(key)
+        if accumulator is None:
+            accumulators[key] = [value, 1, value, value]
+        else:
+            accumulator[0] += value
+            accumulator[1] += 1
+            if value < accumulator[2]:
+                accumulator[2] = value
+            if value > accumulator[3]:
+                accumulator[3] = value
+    
+    totals = {}
+    for (*codes, measure), (total, count, low, high) in accumulators.items():
+        name = records.measures[measure]
+        aggregation = aggregations.get(name, 'sum')
+        if aggregation == 'avg':
+            value = total / count
+        elif aggregation == 'max':
+            value = high
+        elif aggregation == 'min':
+            value = low
+        else:
+            value = total
+        key = tuple(records.names[i][code] for i, code in zip(index, codes)) + (name,)
+        totals[key] = value
+    return totals
+
+def write_report(report, data, output_dir):
+    """Write the output files of a report from its merged response"""
+    output = report['output']
+    prefix = os.path.join(output_dir, output['prefix'])
+    if 'raw' in output['files']:
+        raw_filename = save_raw_archive(data, prefix, output['raw_format'])
+        print(f"Saved raw data to {raw_filename}")
+    
+    records = process_report(report, data)
+    del data
+    if not records:
+        print(f"No data in {report['name']}")
+        return
+    
+    if 'timeseries' in output['files']:
+        filename = f"{prefix}_timeseries.csv"
+        header = (['time'] if records.timed else []) + records.dimensions + ['measure', 'value']
+        with open(filename, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(header)
+            writer.writerows(records.rows())
+        print(f"Created {filename} with {len(records)} records")
+    
+    aggregations = {measure['fieldName']: measure['aggType'] for measure in report['measures']}
+    if 'summary' in output['files']:
+        # measures in spec order, then any the response added
+        measures = [measure['fieldName'] for measure in report['measures'] if measure['fieldName'] in records.measures]
+        measures += sorted(set(records.measures) - set(measures))
+        save_summary(records, output['summary_by'], measures, aggregations, f"{prefix}_summary.csv")
+    if 'pivot' in output['files']:
+        save_pivot(records, output['pivot'], aggregations, f"{prefix}_pivot.csv")
+
+def save_summary(records, group_by, measures, aggregations, filename):
+    """Save one row per value of the `group_by` dimensions, with one column per
+    measure, ordered by the first measure descending"""
+    totals = aggregate_records(records, group_by, aggregations)
+    groups = defaultdict(dict)
+    for (*values, measure), value in totals.items():
+        groups[tuple(values)][measure] = value
+    
+    ordered = sorted(groups.items(), key=lambda x: x[0])
+    ordered.sort(key=lambda x: round(x[1].get(measures[0], 0), 3), reverse=True)
+    with open(filename, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(list(group_by) + measures)
+        for values, measure_values in ordered:
+            writer.writerow(list(values) + [round(measure_values.get(measure, 0), 3) for measure in measures])
+    print(f"Created {filename} with {len(ordered)} rows")
+
+def save_pivot(records, pivot, aggregations, filename):
+    """Save one measure as a table of one row per value of the `rows`
+    dimension and one column per value of the `columns` dimension, with the
+    rows ordered by their total descending"""
+    totals = aggregate_records(records, [pivot['rows'], pivot['columns']], aggregations)
+    cells = {(row, column): value for (row, column, measure), value in totals.items() if measure == pivot['measure']}
+    rows = sorted(set(row for row, _ in cells))
+    columns = sorted(set(column for _, column in cells))
+    row_totals = {row: sum(cells.get((row, column), 0) for column in columns) for row in rows}
+    rows.sort(key=lambda row: round(row_totals[row], 3), reverse=True)
+    
+    with open(filename, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow([pivot['rows']] + [column or 'Unknown' for column in columns] + ['total'])
+        for row in rows:
+            writer.writerow([row] + [round(cells.get((row, column), 0), 3) for column in columns]
+                            + [round(row_totals[row], 3)])
+    print(f"Created {filename} with {len(rows)} rows")
+
+
+if __name__ == "__main__":
+    main()